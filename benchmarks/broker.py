@@ -0,0 +1,109 @@
+'''
+Minimal in-process MQTT 3.1.1 broker stand-in for benchmarks. It accepts
+connections, acknowledges CONNECT/SUBSCRIBE/PINGREQ and QoS 1 PUBLISH packets
+and counts the published messages. Messages are not routed to subscribers.
+'''
+
+import socket
+import threading
+import socketserver
+
+CONNECT = 1
+PUBLISH = 3
+PUBACK = 4
+SUBSCRIBE = 8
+PINGREQ = 12
+DISCONNECT = 14
+
+
+def read_exactly(sock, length):
+    data = bytearray()
+    while len(data) < length:
+        chunk = sock.recv(length - len(data))
+        if not chunk:
+            raise ConnectionError("Connection closed")
+        data += chunk
+    return bytes(data)
+
+
+def read_packet(sock):
+    header = read_exactly(sock, 1)[0]
+    remaining = 0
+    multiplier = 1
+    while True:
+        byte = read_exactly(sock, 1)[0]
+        remaining += (byte & 0x7F) * multiplier
+        if byte < 0x80:
+            break
+        multiplier *= 128
+    return header >> 4, header & 0x0F, read_exactly(sock, remaining)
+
+
+class BrokerHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        broker = self.server.broker
+        sock = self.request
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            while True:
+                packet_type, flags, body = read_packet(sock)
+                if packet_type == CONNECT:
+                    sock.sendall(b"\x20\x02\x00\x00")
+                elif packet_type == PUBLISH:
+                    qos = (flags >> 1) & 0x03
+                    topic_length = int.from_bytes(body[:2], "big")
+                    topic = body[2:2 + topic_length].decode("utf-8")
+                    position = 2 + topic_length
+                    if qos > 0:
+                        packet_id = body[position:position + 2]
+                        position += 2
+                        sock.sendall(b"\x40\x02" + packet_id)
+                    broker.on_publish(topic, body[position:])
+                elif packet_type == SUBSCRIBE:
+                    packet_id = body[:2]
+                    position = 2
+                    granted = bytearray()
+                    while position < len(body):
+                        topic_length = int.from_bytes(body[position:position + 2], "big")
+                        position += 2 + topic_length
+                        granted.append(min(body[position], 1))
+                        position += 1
+                    sock.sendall(bytes([0x90, 2 + len(granted)]) + packet_id + bytes(granted))
+                elif packet_type == PINGREQ:
+                    sock.sendall(b"\xd0\x00")
+                elif packet_type == DISCONNECT:
+                    return
+        except (ConnectionError, OSError):
+            return
+
+
+class ThreadingTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class MiniBroker:
+    def __init__(self, host="127.0.0.1", port=0):
+        self.server = ThreadingTCPServer((host, port), BrokerHandler)
+        self.server.broker = self
+        self.host, self.port = self.server.server_address
+        self.lock = threading.Lock()
+        self.message_count = 0
+        self.byte_count = 0
+        self.topic_counts = {}
+        self.thread = None
+
+    def on_publish(self, topic, payload):
+        with self.lock:
+            self.message_count += 1
+            self.byte_count += len(payload)
+            self.topic_counts[topic] = self.topic_counts.get(topic, 0) + 1
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,254 @@
+'''
+Benchmarks of the CAN ingest, OBD callback and MQTT publish hot paths.
+Runs without hardware: a python-can virtual bus, a stub obd.Async and an
+in-process broker stand-in (benchmarks/broker.py).
+
+    python benchmarks/run_benchmarks.py --output results.json \
+        --thresholds benchmarks/thresholds.json
+
+Exits with status 1 if a result is worse than its threshold.
+'''
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import platform
+import threading
+import logging
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.append(os.path.join(ROOT, "can"))
+
+import can
+import obd
+from config import Config
+from CANListener import CANListener
+from mqtt import MqttClient, PublishPipeline
+from obd_listener import OBDTracker
+from broker import MiniBroker
+
+CAN_CONFIG_FILEPATH = os.path.join(ROOT, "can", "config.yaml")
+DEFAULT_THRESHOLDS_FILEPATH = os.path.join(
+    os.path.dirname(os.path.realpath(__file__)), "thresholds.json")
+
+
+def percentile(sorted_values, quantile):
+    if len(sorted_values) == 0:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(quantile * len(sorted_values)))]
+
+
+def make_frames(n_frames, msg_ids):
+    return [can.Message(arbitration_id=msg_ids[index % len(msg_ids)], is_extended_id=False,
+                        data=bytes([index & 0xFF, 0, index & 0xFF, 0, 7, 0, 0, 0]),
+                        timestamp=index * 0.0002)
+            for index in range(n_frames)]
+
+
+def bench_can_callback(n_frames):
+    # CPU cost of CANListener.listen_async_cb (filtering, batching, decoding)
+    listener = CANListener(None, Config(CAN_CONFIG_FILEPATH).read_config())
+    frames = make_frames(n_frames, list(listener.config_messages.keys()) + [0x7FF])
+    start = time.perf_counter()
+    for frame in frames:
+        listener.listen_async_cb(frame)
+    listener.decode_batch()
+    elapsed = time.perf_counter() - start
+    return {"can_callback_frames_per_second": n_frames / elapsed}
+
+
+def bench_can_virtual_bus(n_frames, timeout=60.0):
+    # Frames sent on a virtual bus until CANListener received all of them
+    channel = "bench_{}".format(os.getpid())
+    receive_bus = can.interface.Bus(channel=channel, interface="virtual")
+    send_bus = can.interface.Bus(channel=channel, interface="virtual")
+    listener = CANListener(receive_bus, Config(CAN_CONFIG_FILEPATH).read_config())
+    frames = make_frames(n_frames, list(listener.config_messages.keys()))
+    loop = asyncio.new_event_loop()
+    notifier = listener.attach_to_loop(loop)
+
+    def send_all():
+        for frame in frames:
+            send_bus.send(frame)
+
+    async def wait_for_frames():
+        deadline = time.perf_counter() + timeout
+        while listener.filter_stats.received < n_frames and time.perf_counter() < deadline:
+            await asyncio.sleep(0.001)
+
+    start = time.perf_counter()
+    sender = threading.Thread(target=send_all)
+    sender.start()
+    loop.run_until_complete(wait_for_frames())
+    elapsed = time.perf_counter() - start
+    sender.join()
+    notifier.stop()
+    loop.close()
+    send_bus.shutdown()
+    receive_bus.shutdown()
+    return {"can_virtual_bus_frames_per_second": listener.filter_stats.received / elapsed}
+
+
+class StubResponse:
+    def __init__(self, command, value):
+        self.command = command
+        self.value = value
+        self.time = time.time()
+
+    def is_null(self):
+        return False
+
+
+class StubAsync:
+    '''
+    Stands in for obd.Async. Watched callbacks are invoked by emit()
+    '''
+
+    def __init__(self, *args, **kwargs):
+        self.watches = []
+        self.supported_commands = set()
+
+    def is_connected(self):
+        return True
+
+    def watch(self, command, callback=None, force=False):
+        self.watches.append((command, callback))
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def close(self):
+        pass
+
+    def emit(self, n_responses):
+        # Returns the latency (s) of every callback call
+        latencies = []
+        responses = [StubResponse(command, obd.Unit.Quantity(index, "rpm"))
+                     for index, (command, _) in enumerate(self.watches)]
+        for index in range(n_responses):
+            slot = index % len(self.watches)
+            callback = self.watches[slot][1]
+            start = time.perf_counter()
+            callback(responses[slot])
+            latencies.append(time.perf_counter() - start)
+        return latencies
+
+
+class StubMqttClient:
+    '''
+    MqttClient without a connection. publish_value goes through a real
+    (never started) PublishPipeline, like it does in MqttClient
+    '''
+
+    def __init__(self):
+        self.id = "bench"
+        self.is_connected = True
+        self.publisher = PublishPipeline(self)
+        self.aggregator = None
+
+    def wait_connected(self, timeout=None):
+        return True
+
+    def publish_value(self, key, value, received=None):
+        return self.publisher.update(key, value, received)
+
+    def publish(self, topic, payload, qos=0):
+        pass
+
+
+def bench_obd_callback(n_responses):
+    config = {"OBD": {"ID": "bench", "job": "publish", "polling": "round_robin",
+                      "messages": ["RPM", "SPEED", "COOLANT_TEMP", "ENGINE_LOAD"],
+                      # The stub has no adapter to profile
+                      "profile": False}}
+    original_async = obd.Async
+    obd.Async = StubAsync
+    try:
+        tracker = OBDTracker(config, mqtt_client=StubMqttClient())
+        tracker.connect(print_info=False)
+    finally:
+        obd.Async = original_async
+    latencies = sorted(tracker.connection.emit(n_responses))
+    return {"obd_callback_mean_latency": sum(latencies) / len(latencies),
+            "obd_callback_p50_latency": percentile(latencies, 0.5),
+            "obd_callback_p99_latency": percentile(latencies, 0.99)}
+
+
+def bench_mqtt_publish(n_messages, timeout=60.0):
+    broker = MiniBroker().start()
+    config = {"Broker": {"host": broker.host, "port": broker.port,
+                         "username": None, "password": None},
+              "Client": {"id": "bench", "subscribe_topics": [], "pub_topics": [],
+                         "heartbeat_period": 3600}}
+    client = MqttClient(config)
+    client.connect()
+    deadline = time.perf_counter() + timeout
+    while not client.is_connected and time.perf_counter() < deadline:
+        time.sleep(0.01)
+    received_before = broker.message_count
+    payload = b"x" * 32
+    start = time.perf_counter()
+    for index in range(n_messages):
+        client.publish("bench/topic", payload)
+    while broker.message_count - received_before < n_messages and time.perf_counter() < deadline:
+        time.sleep(0.001)
+    elapsed = time.perf_counter() - start
+    received = broker.message_count - received_before
+    client.shut_down()
+    broker.stop()
+    return {"mqtt_publish_messages_per_second": received / elapsed}
+
+
+def check_thresholds(results, thresholds):
+    # Thresholds are {"min": {name: value}, "max": {name: value}}
+    failures = []
+    for name, minimum in thresholds.get("min", {}).items():
+        if name in results and results[name] < minimum:
+            failures.append("{} = {:.6g} < {:.6g}".format(name, results[name], minimum))
+    for name, maximum in thresholds.get("max", {}).items():
+        if name in results and results[name] > maximum:
+            failures.append("{} = {:.6g} > {:.6g}".format(name, results[name], maximum))
+    return failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-o", "--output", default=None, help="JSON file to write the results to")
+    parser.add_argument("-t", "--thresholds", default=DEFAULT_THRESHOLDS_FILEPATH)
+    parser.add_argument("-n", "--scale", type=float, default=1.0,
+                        help="multiplies the number of frames/messages of every benchmark")
+    args = parser.parse_args()
+    # Benchmarks measure the hot paths, not the console
+    logging.getLogger().setLevel(logging.WARNING)
+
+    results = {}
+    results.update(bench_can_callback(int(100000 * args.scale)))
+    results.update(bench_can_virtual_bus(int(20000 * args.scale)))
+    results.update(bench_obd_callback(int(20000 * args.scale)))
+    results.update(bench_mqtt_publish(int(20000 * args.scale)))
+
+    report = {"platform": {"machine": platform.machine(),
+                           "processor": platform.processor(),
+                           "python": platform.python_version(),
+                           "system": platform.platform()},
+              "timestamp": time.time(),
+              "results": results}
+    failures = []
+    if args.thresholds is not None and os.path.exists(args.thresholds):
+        with open(args.thresholds, "r") as stream:
+            failures = check_thresholds(results, json.load(stream))
+        report["regressions"] = failures
+    output = json.dumps(report, indent=2)
+    if args.output is not None:
+        with open(args.output, "w") as stream:
+            stream.write(output)
+    print(output)
+    sys.exit(1 if len(failures) > 0 else 0)
@@ -0,0 +1,146 @@
+'''
+Builds python-can `can_filters` from the requested CAN message IDs so that
+irrelevant frames are dropped by the kernel (SocketCAN) instead of waking up
+the Python interpreter, and keeps statistics on where frames were filtered.
+'''
+
+import heapq
+import logging
+
+logger = logging.getLogger(__name__)
+
+STANDARD_MASK = 0x7FF
+EXTENDED_MASK = 0x1FFFFFFF
+
+# Config keywords
+FILTERS_STR = 'FILTERS'
+MAX_FILTERS_STR = 'max_filters'
+
+DEFAULT_MAX_FILTERS = 16
+
+
+def _coverage(mask, full_mask):
+    # Number of IDs accepted by a filter having the given mask
+    return 1 << (bin(full_mask).count('1') - bin(mask & full_mask).count('1'))
+
+
+def _merge(filter_a, filter_b):
+    can_id_a, mask_a = filter_a
+    can_id_b, mask_b = filter_b
+    mask = mask_a & mask_b & ~(can_id_a ^ can_id_b)
+    return can_id_a & mask, mask
+
+
+def coalesce_ids(msg_ids, full_mask, max_filters):
+    '''
+    Merges exact-match (id, mask) pairs until at most `max_filters` remain.
+    IDs are sorted and only neighbouring filters are merged, each time the
+    pair that lets through the fewest IDs that were not requested. The merge
+    costs are kept in a heap, so this is O(n log n) in the number of IDs.
+    Returns a list of (can_id, can_mask) tuples.
+    '''
+    msg_ids = sorted(set(msg_ids))
+    count = len(msg_ids)
+    filters = [(msg_id, full_mask) for msg_id in msg_ids]
+    sizes = [1] * count  # requested IDs per filter
+    # Doubly linked list of the remaining filters in ID order
+    following = list(range(1, count + 1))
+    preceding = list(range(-1, count - 1))
+    versions = [0] * count  # -1 once merged into the preceding filter
+    heap = []
+
+    def push(i):
+        j = following[i]
+        if i < 0 or j >= count:
+            return
+        merged = _merge(filters[i], filters[j])
+        false_positives = _coverage(merged[1], full_mask) - sizes[i] - sizes[j]
+        heapq.heappush(heap, (false_positives, i, versions[i], j, versions[j], merged))
+
+    for i in range(count - 1):
+        push(i)
+    remaining = count
+    while remaining > max(max_filters, 1):
+        _, i, version_i, j, version_j, merged = heapq.heappop(heap)
+        if versions[i] != version_i or versions[j] != version_j or following[i] != j:
+            # One of the filters changed since the cost was computed
+            continue
+        filters[i] = merged
+        sizes[i] += sizes[j]
+        versions[i] += 1
+        versions[j] = -1
+        following[i] = following[j]
+        if following[j] < count:
+            preceding[following[j]] = i
+        remaining -= 1
+        push(preceding[i])
+        push(i)
+    return [filters[i] for i in range(count) if versions[i] >= 0]
+
+
+def build_can_filters(msg_ids, max_filters=DEFAULT_MAX_FILTERS):
+    # Standard and extended IDs are coalesced separately as they never match
+    # each other's filters. Returns None (accept all) if no ID is requested.
+    msg_ids = list(msg_ids)
+    if len(msg_ids) == 0:
+        return None
+    standard_ids = [msg_id for msg_id in msg_ids if msg_id <= STANDARD_MASK]
+    extended_ids = [msg_id for msg_id in msg_ids if msg_id > STANDARD_MASK]
+    standard_budget = max_filters
+    if len(extended_ids) > 0 and len(standard_ids) > 0:
+        standard_budget = max(1, max_filters * len(standard_ids) // len(msg_ids))
+    can_filters = []
+    for can_id, can_mask in coalesce_ids(standard_ids, STANDARD_MASK, standard_budget):
+        can_filters.append(
+            {"can_id": can_id, "can_mask": can_mask, "extended": False})
+    for can_id, can_mask in coalesce_ids(extended_ids, EXTENDED_MASK,
+                                         max(1, max_filters - len(can_filters))):
+        can_filters.append(
+            {"can_id": can_id, "can_mask": can_mask, "extended": True})
+    logger.info("Constructed {} CAN filters for {} message IDs: {}".format(
+        len(can_filters), len(msg_ids), can_filters))
+    return can_filters
+
+
+class FilterStats:
+    '''
+    Counts frames that reached userspace and how many of them were dropped
+    there. Frames dropped in the kernel are derived from the interface's
+    rx_packets counter (SocketCAN only).
+    '''
+    __slots__ = ('channel', 'received', 'rejected', 'rx_packets_start')
+
+    def __init__(self, channel=None):
+        self.channel = channel
+        self.received = 0
+        self.rejected = 0
+        self.rx_packets_start = self.read_rx_packets()
+
+    def read_rx_packets(self):
+        if self.channel is None:
+            return None
+        try:
+            with open("/sys/class/net/{}/statistics/rx_packets".format(self.channel), "r") as stream:
+                return int(stream.read())
+        except (OSError, ValueError):
+            return None
+
+    def count(self, accepted):
+        self.received += 1
+        if not accepted:
+            self.rejected += 1
+
+    def count_many(self, received, rejected):
+        self.received += received
+        self.rejected += rejected
+
+    def kernel_filtered(self):
+        rx_packets = self.read_rx_packets()
+        if rx_packets is None or self.rx_packets_start is None:
+            return None
+        return max(0, rx_packets - self.rx_packets_start - self.received)
+
+    def as_dict(self):
+        return {"kernel_filtered": self.kernel_filtered(),
+                "userspace_received": self.received,
+                "userspace_filtered": self.rejected}
@@ -1,24 +1,74 @@
 import can
 from can.bus import BusState
 import asyncio
+import time
+import numpy as np
 
 from threading import Thread
-from CANMessage import CANMessage
+from SignalStore import SignalStore
+from SignalDecoder import SignalDecoder, FrameBatch, message_key, message_size, transport_of, \
+    pgn_key, PGN_KEY_FLAG, TRANSPORT_J1939, TRANSPORT_ISOTP, MAX_DLC
+from ChangeFilter import ChangeFilter, CHANGE_DETECTION_STR
+from Transport import TransportReassembler, j1939_pgn, j1939_filters, TRANSPORT_CONFIG_STR
+from CANFilter import build_can_filters, FilterStats, FILTERS_STR, MAX_FILTERS_STR, DEFAULT_MAX_FILTERS
+from SharedFrameRing import INGEST_STR, POLL_INTERVAL_STR, DEFAULT_POLL_INTERVAL, \
+    FLAG_EXTENDED, FLAG_REMOTE, FLAG_ERROR
 
 import logging
 import inspect
-logging.getLogger().setLevel(logging.INFO)
+
+logger = logging.getLogger(__name__)
 
 CAN_MESSAGES = 'CAN_MESSAGES'
+# Binds a message to a channel, see ListenerManager
+CHANNEL_STR = 'channel'
+DECODER_STR = 'DECODER'
+BATCH_SIZE_STR = 'batch_size'
+MAX_BATCH_DELAY_STR = 'max_batch_delay'
+
+# Binary schema types (mqtt/serializer.py) of the decoded signals and of the
+# raw hex payloads of transport messages, see schema_fields
+SIGNAL_FIELD_TYPE = "f32"
+PAYLOAD_FIELD_TYPE = "str"
+DEFAULT_BATCH_SIZE = 64
+DEFAULT_MAX_BATCH_DELAY = 0.05  # seconds
 
 
 class CANListener:
     def __init__(self, bus, config={}):
         self.bus = bus
         self.config = config
+        # Called with (msg_id, timestamps, values) for every decoded batch
+        self.batch_listeners = []
+        # Called with (msg_id, timestamp, values) of the latest values of a
+        # message, unless they are within its deadband of the stored ones
+        self.latest_listeners = []
+        # Monotonic and wall clock time of the last decode (see stamp_decode)
+        self.decoded_at = 0.0
+        self.decoded_wall = 0.0
+        # Set by aggregate_to: every frame is decoded and the change filter
+        # only applies to the stored and published latest values
+        self.decode_all = False
+        # Additional can.Notifier listeners receiving every frame, e.g. a TraceRecorder
+        self.frame_listeners = []
+        # Called with (msg_id, timestamp, payload) for every reassembled message
+        self.transport_listeners = []
+        # Called without arguments once a new config is applied
+        self.reload_listeners = []
+        # Set while attached to a loop, see detach()
+        self.attached = False
+        # Set if a recorder needs every frame: no kernel filters are applied
+        self.record_all = False
+        # Prepended to the published keys of the messages not bound to a
+        # channel, set by ListenerManager when listening to several channels
+        self.shared_key_prefix = ""
+        self.notifier = None
         self.set_config_msgids()
+        self.init_decoder()
+        self.init_transport()
         self.init_can_messages()
         self.construct_message_id_mapping()
+        self.filter_stats = FilterStats()
 
     def set_config_msgids(self):
         # Stores the CAN message IDs (retrieved from the config.yaml file)
@@ -26,34 +76,238 @@ class CANListener:
         self.config_messages = {}  # set()
         if self.config is not None and CAN_MESSAGES in self.config:
             for can_msg in self.config[CAN_MESSAGES]:
-                logging.info("Reading {} message information".format(can_msg))
-                id = self.config[CAN_MESSAGES][can_msg]['ID']
+                logger.info("Reading {} message information".format(can_msg))
+                id = message_key(self.config[CAN_MESSAGES][can_msg])
                 self.config_messages[id] = can_msg
-            logging.info("Constructed requested CAN message ID set: {}".format(
+            logger.info("Constructed requested CAN message ID set: {}".format(
                 self.config_messages))
         elif self.config is not None and CAN_MESSAGES not in self.config:
-            logging.warning("config does not include {0}".format(CAN_MESSAGES))
+            logger.warning("config does not include {0}".format(CAN_MESSAGES))
 
     def init_can_messages(self):
-        # Stores the latest CAN messages as CAN_Message_ID - CANMessage pairs
-        self.can_data = {}
-        for can_msg in self.config_messages:
-            self.can_data[can_msg] = CANMessage(
-                id=can_msg, desc=self.config_messages[can_msg])
+        # Stores the latest CAN messages in a preallocated store indexed by
+        # CAN_Message_ID. self.can_data[msg_id] returns a view of the message
+        signal_names = {}
+        for msg_id in self.config_messages:
+            if msg_id in self.decoder or self.decoder.is_transport(msg_id):
+                signal_names[msg_id] = self.decoder.signal_names(msg_id)
+        max_payload = max([MAX_DLC] + [message_size(msg_config)
+                                       for msg_config in self.config.get(CAN_MESSAGES, {}).values()]) \
+            if self.config is not None else MAX_DLC
+        self.can_data = SignalStore(self.config_messages, signal_names, max_payload)
 
     def construct_message_id_mapping(self):
-        logging.debug("Constructing self.desc_id_dict")
+        logger.debug("Constructing self.desc_id_dict")
         if self.config_messages is None:
             func_info = inspect.currentframe().f_back.f_code
-            logging.warning(
+            logger.warning(
                 "[{}]: Must initialize self.config_messages first".format(func_info.co_name))
         # Construct description-id map
         self.desc_id_dict = {}
         for msg_id in self.config_messages:
             self.desc_id_dict[self.config_messages[msg_id]] = msg_id
+        # Published keys are <key base>/<signal>
+        messages = (self.config.get(CAN_MESSAGES) or {}) if self.config is not None else {}
+        self.key_bases = {}
+        for msg_id, desc in self.config_messages.items():
+            shared = CHANNEL_STR not in messages.get(desc, {})
+            self.key_bases[msg_id] = (self.shared_key_prefix if shared else "") + desc
+
+    def init_decoder(self):
+        # Compiles the signal layouts of the configured messages and preallocates
+        # the batch in which received frames wait to be decoded
+        decoder_config = {}
+        if self.config is not None and DECODER_STR in self.config:
+            decoder_config = self.config[DECODER_STR]
+        self.max_batch_delay = decoder_config.get(
+            MAX_BATCH_DELAY_STR, DEFAULT_MAX_BATCH_DELAY)
+        self.decoder = SignalDecoder(self.config)
+        self.frame_batch = FrameBatch(
+            decoder_config.get(BATCH_SIZE_STR, DEFAULT_BATCH_SIZE))
+        self.decoder_ids = np.array(sorted(self.decoder.tables), dtype=np.uint32)
+        # Drops unchanged frames before they are batched, if enabled (after the
+        # decoder if decode_all is set)
+        self.change_filter = None
+        if decoder_config.get(CHANGE_DETECTION_STR, False):
+            self.change_filter = ChangeFilter(self.config, self.decoder, decoder_config)
+
+    def init_transport(self):
+        # J1939 messages are looked up by the PGN of 29-bit frames, and messages
+        # longer than a frame are reassembled before being decoded
+        self.has_pgn_messages = any(msg_id & PGN_KEY_FLAG for msg_id in self.config_messages)
+        j1939_pgns, isotp_ids = [], []
+        messages = self.config.get(CAN_MESSAGES, {}) if self.config is not None else {}
+        for msg_config in messages.values():
+            transport = transport_of(msg_config)
+            if transport == TRANSPORT_J1939:
+                j1939_pgns.append(message_key(msg_config) & ~PGN_KEY_FLAG)
+            elif transport == TRANSPORT_ISOTP:
+                isotp_ids.append(message_key(msg_config))
+        self.transport = None
+        if len(j1939_pgns) > 0 or len(isotp_ids) > 0:
+            self.transport = TransportReassembler.from_config(
+                self.config.get(TRANSPORT_CONFIG_STR), j1939_pgns, isotp_ids,
+                self.on_transport_message)
+
+    def set_shared_key_prefix(self, prefix):
+        # Set before publish_to/aggregate_to, the keys of a reload use the new prefix
+        self.shared_key_prefix = prefix
+        self.construct_message_id_mapping()
+
+    def add_frame_listener(self, callback):
+        self.frame_listeners.append(callback)
+
+    def add_batch_listener(self, callback):
+        self.batch_listeners.append(callback)
+
+    def add_latest_listener(self, callback):
+        self.latest_listeners.append(callback)
+
+    def add_transport_listener(self, callback):
+        self.transport_listeners.append(callback)
+
+    def add_reload_listener(self, callback):
+        self.reload_listeners.append(callback)
+
+    def reload(self, config, can_filters=None):
+        '''
+        Applies a new config without reopening the bus. Frames waiting in the
+        batch are decoded with the old layouts, messages whose config did not
+        change keep their stored values and the kernel filters are replaced
+        (by `can_filters` if given). Returns False if nothing changed.
+        '''
+        old_config = self.config if self.config is not None else {}
+        if config == old_config:
+            return False
+        old_messages = old_config.get(CAN_MESSAGES) or {}
+        new_messages = config.get(CAN_MESSAGES) or {}
+        unchanged = [desc for desc, msg_config in new_messages.items()
+                     if old_messages.get(desc) == msg_config]
+        logger.info("Reloading CAN config. Added: {}, removed: {}, changed: {}".format(
+            [desc for desc in new_messages if desc not in old_messages],
+            [desc for desc in old_messages if desc not in new_messages],
+            [desc for desc in new_messages if desc in old_messages and desc not in unchanged]))
+        if len(self.frame_batch) > 0:
+            self.decode_batch()
+        old_store = self.can_data
+        self.config = config
+        self.set_config_msgids()
+        self.init_decoder()
+        self.init_transport()
+        self.init_can_messages()
+        self.can_data.carry_over(old_store, [message_key(new_messages[desc]) for desc in unchanged])
+        self.construct_message_id_mapping()
+        if self.bus is not None and not self.record_all:
+            self.bus.set_filters(can_filters if can_filters is not None else self.build_can_filters())
+        for callback in self.reload_listeners:
+            callback()
+        return True
+
+    def publish_to(self, publisher):
+        # Feeds the latest decoded value of every signal into a publish
+        # pipeline (e.g. MqttClient.publisher) keyed as <description>/<signal>
+        # (<channel>/<description>/<signal> if shared, see ListenerManager).
+        # The kernel timestamp of the frame and the decode time are passed on,
+        # on the monotonic clock, so that the pipeline can trace the latency
+        # Transport messages without signals (e.g. DM1, VIN) are published raw
+        raw_ids = self.raw_message_ids()
+
+        def update_raw_ids():
+            raw_ids.clear()
+            raw_ids.update(self.raw_message_ids())
+        self.add_reload_listener(update_raw_ids)
+
+        def publish_latest_cb(msg_id, timestamp, values):
+            prefix = self.key_bases[msg_id] + "/"
+            names = self.decoder.signal_names(msg_id)
+            publisher.update_many(
+                zip([prefix + name for name in names], values.tolist()),
+                self.monotonic_from_wall(float(timestamp)), self.decoded_at)
+        self.add_latest_listener(publish_latest_cb)
+
+        def publish_payload_cb(msg_id, timestamp, payload):
+            if msg_id in raw_ids:
+                publisher.update(self.key_bases[msg_id] + "/payload", payload.hex(),
+                                 self.monotonic_from_wall(timestamp), self.decoded_at)
+        if len(raw_ids) > 0:
+            self.add_transport_listener(publish_payload_cb)
+
+    def raw_message_ids(self):
+        # Decoded transport messages without signals, published as hex payloads
+        return set(msg_id for msg_id in self.config_messages
+                   if self.decoder.is_transport(msg_id)
+                   and len(self.decoder.signal_names(msg_id)) == 0)
+
+    def schema_fields(self) -> dict:
+        # Binary schema type of every key published by publish_to, see
+        # MqttClient.set_schema
+        fields = {key: SIGNAL_FIELD_TYPE for key in self.signal_keys()}
+        for msg_id in self.raw_message_ids():
+            fields[self.key_bases[msg_id] + "/payload"] = PAYLOAD_FIELD_TYPE
+        return fields
+
+    def signal_keys(self):
+        # <key base>/<signal> of the decoded signals, in config order
+        return ["{}/{}".format(self.key_bases[msg_id], name)
+                for msg_id in self.config_messages
+                if msg_id in self.decoder or self.decoder.is_transport(msg_id)
+                for name in self.decoder.signal_names(msg_id)]
+
+    def capture_to(self, sink):
+        # Passes every decoded sample to `sink.add_samples(names, timestamps,
+        # values)`, e.g. for the freeze frames of a DiagnosticsMonitor. Names
+        # are <description>/<signal>, as published
+        def capture_batch_cb(msg_id, timestamps, values):
+            prefix = self.key_bases[msg_id] + "/"
+            names = self.decoder.signal_names(msg_id)
+            if len(names) > 0:
+                sink.add_samples([prefix + name for name in names], timestamps, values)
+        self.add_batch_listener(capture_batch_cb)
+
+    def bus_healthy(self) -> bool:
+        # Buses that do not report their state count as healthy. Buses opened
+        # by an ingest process are not known here (see ListenerManager.healthy)
+        if self.bus is None:
+            return True
+        try:
+            return self.bus.state != BusState.ERROR
+        except NotImplementedError:
+            return True
+
+    def aggregate_to(self, aggregator):
+        # Feeds every decoded sample (not only the latest, nor only the changed
+        # frames) into a window aggregator (e.g. MqttClient.aggregator) keyed
+        # as <description>/<signal>
+        self.decode_all = True
+
+        def aggregate_batch_cb(msg_id, timestamps, values):
+            prefix = self.key_bases[msg_id] + "/"
+            for index, name in enumerate(self.decoder.signal_names(msg_id)):
+                aggregator.add_many(prefix + name, values[:, index])
+        self.add_batch_listener(aggregate_batch_cb)
+
+    def build_can_filters(self):
+        # Kernel-side filters accepting (a superset of) the configured message IDs
+        max_filters = DEFAULT_MAX_FILTERS
+        if self.config is not None and FILTERS_STR in self.config:
+            max_filters = self.config[FILTERS_STR].get(
+                MAX_FILTERS_STR, DEFAULT_MAX_FILTERS)
+        msg_ids = [msg_id for msg_id in self.config_messages if not msg_id & PGN_KEY_FLAG]
+        pgns = [msg_id & ~PGN_KEY_FLAG for msg_id in self.config_messages
+                if msg_id & PGN_KEY_FLAG]
+        pgn_filters = j1939_filters(
+            pgns, self.transport is not None and len(self.transport.j1939_keys) > 0) \
+            if len(pgns) > 0 else []
+        can_filters = build_can_filters(msg_ids, max(1, max_filters - len(pgn_filters))) \
+            if len(msg_ids) > 0 else None
+        if len(pgn_filters) == 0:
+            return can_filters
+        return (can_filters or []) + pgn_filters
 
     def set_bus(self, bus):
         self.bus = bus
+        channel = getattr(bus, 'channel', None) if bus is not None else None
+        self.filter_stats = FilterStats(channel)
 
     def get_bus(self):
         return self.bus
@@ -84,13 +338,18 @@ class CANListener:
             print("Requested CAN message IDs: {}".format(self.config_messages))
             while True:
                 msg = self.bus.recv(1)
-                if msg is not None and msg.arbitration_id in self.config_messages:
+                if msg is None:
+                    continue
+                is_requested = msg.arbitration_id in self.config_messages
+                self.filter_stats.count(is_requested)
+                if is_requested:
                     print(msg)
-                elif msg is not None:
+                else:
                     print(
                         "[DEBUG] Message is not in the requested messages:\n{}".format(msg))
         except KeyboardInterrupt:
             print("keyboardInterrupt! Stopped listening to the CN bus")
+            print("Filter stats: {}".format(self.filter_stats.as_dict()))
             pass
 
     def start_background_listener(self, loop=None):
@@ -100,26 +359,218 @@ class CANListener:
         try:
             thread.join()
         except KeyboardInterrupt:
-            logging.info("Keyboard interrupt. Stopping...")
+            logger.info("Keyboard interrupt. Stopping...")
 
     def listen_asynchronously(self):
         func_info = inspect.currentframe().f_back.f_code
         if self.bus is None:
-            logging.warning(
+            logger.warning(
                 "[{}]: Must set bus first".format(func_info.co_name))
             return
-        listeners = [self.listen_async_cb]
         asyncio.set_event_loop(asyncio.new_event_loop())
         loop = asyncio.get_event_loop()
-        notifier = can.Notifier(self.bus, listeners, loop=loop)
+        self.attach_to_loop(loop)
+        try:
+            loop.run_forever()
+        except KeyboardInterrupt:
+            print("Interrupted")
+
+    def attach_to_loop(self, loop):
+        # Registers the bus with an event loop run by the caller, e.g. the loop
+        # of an AsyncMqttClient, so that both share a single thread
+        if self.bus is None:
+            logger.warning("Must set bus before attaching to a loop")
+            return None
+        listeners = [self.listen_async_cb] + self.frame_listeners
+        self.notifier = can.Notifier(self.bus, listeners, loop=loop)
+        self.attached = True
+        loop.call_later(self.max_batch_delay, self.flush_stale_batch, loop)
+        return self.notifier
+
+    def detach(self):
+        # Stops the callbacks scheduled on the loop, e.g. once the channel is removed
+        self.attached = False
+        if self.notifier is not None:
+            self.notifier.stop()
+            self.notifier = None
+
+    def flush_stale_batch(self, loop):
+        # Decodes the pending frames once they waited max_batch_delay even if
+        # no further frame arrives to trigger it
+        if not self.attached:
+            return
+        first_timestamp = self.frame_batch.first_timestamp()
+        if first_timestamp is not None and time.time() - first_timestamp >= self.max_batch_delay:
+            self.decode_batch()
+        loop.call_later(self.max_batch_delay, self.flush_stale_batch, loop)
+
+    def listen_to_ring(self, ring, channel=None):
+        # Runs the decoding side of the multi-process ingest (see SharedFrameRing)
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        loop = asyncio.get_event_loop()
+        self.attach_ring(ring, loop, channel)
         try:
             loop.run_forever()
         except KeyboardInterrupt:
             print("Interrupted")
 
+    def attach_ring(self, ring, loop, channel=None, ingest=None):
+        # Consumes the frames an IngestProcess receives, in batches, from `loop`.
+        # Polling stops with an error once `ingest` (the IngestProcess) exited
+        self.filter_stats = FilterStats(channel)
+        poll_interval = DEFAULT_POLL_INTERVAL
+        if self.config is not None and INGEST_STR in self.config:
+            poll_interval = self.config[INGEST_STR].get(
+                POLL_INTERVAL_STR, DEFAULT_POLL_INTERVAL)
+        self.attached = True
+        loop.call_soon(self.poll_ring, ring, loop, poll_interval, ingest)
+
+    def poll_ring(self, ring, loop, poll_interval, ingest=None):
+        if not self.attached:
+            return
+        # Checked before draining, so that the last frames are still decoded
+        ingest_exited = ingest is not None and not ingest.is_alive()
+        while len(ring) > 0:
+            ids, data, dlcs, timestamps, flags = ring.read(self.frame_batch.capacity)
+            accepted = np.isin(ids, self.decoder_ids)
+            n_accepted = int(accepted.sum())
+            if self.has_pgn_messages or self.transport is not None:
+                # The other frames are counted by route_frame
+                self.filter_stats.count_many(n_accepted, 0)
+                for row in np.flatnonzero(~accepted).tolist():
+                    msg_id = self.route_frame(int(ids[row]), bool(flags[row] & FLAG_EXTENDED),
+                                              bytes(data[row, :dlcs[row]]), float(timestamps[row]))
+                    if msg_id is not None:
+                        ids[row] = msg_id
+                        accepted[row] = True
+            else:
+                self.filter_stats.count_many(len(ids), len(ids) - n_accepted)
+            if self.change_filter is not None and not self.decode_all:
+                for row in np.flatnonzero(accepted).tolist():
+                    accepted[row] = self.change_filter.accept(
+                        int(ids[row]), data[row, :dlcs[row]].tobytes(), float(timestamps[row]))
+            if len(self.frame_listeners) > 0:
+                for msg in ring_messages(ids, data, dlcs, timestamps, flags):
+                    for callback in self.frame_listeners:
+                        callback(msg)
+            self.decode_frames(ids[accepted], data[accepted],
+                               dlcs[accepted], timestamps[accepted])
+        if ingest_exited:
+            logger.error("CAN ingest process of {} exited with code {}. No frames are "
+                         "received".format(ingest.channel, ingest.exitcode))
+            self.attached = False
+            return
+        loop.call_later(poll_interval, self.poll_ring, ring, loop, poll_interval, ingest)
+
     def listen_async_cb(self, msg):
-        print(msg)
-        CANListener.print_postproc()
+        msg_id = msg.arbitration_id
+        if msg_id in self.decoder:
+            self.filter_stats.count(True)
+        else:
+            msg_id = self.route_frame(msg_id, msg.is_extended_id, msg.data, msg.timestamp)
+            if msg_id is None:
+                return
+        if self.change_filter is not None and not self.decode_all and \
+                not self.change_filter.accept(msg_id, msg.data, msg.timestamp):
+            return
+        batch_full = self.frame_batch.append(msg_id, msg.data, msg.timestamp)
+        if batch_full or msg.timestamp - self.frame_batch.first_timestamp() >= self.max_batch_delay:
+            self.decode_batch()
+
+    def route_frame(self, arbitration_id, is_extended, data, timestamp):
+        # Frames that are not decoded by their ID: single frame J1939 messages are
+        # batched under their PGN key (returned), transport frames are reassembled.
+        # Returns None if the frame is not batched
+        if is_extended and self.has_pgn_messages:
+            key = pgn_key(j1939_pgn(arbitration_id))
+            if key in self.decoder:
+                self.filter_stats.count(True)
+                return key
+            if self.decoder.is_transport(key):
+                # A transport message short enough to fit into a single frame
+                self.filter_stats.count(True)
+                self.on_transport_message(key, bytes(data), timestamp)
+                return None
+        if self.transport is not None and \
+                self.transport.feed(arbitration_id, is_extended, data, timestamp):
+            self.filter_stats.count(True)
+            return None
+        self.filter_stats.count(False)
+        return None
+
+    def on_transport_message(self, msg_id, payload, timestamp):
+        # A reassembled message reaches the same store and listeners as batches
+        values = self.decoder.decode_payload(msg_id, payload)
+        self.stamp_decode()
+        self.can_data.update(msg_id, values, np.frombuffer(payload, dtype=np.uint8))
+        for callback in self.batch_listeners:
+            callback(msg_id, np.array([timestamp]), values[np.newaxis])
+        for callback in self.latest_listeners:
+            callback(msg_id, timestamp, values)
+        for callback in self.transport_listeners:
+            callback(msg_id, timestamp, payload)
+
+    def decode_batch(self):
+        # Decodes the pending frames at once and keeps the latest value of each ID
+        ids, data, timestamps = self.frame_batch.view()
+        decoded = self.decode_frames(ids, data, self.frame_batch.dlcs, timestamps)
+        self.frame_batch.reset()
+        return decoded
+
+    def decode_frames(self, ids, data, dlcs, timestamps):
+        decoded = self.decoder.decode(ids, data)
+        self.stamp_decode()
+        latest = decoded
+        if self.change_filter is not None:
+            # Latest values within their deadband of the stored ones are neither
+            # stored nor published. The batch listeners still get every row
+            latest = set(msg_id for msg_id, (rows, values) in decoded.items()
+                         if self.latest_changed(msg_id, rows[-1], values[-1],
+                                                data, dlcs, timestamps))
+        self.can_data.begin_write()
+        try:
+            for msg_id, (rows, values) in decoded.items():
+                if msg_id in latest:
+                    last = rows[-1]
+                    self.can_data.write(msg_id, values[-1], data[last, :dlcs[last]])
+        finally:
+            self.can_data.end_write()
+        for msg_id, (rows, values) in decoded.items():
+            for callback in self.batch_listeners:
+                callback(msg_id, timestamps[rows], values)
+            if msg_id in latest:
+                for callback in self.latest_listeners:
+                    callback(msg_id, timestamps[rows[-1]], values[-1])
+        return decoded
+
+    def stamp_decode(self):
+        # Both clocks are read together, once per decode, so that the frame
+        # timestamps (wall clock) map consistently to the monotonic clock
+        self.decoded_at = time.monotonic()
+        self.decoded_wall = time.time()
+
+    def monotonic_from_wall(self, timestamp):
+        # Monotonic time of a frame timestamp, relative to the last decode
+        return self.decoded_at - (self.decoded_wall - timestamp)
+
+    def latest_changed(self, msg_id, row, values, data, dlcs, timestamps):
+        # The payload of the latest frame is only checked here if every frame
+        # was decoded (see decode_all)
+        if self.decode_all and not self.change_filter.accept(
+                msg_id, data[row, :dlcs[row]].tobytes(), float(timestamps[row])):
+            return False
+        return self.change_filter.significant(
+            msg_id, values, self.can_data.latest(msg_id), self.can_data[msg_id].last_update)
+
 
-    def print_postproc():
-        print("Finished processing")
+def ring_messages(ids, data, dlcs, timestamps, flags):
+    # Rebuilds can.Message objects for the frame listeners (e.g. TraceRecorder)
+    for index in range(len(ids)):
+        frame_flags = int(flags[index])
+        yield can.Message(timestamp=float(timestamps[index]),
+                          arbitration_id=int(ids[index]),
+                          is_extended_id=bool(frame_flags & FLAG_EXTENDED),
+                          is_remote_frame=bool(frame_flags & FLAG_REMOTE),
+                          is_error_frame=bool(frame_flags & FLAG_ERROR),
+                          dlc=int(dlcs[index]),
+                          data=bytes(data[index, :dlcs[index]]))
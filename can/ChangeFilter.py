@@ -0,0 +1,108 @@
+'''
+Change detection ahead of the decoder. Cyclic frames mostly repeat the
+previous payload, so a frame is only batched if its payload differs from the
+last accepted payload of its ID, at most once per `min_interval` and at least
+once per `max_interval` (so that the store keeps showing the ID as alive).
+After decoding, the latest values of an ID are only stored and published if
+a signal moved by more than its `deadband` since the stored value. Listeners
+of the decoded batches still get every row. If a window aggregator is
+attached, every frame is decoded and the payload check only applies to the
+latest frame of each ID in a batch, i.e. to the stored and published values.
+
+    DECODER:
+        change_detection: true
+        # Defaults of the messages that do not set them
+        min_interval: 0
+        max_interval: 1.0
+    CAN_MESSAGES:
+        eng_speed:
+            ID: 1
+            min_interval: 0.1
+            signals:
+                eng_speed:
+                    ...
+                    deadband: 0.5
+'''
+
+import time
+import numpy as np
+
+from SignalDecoder import CAN_MESSAGES, SIGNALS_STR, message_key
+
+# Config keywords
+CHANGE_DETECTION_STR = 'change_detection'
+MIN_INTERVAL_STR = 'min_interval'
+MAX_INTERVAL_STR = 'max_interval'
+DEADBAND_STR = 'deadband'
+
+DEFAULT_MIN_INTERVAL = 0.0  # seconds
+DEFAULT_MAX_INTERVAL = 1.0  # seconds
+
+# Per ID state
+LAST_PAYLOAD = 0
+LAST_TIME = 1
+MIN_INTERVAL = 2
+MAX_INTERVAL = 3
+
+
+class ChangeFilter:
+    def __init__(self, config, decoder, decoder_config={}):
+        self.default_min_interval = decoder_config.get(MIN_INTERVAL_STR, DEFAULT_MIN_INTERVAL)
+        self.default_max_interval = decoder_config.get(MAX_INTERVAL_STR, DEFAULT_MAX_INTERVAL)
+        self.state = {}  # msg_id -> [last payload, last frame time, min interval, max interval]
+        self.intervals = {}  # msg_id -> (min interval, max interval)
+        self.deadbands = {}  # msg_id -> per signal deadband array, if any is set
+        messages = config.get(CAN_MESSAGES, {}) if config is not None else {}
+        for msg_config in messages.values():
+            msg_id = message_key(msg_config)
+            self.intervals[msg_id] = (
+                msg_config.get(MIN_INTERVAL_STR, self.default_min_interval),
+                msg_config.get(MAX_INTERVAL_STR, self.default_max_interval))
+            if msg_id not in decoder or SIGNALS_STR not in msg_config:
+                continue
+            signals = msg_config[SIGNALS_STR]
+            deadbands = np.array([signals[name].get(DEADBAND_STR, 0.0)
+                                  for name in decoder.signal_names(msg_id)], dtype=np.float64)
+            if deadbands.any():
+                self.deadbands[msg_id] = deadbands
+        self.unchanged_count = 0
+        self.rate_limited_count = 0
+        self.deadband_count = 0
+
+    def accept(self, msg_id, payload, timestamp):
+        # Returns False if the frame should be dropped before decoding
+        state = self.state.get(msg_id)
+        if state is None:
+            min_interval, max_interval = self.intervals.get(
+                msg_id, (self.default_min_interval, self.default_max_interval))
+            self.state[msg_id] = [bytes(payload), timestamp, min_interval, max_interval]
+            return True
+        elapsed = timestamp - state[LAST_TIME]
+        if elapsed < state[MIN_INTERVAL]:
+            self.rate_limited_count += 1
+            return False
+        if elapsed < state[MAX_INTERVAL] and state[LAST_PAYLOAD] == payload:
+            self.unchanged_count += 1
+            return False
+        state[LAST_PAYLOAD] = bytes(payload)
+        state[LAST_TIME] = timestamp
+        return True
+
+    def significant(self, msg_id, values, last_values, last_update):
+        # True if the latest `values` moved beyond the deadband of the stored ones
+        deadbands = self.deadbands.get(msg_id)
+        if deadbands is None:
+            return True
+        max_interval = self.intervals.get(msg_id, (0, self.default_max_interval))[1]
+        if time.monotonic() - last_update >= max_interval:
+            return True
+        # NaN (never stored) compares as significant
+        if not (np.abs(values - last_values) <= deadbands).all():
+            return True
+        self.deadband_count += 1
+        return False
+
+    def stats(self):
+        return {"unchanged": self.unchanged_count,
+                "rate_limited": self.rate_limited_count,
+                "deadband": self.deadband_count}
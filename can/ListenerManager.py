@@ -0,0 +1,274 @@
+'''
+Runs one CANListener per configured CAN channel in a single event loop and
+merges their output into one stream tagged by channel name.
+
+    CHANNELS:
+        powertrain:
+            channel: can0
+            interface: socketcan
+            bitrate: 500000
+        body:
+            channel: can1
+            interface: socketcan
+            bitrate: 250000
+            # Optional explicit kernel filters, computed from the messages otherwise
+            filters: [{can_id: 0x300, can_mask: 0x700}]
+
+CAN_MESSAGES entries are bound to a channel with `channel: <name>`; messages
+without one are listened to on every channel. With several channels, the
+keys these shared messages are published under are prefixed with the channel
+name (<channel>/<description>/<signal>), so that the values of the channels
+do not overwrite each other. Without a CHANNELS section a
+single socketcan channel can0 at 500 kbit/s is used.
+
+reload() applies a changed config in place: channels whose bus settings
+changed are reopened, the others keep their bus and only get new messages
+and kernel filters.
+'''
+
+import os
+import copy
+import logging
+import can
+
+from CANListener import CANListener, CAN_MESSAGES, CHANNEL_STR
+from SharedFrameRing import IngestProcess, INGEST_STR, MODE_STR, MODE_PROCESS
+from TraceRecorder import TraceRecorder, DIRECTORY_STR
+
+logger = logging.getLogger(__name__)
+
+# Config keywords
+CHANNELS_STR = 'CHANNELS'
+INTERFACE_STR = 'interface'
+BITRATE_STR = 'bitrate'
+CAN_FILTERS_STR = 'filters'
+
+DEFAULT_CHANNELS = {'can0': {CHANNEL_STR: 'can0', INTERFACE_STR: 'socketcan',
+                             BITRATE_STR: 500000}}
+
+
+class ListenerManager:
+    def __init__(self, config):
+        self.config = config if config is not None else {}
+        self.channels = self.config.get(CHANNELS_STR) or DEFAULT_CHANNELS
+        self.listeners = {}  # channel name -> CANListener
+        self.ingests = {}  # channel name -> IngestProcess
+        self.recorders = {}  # channel name -> TraceRecorder
+        self.notifiers = {}  # channel name -> can.Notifier
+        # Applied as setup(name, listener) to every channel, also to those added on reload
+        self.setups = []
+        self.loop = None
+        for name in self.channels:
+            self.listeners[name] = self.create_listener(name)
+
+    def create_listener(self, name):
+        listener = CANListener(None, self.channel_config(name))
+        listener.set_shared_key_prefix(self.shared_key_prefix(name))
+        return listener
+
+    def shared_key_prefix(self, name):
+        return name + "/" if len(self.channels) > 1 else ""
+
+    def channel_config(self, name):
+        # The config of the listener of channel `name`: only its messages
+        config = copy.copy(self.config)
+        messages = self.config.get(CAN_MESSAGES) or {}
+        config[CAN_MESSAGES] = {desc: message for desc, message in messages.items()
+                                if message.get(CHANNEL_STR, name) == name}
+        return config
+
+    def bus_kwargs(self, name):
+        channel_config = self.channels[name]
+        can_filters = channel_config.get(CAN_FILTERS_STR)
+        if can_filters is None:
+            # Let the kernel drop the frames that are not in the config
+            can_filters = self.listeners[name].build_can_filters()
+        if self.listeners[name].record_all:
+            # The recorder keeps every frame, the listener drops the others itself
+            can_filters = None
+        kwargs = {'channel': channel_config.get(CHANNEL_STR, name),
+                  'interface': channel_config.get(INTERFACE_STR, 'socketcan'),
+                  'can_filters': can_filters}
+        if channel_config.get(BITRATE_STR) is not None:
+            kwargs['bitrate'] = channel_config[BITRATE_STR]
+        return kwargs
+
+    def add_setup(self, setup):
+        self.setups.append(setup)
+        for name, listener in self.listeners.items():
+            setup(name, listener)
+
+    def add_frame_listener(self, callback):
+        # `callback(channel, msg)` is called for every frame of every channel
+        self.add_setup(lambda name, listener: listener.add_frame_listener(
+            lambda msg: callback(name, msg)))
+
+    def add_batch_listener(self, callback):
+        # `callback(channel, msg_id, timestamps, values)` is called for every decoded batch
+        self.add_setup(lambda name, listener: listener.add_batch_listener(
+            lambda msg_id, timestamps, values: callback(name, msg_id, timestamps, values)))
+
+    def publish_to(self, publisher):
+        # Keys are <description>/<signal>, descriptions are unique over all
+        # channels. Shared messages are prefixed with the channel name
+        self.add_setup(lambda name, listener: listener.publish_to(publisher))
+
+    def aggregate_to(self, aggregator):
+        # Same keys as publish_to. Every frame of every channel is decoded
+        self.add_setup(lambda name, listener: listener.aggregate_to(aggregator))
+
+    def capture_to(self, sink):
+        # Same keys as publish_to, see CANListener.capture_to
+        self.add_setup(lambda name, listener: listener.capture_to(sink))
+
+    def schema_fields(self) -> dict:
+        # Binary schema types of the keys of publish_to over all channels
+        fields = {}
+        for listener in self.listeners.values():
+            fields.update(listener.schema_fields())
+        return fields
+
+    def record_to(self, recorder_config):
+        # One trace directory per channel, since the trace format has no channel
+        # column. Recorded channels are not filtered by the kernel, so call it
+        # before open(): channels opened already only drop their filters
+        def record_channel(name, listener):
+            channel_recorder_config = dict(recorder_config)
+            channel_recorder_config[DIRECTORY_STR] = os.path.join(
+                recorder_config[DIRECTORY_STR], name)
+            self.recorders[name] = TraceRecorder.from_config(channel_recorder_config)
+            listener.add_frame_listener(self.recorders[name].append)
+            listener.record_all = True
+            if listener.bus is not None:
+                listener.bus.set_filters(None)
+            elif name in self.ingests:
+                logger.warning("Channel {} records the frames passing its kernel filters "
+                               "until its ingest process restarts".format(name))
+            if self.loop is not None:
+                self.recorders[name].attach_to_loop(self.loop)
+        self.add_setup(record_channel)
+
+    def open(self):
+        # Opens the buses, or starts the ingest processes in process mode.
+        # Must be called before attach_to_loop and before other threads are started
+        logger.info("Listening to CAN channels: {}".format(list(self.channels)))
+        for name in self.listeners:
+            self.open_channel(name)
+
+    def open_channel(self, name):
+        ingest_config = self.config.get(INGEST_STR) or {}
+        bus_kwargs = self.bus_kwargs(name)
+        if ingest_config.get(MODE_STR) == MODE_PROCESS:
+            self.ingests[name] = IngestProcess.from_config(ingest_config, bus_kwargs)
+            self.ingests[name].start()
+        else:
+            self.listeners[name].set_bus(can.interface.Bus(**bus_kwargs))
+
+    def attach_to_loop(self, loop):
+        # All channels are served by `loop`: python-can registers the bus sockets
+        # with the loop so that a single thread multiplexes them
+        self.loop = loop
+        for name in self.listeners:
+            self.attach_channel(name)
+
+    def attach_channel(self, name):
+        listener = self.listeners[name]
+        if name in self.recorders:
+            self.recorders[name].attach_to_loop(self.loop)
+        if name in self.ingests:
+            ingest = self.ingests[name]
+            listener.attach_ring(ingest.ring, self.loop, ingest.channel, ingest)
+        else:
+            notifier = listener.attach_to_loop(self.loop)
+            if notifier is not None:
+                self.notifiers[name] = notifier
+
+    def close_channel(self, name):
+        listener = self.listeners.pop(name)
+        # Stops the notifier of the channel
+        listener.detach()
+        self.notifiers.pop(name, None)
+        ingest = self.ingests.pop(name, None)
+        if ingest is not None:
+            ingest.stop()
+        if listener.bus is not None:
+            listener.bus.shutdown()
+        recorder = self.recorders.pop(name, None)
+        if recorder is not None:
+            recorder.stop()
+            logger.info("Recorded {} frames of {}".format(recorder.recorded_count, name))
+
+    def reload(self, config):
+        '''
+        Applies a changed config. Must be called from the thread running the
+        loop the channels are attached to (e.g. by a config.ConfigWatcher
+        attached to it). Returns False if nothing changed
+        '''
+        config = config if config is not None else {}
+        if config == self.config:
+            return False
+        old_channels = self.channels
+        self.config = config
+        self.channels = self.config.get(CHANNELS_STR) or DEFAULT_CHANNELS
+
+        def bus_settings(channel_config):
+            return {key: value for key, value in channel_config.items()
+                    if key != CAN_FILTERS_STR}
+        for name in list(self.listeners):
+            if name not in self.channels or \
+                    bus_settings(self.channels[name]) != bus_settings(old_channels[name]):
+                logger.info("Closing CAN channel {}".format(name))
+                self.close_channel(name)
+        for name in self.channels:
+            listener = self.listeners.get(name)
+            if listener is not None:
+                listener.shared_key_prefix = self.shared_key_prefix(name)
+                listener.reload(self.channel_config(name), self.channels[name].get(CAN_FILTERS_STR))
+                if name in self.ingests:
+                    logger.warning("Kernel filters of channel {} are applied when its "
+                                    "ingest process restarts".format(name))
+                continue
+            logger.info("Opening CAN channel {}".format(name))
+            listener = self.listeners[name] = self.create_listener(name)
+            for setup in self.setups:
+                setup(name, listener)
+            try:
+                self.open_channel(name)
+            except OSError as exc:
+                logger.error("Error while opening CAN channel {}.\nDetails: {}".format(name, exc))
+                self.close_channel(name)
+                continue
+            if self.loop is not None:
+                self.attach_channel(name)
+        return True
+
+    def failed_channels(self):
+        # Channels whose ingest process exited, e.g. because the bus failed to open
+        return [name for name, ingest in self.ingests.items() if not ingest.is_alive()]
+
+    def healthy(self) -> bool:
+        # False once an ingest process exited or a bus is in the error state
+        return all(ingest.is_alive() for ingest in self.ingests.values()) and \
+            all(listener.bus_healthy() for listener in self.listeners.values())
+
+    def filter_stats(self):
+        return {name: listener.filter_stats.as_dict()
+                for name, listener in self.listeners.items()}
+
+    def snapshot_dict(self):
+        return {name: listener.can_data.snapshot_dict()
+                for name, listener in self.listeners.items()}
+
+    def shut_down(self):
+        for notifier in self.notifiers.values():
+            notifier.stop()
+        self.notifiers = {}
+        for ingest in self.ingests.values():
+            ingest.stop()
+        self.ingests = {}
+        for listener in self.listeners.values():
+            if listener.bus is not None:
+                listener.bus.shutdown()
+        for name, recorder in self.recorders.items():
+            recorder.stop()
+            logger.info("Recorded {} frames of {}".format(recorder.recorded_count, name))
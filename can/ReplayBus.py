@@ -0,0 +1,140 @@
+'''
+A python-can bus replaying recorded traces, so that CANListener can be
+exercised without a live CAN interface.
+
+Supported traces are our own binary format (.pctrace, see TraceRecorder) and
+anything can.LogReader understands (candump .log, .asc, .blf, .csv, .trc).
+Frames are emitted at their recorded pace divided by `speed`; a speed of 0
+replays as fast as possible.
+'''
+
+import os
+import math
+import time
+import itertools
+import can
+
+from TraceRecorder import TraceFile, FILE_EXTENSION, list_trace_files
+
+# Lateness histogram buckets: [0, 1us), [1us, 2us), ... doubling up to ~17 min
+LATENESS_BUCKETS = 31
+LATENESS_UNIT = 1e-6  # seconds
+
+
+def read_trace(path):
+    # Yields the can.Message objects of a trace file or of a directory of .pctrace files
+    if os.path.isdir(path):
+        for trace_path in list_trace_files(path):
+            yield from TraceFile(trace_path).messages()
+    elif path.endswith(FILE_EXTENSION):
+        yield from TraceFile(path).messages()
+    else:
+        yield from can.LogReader(path)
+
+
+class ReplayBus(can.BusABC):
+    def __init__(self, channel=None, paths=(), speed=1.0, rewrite_timestamps=True,
+                 loop=False, can_filters=None, **kwargs):
+        super().__init__(channel=channel, can_filters=can_filters, **kwargs)
+        self.channel_info = "Replay of {}".format(", ".join(paths))
+        self.channel = channel
+        self.paths = list(paths)
+        self.speed = speed
+        self.rewrite_timestamps = rewrite_timestamps
+        self.loop = loop
+        self.messages = self.open_traces()
+        self.pending = None
+        self.first_timestamp = None
+        self.start_time = None
+        self.replay_start_time = None
+        self.last_replay_time = None
+        self.finished = False
+        # Timing fidelity stats
+        self.replayed_count = 0
+        self.lateness_sum = 0.0
+        self.lateness_max = 0.0
+        self.lateness_histogram = [0] * LATENESS_BUCKETS
+
+    def open_traces(self):
+        return itertools.chain.from_iterable(read_trace(path) for path in self.paths)
+
+    def scheduled_time(self, msg):
+        if self.first_timestamp is None:
+            self.first_timestamp = msg.timestamp
+            self.start_time = time.perf_counter()
+            if self.replay_start_time is None:
+                self.replay_start_time = self.start_time
+        if not self.speed:
+            return self.start_time
+        return self.start_time + (msg.timestamp - self.first_timestamp) / self.speed
+
+    def _recv_internal(self, timeout):
+        if self.pending is None:
+            self.pending = next(self.messages, None)
+            if self.pending is None and self.loop:
+                # Start over, timed from now
+                self.messages = self.open_traces()
+                self.first_timestamp = None
+                self.pending = next(self.messages, None)
+            if self.pending is None:
+                self.finished = True
+                if timeout:
+                    time.sleep(timeout)
+                return None, False
+        scheduled = self.scheduled_time(self.pending)
+        delay = scheduled - time.perf_counter()
+        if delay > 0:
+            if timeout is not None and delay > timeout:
+                time.sleep(timeout)
+                return None, False
+            time.sleep(delay)
+        msg = self.pending
+        self.pending = None
+        self.last_replay_time = time.perf_counter()
+        self.record_lateness(self.last_replay_time - scheduled)
+        if self.rewrite_timestamps:
+            msg.timestamp = time.time()
+        return msg, False
+
+    def record_lateness(self, lateness):
+        self.replayed_count += 1
+        if not self.speed:
+            return
+        lateness = max(lateness, 0.0)
+        self.lateness_sum += lateness
+        self.lateness_max = max(self.lateness_max, lateness)
+        bucket = 0 if lateness < LATENESS_UNIT else \
+            min(LATENESS_BUCKETS - 1, int(math.log2(lateness / LATENESS_UNIT)) + 1)
+        self.lateness_histogram[bucket] += 1
+
+    def lateness_quantile(self, quantile):
+        # Upper bound of the histogram bucket holding the quantile
+        target = quantile * sum(self.lateness_histogram)
+        cumulative = 0
+        for bucket, count in enumerate(self.lateness_histogram):
+            cumulative += count
+            if count > 0 and cumulative >= target:
+                return LATENESS_UNIT * (2 ** bucket)
+        return 0.0
+
+    def timing_stats(self):
+        elapsed = 0.0
+        if self.replay_start_time is not None and self.last_replay_time is not None:
+            elapsed = self.last_replay_time - self.replay_start_time
+        stats = {"frames": self.replayed_count,
+                 "elapsed": elapsed,
+                 "frames_per_second": self.replayed_count / elapsed if elapsed > 0 else 0.0}
+        if self.speed and self.replayed_count > 0:
+            stats.update({"mean_lateness": self.lateness_sum / self.replayed_count,
+                          "p50_lateness": self.lateness_quantile(0.5),
+                          "p99_lateness": self.lateness_quantile(0.99),
+                          "max_lateness": self.lateness_max})
+        return stats
+
+    def send(self, msg, timeout=None):
+        # Frames sent by the application are not part of the replay
+        pass
+
+    def shutdown(self):
+        super().shutdown()
+        self.finished = True
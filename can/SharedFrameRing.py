@@ -0,0 +1,208 @@
+'''
+Single producer, single consumer ring of CAN frames in shared memory, so that
+CAN reception runs in its own process (IngestProcess) and never waits for
+the decoding and publishing process, nor for its GIL.
+
+The columns share the layout of the trace files (see TraceRecorder) after a
+64-byte header of uint64 counters:
+    write_index   frames pushed so far (written by the producer only)
+    read_index    frames consumed so far (written by the consumer only)
+    capacity      power of two
+    dropped       frames dropped because the ring was full (producer)
+Slot i of the columns holds frame number i & (capacity - 1).
+'''
+
+import signal
+import logging
+import threading
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+import can
+
+from TraceRecorder import column_views, HEADER_SIZE, ROW_SIZE, MAX_DLC, \
+    FLAG_EXTENDED, FLAG_REMOTE, FLAG_ERROR
+
+logger = logging.getLogger(__name__)
+
+# Config keywords
+INGEST_STR = 'INGEST'
+MODE_STR = 'mode'
+MODE_THREAD = 'thread'
+MODE_PROCESS = 'process'
+RING_CAPACITY_STR = 'ring_capacity'
+POLL_INTERVAL_STR = 'poll_interval'
+
+DEFAULT_RING_CAPACITY = 65536  # frames
+DEFAULT_POLL_INTERVAL = 0.005  # seconds
+RECV_TIMEOUT = 0.5  # seconds, how often the ingest process checks for stop
+
+WRITE_INDEX = 0
+READ_INDEX = 1
+CAPACITY = 2
+DROPPED = 3
+
+BARRIER_LOCK = threading.Lock()
+# Ingest processes are spawned, not forked: a forked child would inherit the
+# locks and queues of the parent's threads (e.g. the logging queue of the
+# service) in whatever state they were
+INGEST_CONTEXT = multiprocessing.get_context("spawn")
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+
+def memory_barrier():
+    # CPython has no fence primitive, but taking a lock runs the atomic
+    # instructions (and barriers) of the pthread mutex. This keeps the slot
+    # and index accesses in order on weakly ordered CPUs such as the Pi's ARM
+    with BARRIER_LOCK:
+        pass
+
+
+class SharedFrameRing:
+    def __init__(self, capacity=DEFAULT_RING_CAPACITY, name=None):
+        # Creates a ring, or attaches to the ring `name` if given
+        if name is None:
+            capacity = 1 << max(0, int(capacity) - 1).bit_length()
+            self.shm = shared_memory.SharedMemory(
+                create=True, size=HEADER_SIZE + ROW_SIZE * capacity)
+            self.owner = True
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            self.owner = False
+        self.header = np.ndarray((HEADER_SIZE // 8,), dtype='<u8', buffer=self.shm.buf)
+        if self.owner:
+            self.header[:] = 0
+            self.header[CAPACITY] = capacity
+        self.capacity = int(self.header[CAPACITY])
+        self.mask = self.capacity - 1
+        self.timestamps, self.ids, self.dlcs, self.flags, self.data = column_views(
+            self.shm.buf, self.capacity)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    @property
+    def dropped(self):
+        return int(self.header[DROPPED])
+
+    def __len__(self):
+        return int(self.header[WRITE_INDEX]) - int(self.header[READ_INDEX])
+
+    def push(self, msg):
+        # Producer side. Returns False if the frame was dropped
+        write_index = int(self.header[WRITE_INDEX])
+        if write_index - int(self.header[READ_INDEX]) >= self.capacity:
+            self.header[DROPPED] += 1
+            return False
+        index = write_index & self.mask
+        payload = msg.data
+        length = len(payload)
+        self.timestamps[index] = msg.timestamp
+        self.ids[index] = msg.arbitration_id
+        self.dlcs[index] = length
+        self.flags[index] = (FLAG_EXTENDED if msg.is_extended_id else 0) | \
+            (FLAG_REMOTE if msg.is_remote_frame else 0) | \
+            (FLAG_ERROR if msg.is_error_frame else 0)
+        row = self.data[index]
+        row[:length] = payload
+        if length < MAX_DLC:
+            row[length:] = 0
+        # Publish the slot only once it is complete
+        memory_barrier()
+        self.header[WRITE_INDEX] = write_index + 1
+        return True
+
+    def read(self, max_frames):
+        '''
+        Consumer side. Copies up to `max_frames` pending frames out of the ring
+        and releases their slots. Returns (ids, data, dlcs, timestamps, flags)
+        '''
+        read_index = int(self.header[READ_INDEX])
+        count = min(int(self.header[WRITE_INDEX]) - read_index, max_frames)
+        # The slots are read after the index that published them
+        memory_barrier()
+        start = read_index & self.mask
+        positions = (start + np.arange(count)) & self.mask if start + count > self.capacity \
+            else slice(start, start + count)
+        frames = (self.ids[positions].copy(), self.data[positions].copy(),
+                  self.dlcs[positions].copy(), self.timestamps[positions].copy(),
+                  self.flags[positions].copy())
+        # and released once they were copied
+        memory_barrier()
+        self.header[READ_INDEX] = read_index + count
+        return frames
+
+    def close(self):
+        # Release the NumPy views before closing the shared memory
+        self.header = self.timestamps = self.ids = self.dlcs = self.flags = self.data = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def receive_into_ring(ring_name, bus_kwargs, stop_event):
+    # Body of the ingest process: the bus is only opened here
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # The child has its own handler, to stderr like the unconfigured service
+    logging.basicConfig(format=LOG_FORMAT)
+    # A bus that fails to open ends the process, see CANListener.poll_ring
+    bus = can.interface.Bus(**bus_kwargs)
+    ring = SharedFrameRing(name=ring_name)
+    try:
+        while not stop_event.is_set():
+            msg = bus.recv(RECV_TIMEOUT)
+            if msg is not None:
+                ring.push(msg)
+    finally:
+        bus.shutdown()
+        ring.close()
+
+
+class IngestProcess:
+    '''
+    Receives CAN frames in a dedicated process and pushes them into a
+    SharedFrameRing consumed by CANListener.attach_ring. `bus_kwargs` are
+    passed to can.interface.Bus in the child process, which is spawned: the
+    script starting it needs an `if __name__ == "__main__":` guard.
+    '''
+
+    def __init__(self, bus_kwargs, ring_capacity=DEFAULT_RING_CAPACITY):
+        self.bus_kwargs = bus_kwargs
+        self.channel = bus_kwargs.get('channel')
+        self.ring = SharedFrameRing(ring_capacity)
+        self.stop_event = INGEST_CONTEXT.Event()
+        self.process = None
+
+    @staticmethod
+    def from_config(ingest_config, bus_kwargs):
+        return IngestProcess(bus_kwargs,
+                             ingest_config.get(RING_CAPACITY_STR, DEFAULT_RING_CAPACITY))
+
+    def start(self):
+        self.process = INGEST_CONTEXT.Process(
+            target=receive_into_ring, name="CANIngest",
+            args=(self.ring.name, self.bus_kwargs, self.stop_event), daemon=True)
+        self.process.start()
+        logger.info("CAN ingest process {} started on {}".format(
+            self.process.pid, self.channel))
+
+    def is_alive(self):
+        return self.process is not None and self.process.is_alive()
+
+    @property
+    def exitcode(self):
+        # None while running, non-zero if the bus could not be opened or failed
+        return self.process.exitcode if self.process is not None else None
+
+    def stop(self, timeout=2.0):
+        self.stop_event.set()
+        if self.process is not None:
+            self.process.join(timeout)
+            if self.process.is_alive():
+                logger.warning("CAN ingest process did not stop, terminating it")
+                self.process.terminate()
+                self.process.join()
+            self.process = None
+        logger.info("CAN ingest dropped {} frames (ring full)".format(self.ring.dropped))
+        self.ring.close()
@@ -0,0 +1,285 @@
+'''
+Vectorized decoding of CAN frame payloads into physical signal values.
+
+Every configured frame ID is compiled once into shift/mask/scale tables
+(one entry per signal) so that a batch of frames can be decoded with a
+handful of NumPy operations instead of per-frame bit twiddling.
+Messages reassembled from several frames (J1939 transport, ISO-TP; see
+Transport.py) are longer than 8 bytes and decoded one at a time instead.
+'''
+
+import logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+CAN_MESSAGES = 'CAN_MESSAGES'
+
+# Config keywords
+ID_STR = 'ID'
+PGN_STR = 'PGN'
+SIZE_STR = 'size'
+TRANSPORT_STR = 'transport'
+TRANSPORT_J1939 = 'j1939'
+TRANSPORT_ISOTP = 'isotp'
+SIGNALS_STR = 'signals'
+REL_BYTES_STR = 'rel_bytes'
+START_BIT_STR = 'start_bit'
+LENGTH_STR = 'length'
+BYTE_ORDER_STR = 'byte_order'
+SCALE_STR = 'scale'
+OFFSET_STR = 'offset'
+SIGNED_STR = 'signed'
+LITTLE_ENDIAN = 'little_endian'
+BIG_ENDIAN = 'big_endian'
+
+MAX_DLC = 8
+# Keys of PGN-based messages, kept apart from 29-bit CAN IDs
+PGN_KEY_FLAG = 0x80000000
+# Default payload sizes of transport messages
+J1939_MAX_SIZE = 1785
+ISOTP_MAX_SIZE = 4095
+
+
+def pgn_key(pgn):
+    return PGN_KEY_FLAG | pgn
+
+
+def message_key(msg_config):
+    # Messages are identified by their CAN ID or, for J1939, by their PGN
+    if PGN_STR in msg_config:
+        return pgn_key(msg_config[PGN_STR])
+    return msg_config[ID_STR]
+
+
+def transport_of(msg_config):
+    # Returns the transport protocol reassembling the message, None for single frames
+    transport = msg_config.get(TRANSPORT_STR)
+    if transport is None and PGN_STR in msg_config and msg_config.get(SIZE_STR, MAX_DLC) > MAX_DLC:
+        transport = TRANSPORT_J1939
+    return transport
+
+
+def message_size(msg_config):
+    transport = transport_of(msg_config)
+    default = MAX_DLC
+    if transport == TRANSPORT_J1939:
+        default = J1939_MAX_SIZE
+    elif transport == TRANSPORT_ISOTP:
+        default = ISOTP_MAX_SIZE
+    return msg_config.get(SIZE_STR, default)
+
+
+class SignalTable:
+    '''
+    Precompiled layout of all the signals of a single CAN frame ID
+    '''
+    __slots__ = ('msg_id', 'size', 'names', 'shifts', 'masks', 'big_endian',
+                 'signed', 'sign_bits', 'scales', 'offsets')
+
+    def __init__(self, msg_id, signals, size=MAX_DLC):
+        self.msg_id = msg_id
+        self.size = size
+        self.names = [signal[0] for signal in signals]
+        shifts, masks, big_endian, sign_bits = [], [], [], []
+        for _, start_bit, length, byte_order, _, _, _ in signals:
+            if length < 1 or length > 64:
+                raise ValueError("Invalid signal length {} for ID {}".format(
+                    length, msg_id))
+            if byte_order == BIG_ENDIAN:
+                # DBC (Motorola) start bit addresses the MSB of the signal.
+                # Translate it to the LSB position within a big endian u64.
+                msb = (size - 1 - start_bit // 8) * 8 + start_bit % 8
+                shift = msb - length + 1
+            else:
+                shift = start_bit
+            if shift < 0 or shift + length > size * 8:
+                raise ValueError("Signal {} of ID {} does not fit into {} bytes".format(
+                    start_bit, msg_id, size))
+            shifts.append(shift)
+            masks.append((1 << length) - 1)
+            big_endian.append(byte_order == BIG_ENDIAN)
+            sign_bits.append(1 << (length - 1))
+        self.shifts = np.array(shifts, dtype=np.uint64)
+        self.masks = np.array(masks, dtype=np.uint64)
+        self.big_endian = np.array(big_endian, dtype=bool)
+        self.signed = np.array([signal[6] for signal in signals], dtype=bool)
+        self.sign_bits = np.array(sign_bits, dtype=np.uint64)
+        self.scales = np.array([signal[4] for signal in signals], dtype=np.float64)
+        self.offsets = np.array([signal[5] for signal in signals], dtype=np.float64)
+
+    def decode(self, data):
+        '''
+        Decodes an (n, 8) uint8 payload matrix into an (n, n_signals)
+        float64 matrix of physical values
+        '''
+        raw_le = data.view('<u8')
+        if self.big_endian.any():
+            raw_be = data.view('>u8').astype(np.uint64)
+            raw = np.where(self.big_endian, raw_be, raw_le)
+        else:
+            raw = np.broadcast_to(raw_le, (data.shape[0], len(self.names)))
+        values = (raw >> self.shifts) & self.masks
+        physical = values.astype(np.float64)
+        if self.signed.any():
+            negative = self.signed & (values >= self.sign_bits)
+            physical -= np.where(negative, self.sign_bits.astype(np.float64) * 2, 0.0)
+        return physical * self.scales + self.offsets
+
+    def decode_payload(self, payload):
+        '''
+        Decodes a single payload of up to `size` bytes into an (n_signals,)
+        array, for the messages too long for the vectorized decode
+        '''
+        padded = bytes(payload[:self.size]).ljust(self.size, b'\0')
+        raw_le = int.from_bytes(padded, 'little')
+        raw_be = int.from_bytes(padded, 'big')
+        values = np.empty(len(self.names), dtype=np.float64)
+        for index in range(len(self.names)):
+            raw = raw_be if self.big_endian[index] else raw_le
+            value = (raw >> int(self.shifts[index])) & int(self.masks[index])
+            if self.signed[index] and value >= int(self.sign_bits[index]):
+                value -= 2 * int(self.sign_bits[index])
+            values[index] = value
+        return values * self.scales + self.offsets
+
+
+class SignalDecoder:
+    def __init__(self, config={}):
+        self.tables = {}
+        self.transport_tables = {}
+        self.compile(config)
+
+    def compile(self, config):
+        # Builds a SignalTable per CAN message ID (or PGN) listed in the config.
+        # Transport messages are kept apart as they are not decoded in batches
+        self.tables = {}
+        self.transport_tables = {}
+        if config is None or CAN_MESSAGES not in config:
+            logger.warning("config does not include {0}".format(CAN_MESSAGES))
+            return
+        for can_msg, msg_config in config[CAN_MESSAGES].items():
+            signals = SignalDecoder.parse_signals(can_msg, msg_config)
+            msg_id = message_key(msg_config)
+            if transport_of(msg_config) is not None:
+                # Signal-less transport messages (e.g. DM1, VIN) keep their raw payload
+                self.transport_tables[msg_id] = SignalTable(
+                    msg_id, signals, message_size(msg_config))
+                continue
+            if len(signals) == 0:
+                logger.warning("No decodable signal for {}".format(can_msg))
+                continue
+            self.tables[msg_id] = SignalTable(msg_id, signals)
+        logger.info("Compiled signal tables for IDs: {}".format(
+            list(self.tables.keys())))
+        if len(self.transport_tables) > 0:
+            logger.info("Compiled transport signal tables for IDs: {}".format(
+                list(self.transport_tables.keys())))
+
+    @staticmethod
+    def parse_signals(can_msg, msg_config):
+        # Returns (name, start_bit, length, byte_order, scale, offset, signed) tuples.
+        # Messages that only define `rel_bytes` are decoded as a single unsigned
+        # little endian signal spanning the first to the last relevant byte.
+        signals = []
+        if SIGNALS_STR in msg_config:
+            for name, signal in msg_config[SIGNALS_STR].items():
+                signals.append((name,
+                                signal[START_BIT_STR],
+                                signal[LENGTH_STR],
+                                signal.get(BYTE_ORDER_STR, LITTLE_ENDIAN),
+                                signal.get(SCALE_STR, 1.0),
+                                signal.get(OFFSET_STR, 0.0),
+                                signal.get(SIGNED_STR, False)))
+        elif REL_BYTES_STR in msg_config and len(msg_config[REL_BYTES_STR]) > 0:
+            rel_bytes = msg_config[REL_BYTES_STR]
+            first, last = min(rel_bytes), max(rel_bytes)
+            signals.append((can_msg, first * 8, (last - first + 1) * 8,
+                            LITTLE_ENDIAN, 1.0, 0.0, False))
+        return signals
+
+    def __contains__(self, msg_id):
+        # True for the messages decoded in batches
+        return msg_id in self.tables
+
+    def is_transport(self, msg_id):
+        return msg_id in self.transport_tables
+
+    def signal_names(self, msg_id):
+        if msg_id in self.transport_tables:
+            return self.transport_tables[msg_id].names
+        return self.tables[msg_id].names
+
+    def decode(self, ids, data):
+        '''
+        Decodes a batch of frames. `ids` is an (n,) integer array and `data` an
+        (n, 8) uint8 array of zero padded payloads. Returns a dict of
+        msg_id -> (row indices, (k, n_signals) physical values). Unknown IDs
+        are skipped.
+        '''
+        decoded = {}
+        if len(ids) == 0:
+            return decoded
+        order = np.argsort(ids, kind='stable')
+        unique_ids, starts = np.unique(ids[order], return_index=True)
+        ends = np.append(starts[1:], len(order))
+        for msg_id, start, end in zip(unique_ids.tolist(), starts, ends):
+            table = self.tables.get(msg_id)
+            if table is None:
+                continue
+            rows = order[start:end]
+            decoded[msg_id] = (rows, table.decode(data[rows]))
+        return decoded
+
+    def decode_payload(self, msg_id, payload):
+        # Decodes a reassembled transport message into an (n_signals,) array
+        return self.transport_tables[msg_id].decode_payload(payload)
+
+    def decode_frame(self, msg_id, payload):
+        # Convenience (non-vectorized) path for a single frame
+        table = self.tables.get(msg_id)
+        if table is None:
+            return None
+        data = np.zeros((1, MAX_DLC), dtype=np.uint8)
+        data[0, :len(payload)] = bytearray(payload)
+        return dict(zip(table.names, table.decode(data)[0].tolist()))
+
+
+class FrameBatch:
+    '''
+    Preallocated buffer accumulating received frames until they are decoded
+    '''
+
+    def __init__(self, capacity=64):
+        self.capacity = capacity
+        self.ids = np.zeros(capacity, dtype=np.uint32)
+        self.data = np.zeros((capacity, MAX_DLC), dtype=np.uint8)
+        self.dlcs = np.zeros(capacity, dtype=np.uint8)
+        self.timestamps = np.zeros(capacity, dtype=np.float64)
+        self.count = 0
+
+    def append(self, msg_id, payload, timestamp):
+        # Returns True once the batch is full and should be decoded
+        index = self.count
+        self.ids[index] = msg_id
+        row = self.data[index]
+        length = len(payload)
+        row[:length] = payload
+        if length < MAX_DLC:
+            row[length:] = 0
+        self.dlcs[index] = length
+        self.timestamps[index] = timestamp
+        self.count = index + 1
+        return self.count >= self.capacity
+
+    def first_timestamp(self):
+        return self.timestamps[0] if self.count > 0 else None
+
+    def view(self):
+        return self.ids[:self.count], self.data[:self.count], self.timestamps[:self.count]
+
+    def reset(self):
+        self.count = 0
+
+    def __len__(self):
+        return self.count
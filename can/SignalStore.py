@@ -0,0 +1,166 @@
+'''
+Array-backed store holding the latest value of every configured CAN signal.
+
+Columns are preallocated once and indexed by a dense slot per configured
+message ID (timestamps, update counts, raw payloads) and per signal (values),
+so updating the store does not allocate. A single writer (the CAN listener)
+publishes updates under a sequence counter (seqlock) and any number of
+readers (MQTT/OBD threads) take consistent snapshots without locking.
+'''
+
+import time
+from collections import namedtuple
+import numpy as np
+
+MAX_DLC = 8
+
+Snapshot = namedtuple(
+    'Snapshot', ['sequence', 'values', 'timestamps', 'counts'])
+
+
+class MessageView:
+    '''
+    Read-only view over the store slot of one CAN message ID
+    '''
+    __slots__ = ('store', 'slot', 'id', 'description')
+
+    def __init__(self, store, slot, msg_id, description):
+        self.store = store
+        self.slot = slot
+        self.id = msg_id
+        self.description = description
+
+    @property
+    def data(self):
+        # Decoded signal values as {signal name: value}
+        start, end = self.store.signal_ranges[self.slot]
+        return dict(zip(self.store.signal_names[start:end],
+                        self.store.values[start:end].tolist()))
+
+    @property
+    def payload(self):
+        return bytes(self.store.payloads[self.slot, :self.store.dlcs[self.slot]])
+
+    @property
+    def last_update(self):
+        # time.monotonic() of the last update, 0.0 if never updated
+        return float(self.store.timestamps[self.slot])
+
+    @property
+    def update_count(self):
+        return int(self.store.counts[self.slot])
+
+
+class SignalStore:
+    def __init__(self, config_messages, signal_names={}, max_payload=MAX_DLC):
+        # `config_messages` maps message ID to description and `signal_names`
+        # maps message ID to the ordered signal names of that message.
+        # `max_payload` exceeds 8 bytes if transport messages are configured
+        self.sequence = 0
+        self.slots = {}
+        self.signal_ranges = []
+        self.signal_names = []
+        self.views = {}
+        for slot, msg_id in enumerate(config_messages):
+            self.slots[msg_id] = slot
+            names = list(signal_names.get(msg_id, []))
+            start = len(self.signal_names)
+            self.signal_names.extend(names)
+            self.signal_ranges.append((start, start + len(names)))
+            self.views[msg_id] = MessageView(
+                self, slot, msg_id, config_messages[msg_id])
+        n_messages = len(self.slots)
+        self.values = np.full(len(self.signal_names), np.nan, dtype=np.float64)
+        self.timestamps = np.zeros(n_messages, dtype=np.float64)
+        self.counts = np.zeros(n_messages, dtype=np.uint64)
+        self.payloads = np.zeros((n_messages, max_payload), dtype=np.uint8)
+        self.dlcs = np.zeros(n_messages, dtype=np.uint16)
+
+    def __contains__(self, msg_id):
+        return msg_id in self.slots
+
+    def __getitem__(self, msg_id):
+        return self.views[msg_id]
+
+    def __iter__(self):
+        return iter(self.views)
+
+    def __len__(self):
+        return len(self.views)
+
+    def latest(self, msg_id):
+        # Writer side view of the stored values of a message
+        start, end = self.signal_ranges[self.slots[msg_id]]
+        return self.values[start:end]
+
+    def carry_over(self, other, msg_ids):
+        # Copies the slots of `msg_ids` from the store of a previous config whose
+        # layout of these messages is unchanged. Call before the store is shared
+        for msg_id in msg_ids:
+            if msg_id not in self.slots or msg_id not in other.slots:
+                continue
+            slot, other_slot = self.slots[msg_id], other.slots[msg_id]
+            start, end = self.signal_ranges[slot]
+            other_start, other_end = other.signal_ranges[other_slot]
+            if end - start != other_end - other_start:
+                continue
+            self.values[start:end] = other.values[other_start:other_end]
+            self.timestamps[slot] = other.timestamps[other_slot]
+            self.counts[slot] = other.counts[other_slot]
+            length = min(int(other.dlcs[other_slot]), self.payloads.shape[1])
+            self.payloads[slot, :length] = other.payloads[other_slot, :length]
+            self.dlcs[slot] = length
+
+    # Writer side. Must only be called from a single thread.
+    def begin_write(self):
+        self.sequence += 1
+
+    def end_write(self):
+        self.sequence += 1
+
+    def write(self, msg_id, values=None, payload=None, timestamp=None):
+        # Stores the latest decoded values (and raw payload) of a message.
+        # Call between begin_write() and end_write()
+        slot = self.slots[msg_id]
+        if values is not None:
+            start, end = self.signal_ranges[slot]
+            self.values[start:end] = values
+        if payload is not None:
+            length = min(len(payload), self.payloads.shape[1])
+            self.payloads[slot, :length] = payload[:length]
+            self.dlcs[slot] = length
+        self.timestamps[slot] = time.monotonic() if timestamp is None else timestamp
+        self.counts[slot] += 1
+
+    def update(self, msg_id, values=None, payload=None, timestamp=None):
+        self.begin_write()
+        try:
+            self.write(msg_id, values, payload, timestamp)
+        finally:
+            self.end_write()
+
+    # Reader side. Safe to call from any thread.
+    def snapshot(self):
+        while True:
+            sequence = self.sequence
+            if sequence & 1:
+                # A write is in progress, let the writer finish
+                time.sleep(0)
+                continue
+            values = self.values.copy()
+            timestamps = self.timestamps.copy()
+            counts = self.counts.copy()
+            if self.sequence == sequence:
+                return Snapshot(sequence, values, timestamps, counts)
+
+    def snapshot_dict(self):
+        # {description: {signal name: value}} of the messages updated at least once
+        snapshot = self.snapshot()
+        result = {}
+        for msg_id, view in self.views.items():
+            if snapshot.counts[view.slot] == 0:
+                continue
+            start, end = self.signal_ranges[view.slot]
+            result[view.description] = dict(
+                zip(self.signal_names[start:end], snapshot.values[start:end].tolist()))
+        return result
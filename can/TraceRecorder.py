@@ -0,0 +1,201 @@
+'''
+Binary, columnar CAN trace files written through mmap.
+
+Each file is preallocated for `capacity` frames:
+    header   64 bytes: magic, version, capacity, frame count, creation time
+    columns  timestamps float64[capacity], ids uint32[capacity],
+             dlcs uint8[capacity], flags uint8[capacity],
+             data uint8[capacity, 8]
+Only the first `count` rows of each column are valid. TraceFile maps the
+columns as read-only NumPy arrays without copying them.
+'''
+
+import os
+import mmap
+import glob
+import time
+import struct
+import logging
+import numpy as np
+import can
+
+logger = logging.getLogger(__name__)
+
+# Config keywords
+RECORDER_STR = 'RECORDER'
+DIRECTORY_STR = 'directory'
+FRAMES_PER_FILE_STR = 'frames_per_file'
+MAX_FILE_AGE_STR = 'max_file_age'
+
+DEFAULT_FRAMES_PER_FILE = 1000000
+DEFAULT_MAX_FILE_AGE = 3600  # seconds
+
+MAGIC = b'PCTR'
+VERSION = 1
+FILE_EXTENSION = '.pctrace'
+# magic, version, capacity, count, creation time
+HEADER_STRUCT = struct.Struct('<4sHxxQQd')
+HEADER_SIZE = 64
+COUNT_OFFSET = 16
+MAX_DLC = 8
+# Bytes per frame over all the columns
+ROW_SIZE = 8 + 4 + 1 + 1 + MAX_DLC
+AGE_CHECK_EVERY = 1024  # frames
+# Period of the age check of an attached recorder, for buses too quiet to reach AGE_CHECK_EVERY
+AGE_CHECK_INTERVAL = 10.0  # seconds
+
+FLAG_EXTENDED = 0x01
+FLAG_REMOTE = 0x02
+FLAG_ERROR = 0x04
+
+
+def column_views(buffer, capacity):
+    # Returns (timestamps, ids, dlcs, flags, data) arrays over a trace buffer
+    offset = HEADER_SIZE
+    timestamps = np.frombuffer(buffer, dtype='<f8', count=capacity, offset=offset)
+    offset += 8 * capacity
+    ids = np.frombuffer(buffer, dtype='<u4', count=capacity, offset=offset)
+    offset += 4 * capacity
+    dlcs = np.frombuffer(buffer, dtype=np.uint8, count=capacity, offset=offset)
+    offset += capacity
+    flags = np.frombuffer(buffer, dtype=np.uint8, count=capacity, offset=offset)
+    offset += capacity
+    data = np.frombuffer(buffer, dtype=np.uint8, count=capacity * MAX_DLC,
+                         offset=offset).reshape(capacity, MAX_DLC)
+    return timestamps, ids, dlcs, flags, data
+
+
+class TraceRecorder:
+    def __init__(self, directory, frames_per_file=DEFAULT_FRAMES_PER_FILE,
+                 max_file_age=DEFAULT_MAX_FILE_AGE):
+        self.directory = directory
+        self.capacity = frames_per_file
+        self.max_file_age = max_file_age
+        self.buffer = None
+        self.file = None
+        self.path = None
+        self.file_index = 0
+        self.recorded_count = 0
+        self.age_check = None  # Timer handle of attach_to_loop
+        os.makedirs(directory, exist_ok=True)
+        self.open_file()
+
+    @staticmethod
+    def from_config(recorder_config):
+        return TraceRecorder(recorder_config[DIRECTORY_STR],
+                             recorder_config.get(FRAMES_PER_FILE_STR, DEFAULT_FRAMES_PER_FILE),
+                             recorder_config.get(MAX_FILE_AGE_STR, DEFAULT_MAX_FILE_AGE))
+
+    def open_file(self):
+        created = time.time()
+        self.path = os.path.join(self.directory, "trace_{}_{:04d}{}".format(
+            time.strftime("%Y%m%d_%H%M%S", time.localtime(created)), self.file_index, FILE_EXTENSION))
+        self.file_index += 1
+        size = HEADER_SIZE + ROW_SIZE * self.capacity
+        self.file = open(self.path, 'w+b')
+        self.file.truncate(size)
+        self.buffer = mmap.mmap(self.file.fileno(), size)
+        HEADER_STRUCT.pack_into(self.buffer, 0, MAGIC, VERSION, self.capacity, 0, created)
+        self.timestamps, self.ids, self.dlcs, self.flags, self.data = column_views(
+            self.buffer, self.capacity)
+        self.count = 0
+        self.opened_at = time.monotonic()
+        logger.info("Recording CAN frames to {}".format(self.path))
+
+    def close_file(self):
+        if self.buffer is None:
+            return
+        struct.pack_into('<Q', self.buffer, COUNT_OFFSET, self.count)
+        # Release the NumPy views before closing the map
+        self.timestamps = self.ids = self.dlcs = self.flags = self.data = None
+        self.buffer.flush()
+        self.buffer.close()
+        self.file.close()
+        self.buffer = None
+
+    def rotate(self):
+        self.close_file()
+        self.open_file()
+
+    def rotate_if_old(self):
+        if self.count > 0 and time.monotonic() - self.opened_at >= self.max_file_age:
+            self.rotate()
+
+    def attach_to_loop(self, loop):
+        # Checks the file age from `loop`, the loop calling append()
+        self.age_check = loop.call_later(AGE_CHECK_INTERVAL, self.check_age, loop)
+
+    def check_age(self, loop):
+        if self.buffer is None:
+            return
+        self.rotate_if_old()
+        self.age_check = loop.call_later(AGE_CHECK_INTERVAL, self.check_age, loop)
+
+    def append(self, msg):
+        # Can be registered as a can.Notifier listener
+        if self.count >= self.capacity:
+            self.rotate()
+        elif self.count % AGE_CHECK_EVERY == 0:
+            self.rotate_if_old()
+        index = self.count
+        payload = msg.data
+        length = len(payload)
+        self.timestamps[index] = msg.timestamp
+        self.ids[index] = msg.arbitration_id
+        self.dlcs[index] = length
+        self.flags[index] = (FLAG_EXTENDED if msg.is_extended_id else 0) | \
+            (FLAG_REMOTE if msg.is_remote_frame else 0) | \
+            (FLAG_ERROR if msg.is_error_frame else 0)
+        self.data[index, :length] = payload
+        self.count = index + 1
+        struct.pack_into('<Q', self.buffer, COUNT_OFFSET, self.count)
+        self.recorded_count += 1
+
+    __call__ = append
+
+    def stop(self):
+        if self.age_check is not None:
+            self.age_check.cancel()
+            self.age_check = None
+        self.close_file()
+
+
+class TraceFile:
+    '''
+    Read-only, zero-copy access to a recorded trace file
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as stream:
+            self.buffer = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, capacity, count, self.created = HEADER_STRUCT.unpack_from(
+            self.buffer, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("{} is not a CAN trace file".format(path))
+        timestamps, ids, dlcs, flags, data = column_views(self.buffer, capacity)
+        self.count = count
+        self.timestamps = timestamps[:count]
+        self.ids = ids[:count]
+        self.dlcs = dlcs[:count]
+        self.flags = flags[:count]
+        self.data = data[:count]
+
+    def __len__(self):
+        return self.count
+
+    def messages(self):
+        # Yields the recorded frames as can.Message objects
+        for index in range(self.count):
+            flags = int(self.flags[index])
+            yield can.Message(timestamp=float(self.timestamps[index]),
+                              arbitration_id=int(self.ids[index]),
+                              is_extended_id=bool(flags & FLAG_EXTENDED),
+                              is_remote_frame=bool(flags & FLAG_REMOTE),
+                              is_error_frame=bool(flags & FLAG_ERROR),
+                              dlc=int(self.dlcs[index]),
+                              data=bytes(self.data[index, :self.dlcs[index]]))
+
+
+def list_trace_files(directory):
+    return sorted(glob.glob(os.path.join(directory, "*" + FILE_EXTENSION)))
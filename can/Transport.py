@@ -0,0 +1,244 @@
+'''
+Reassembly of multi-frame CAN transport protocols:
+    J1939-21 transport (TP.CM/TP.DT), broadcast (BAM) and connection mode (RTS/CTS)
+    ISO 15765-2 (ISO-TP) single, first and consecutive frames
+Sessions are kept in an LRU table bounded by `max_sessions` and dropped
+once no fragment arrived for `timeout` seconds (frame timestamps). Completed
+messages are passed to `on_message(key, payload, timestamp)`, keyed like the
+CAN_MESSAGES entries they belong to (see SignalDecoder.message_key).
+'''
+
+import logging
+from collections import OrderedDict
+
+from SignalDecoder import pgn_key
+
+logger = logging.getLogger(__name__)
+
+# Config keywords
+TRANSPORT_CONFIG_STR = 'TRANSPORT'
+TIMEOUT_STR = 'timeout'
+MAX_SESSIONS_STR = 'max_sessions'
+
+DEFAULT_TIMEOUT = 1.25  # seconds, J1939-21 T2
+DEFAULT_MAX_SESSIONS = 64
+
+# J1939-21
+TP_CM_PGN = 0xEC00
+TP_DT_PGN = 0xEB00
+TP_CM_RTS = 16
+TP_CM_CTS = 17
+TP_CM_EOM_ACK = 19
+TP_CM_BAM = 32
+TP_CM_ABORT = 255
+TP_DT_SIZE = 7
+J1939_MAX_SIZE = 1785
+GLOBAL_ADDRESS = 0xFF
+PDU1_MASK = 0x3FF0000
+PDU2_MASK = 0x3FFFF00
+
+# ISO 15765-2
+ISOTP_SINGLE_FRAME = 0
+ISOTP_FIRST_FRAME = 1
+ISOTP_CONSECUTIVE_FRAME = 2
+ISOTP_FLOW_CONTROL = 3
+ISOTP_MAX_SIZE = 4095
+
+
+def j1939_pgn(arbitration_id):
+    pdu_format = (arbitration_id >> 16) & 0xFF
+    pgn = (arbitration_id >> 8) & 0x3FFFF
+    if pdu_format < 240:
+        # PDU1: the PDU specific byte is a destination address
+        pgn &= 0x3FF00
+    return pgn
+
+
+def j1939_filters(pgns, transport=False):
+    # Kernel filters accepting the given PGNs from any source (and, in PDU1, to any
+    # destination), plus the transport protocol frames if `transport` is set
+    pgns = set(pgns)
+    if transport:
+        pgns.update((TP_CM_PGN, TP_DT_PGN))
+    can_filters = []
+    for pgn in sorted(pgns):
+        is_pdu1 = ((pgn >> 8) & 0xFF) < 240
+        can_filters.append({"can_id": pgn << 8,
+                            "can_mask": PDU1_MASK if is_pdu1 else PDU2_MASK,
+                            "extended": True})
+    return can_filters
+
+
+class Session:
+    __slots__ = ('key', 'size', 'packets', 'buffer', 'received', 'next_sequence',
+                 'last_timestamp')
+
+    def __init__(self, key, size, packets, timestamp):
+        self.key = key
+        self.size = size
+        self.packets = packets
+        self.buffer = bytearray(max(size, packets * TP_DT_SIZE))
+        # J1939: bit mask of the received packets, ISO-TP: received byte count
+        self.received = 0
+        self.next_sequence = 1
+        self.last_timestamp = timestamp
+
+
+class TransportReassembler:
+    def __init__(self, j1939_pgns=(), isotp_ids=(), on_message=None,
+                 timeout=DEFAULT_TIMEOUT, max_sessions=DEFAULT_MAX_SESSIONS):
+        self.j1939_keys = {pgn: pgn_key(pgn) for pgn in j1939_pgns}
+        self.isotp_ids = set(isotp_ids)
+        self.on_message = on_message
+        self.timeout = timeout
+        self.max_sessions = max_sessions
+        self.sessions = OrderedDict()  # (protocol, source, destination) -> Session
+        self.completed_count = 0
+        self.timed_out_count = 0
+        self.evicted_count = 0
+        self.error_count = 0
+
+    @staticmethod
+    def from_config(transport_config, j1939_pgns, isotp_ids, on_message):
+        transport_config = transport_config or {}
+        return TransportReassembler(j1939_pgns, isotp_ids, on_message,
+                                    transport_config.get(TIMEOUT_STR, DEFAULT_TIMEOUT),
+                                    transport_config.get(MAX_SESSIONS_STR, DEFAULT_MAX_SESSIONS))
+
+    def feed(self, arbitration_id, is_extended, data, timestamp):
+        # Returns True if the frame belongs to a tracked transport session
+        self.expire(timestamp)
+        if arbitration_id in self.isotp_ids:
+            self.feed_isotp(arbitration_id, data, timestamp)
+            return True
+        if not is_extended or len(self.j1939_keys) == 0:
+            return False
+        pgn = j1939_pgn(arbitration_id)
+        source = arbitration_id & 0xFF
+        destination = (arbitration_id >> 8) & 0xFF
+        if pgn == TP_CM_PGN:
+            return self.feed_tp_cm(source, destination, data, timestamp)
+        if pgn == TP_DT_PGN:
+            return self.feed_tp_dt(source, destination, data, timestamp)
+        return False
+
+    def open_session(self, session_key, session):
+        self.sessions.pop(session_key, None)
+        self.sessions[session_key] = session
+        if len(self.sessions) > self.max_sessions:
+            self.sessions.popitem(last=False)
+            self.evicted_count += 1
+
+    def expire(self, timestamp):
+        # Sessions are ordered by their last fragment
+        while len(self.sessions) > 0:
+            session = next(iter(self.sessions.values()))
+            if timestamp - session.last_timestamp < self.timeout:
+                return
+            self.sessions.popitem(last=False)
+            self.timed_out_count += 1
+
+    def touch(self, session_key, session, timestamp):
+        session.last_timestamp = timestamp
+        self.sessions.move_to_end(session_key)
+
+    def complete(self, session_key, session, timestamp):
+        del self.sessions[session_key]
+        self.completed_count += 1
+        if self.on_message is not None:
+            self.on_message(session.key, bytes(session.buffer[:session.size]), timestamp)
+
+    def feed_tp_cm(self, source, destination, data, timestamp):
+        if len(data) < 8:
+            self.error_count += 1
+            return True
+        control = data[0]
+        if control == TP_CM_RTS or control == TP_CM_BAM:
+            pgn = data[5] | (data[6] << 8) | (data[7] << 16)
+            key = self.j1939_keys.get(pgn)
+            if key is None:
+                return False
+            size = data[1] | (data[2] << 8)
+            packets = data[3]
+            if size > J1939_MAX_SIZE or packets == 0 or packets * TP_DT_SIZE < size:
+                self.error_count += 1
+                return True
+            if control == TP_CM_BAM:
+                destination = GLOBAL_ADDRESS
+            self.open_session(('j1939', source, destination),
+                              Session(key, size, packets, timestamp))
+        elif control == TP_CM_ABORT:
+            # Either side of a connection may abort it
+            self.sessions.pop(('j1939', source, destination), None)
+            self.sessions.pop(('j1939', destination, source), None)
+        return True
+
+    def feed_tp_dt(self, source, destination, data, timestamp):
+        session_key = ('j1939', source, destination)
+        session = self.sessions.get(session_key)
+        if session is None:
+            return False
+        sequence = data[0] if len(data) > 0 else 0
+        if sequence < 1 or sequence > session.packets:
+            self.error_count += 1
+            return True
+        # Packets may be repeated on request (CTS), so they are placed by sequence number
+        start = (sequence - 1) * TP_DT_SIZE
+        chunk = data[1:1 + TP_DT_SIZE]
+        session.buffer[start:start + len(chunk)] = chunk
+        session.received |= 1 << (sequence - 1)
+        if session.received == (1 << session.packets) - 1:
+            self.complete(session_key, session, timestamp)
+        else:
+            self.touch(session_key, session, timestamp)
+        return True
+
+    def feed_isotp(self, arbitration_id, data, timestamp):
+        if len(data) == 0:
+            return
+        frame_type = data[0] >> 4
+        session_key = ('isotp', arbitration_id, None)
+        if frame_type == ISOTP_SINGLE_FRAME:
+            size = data[0] & 0x0F
+            if size == 0 or size > len(data) - 1:
+                self.error_count += 1
+                return
+            self.completed_count += 1
+            if self.on_message is not None:
+                self.on_message(arbitration_id, bytes(data[1:1 + size]), timestamp)
+        elif frame_type == ISOTP_FIRST_FRAME:
+            size = ((data[0] & 0x0F) << 8) | data[1] if len(data) > 1 else 0
+            if size == 0:
+                # Sizes above 4095 bytes (escape sequence) are not supported
+                self.error_count += 1
+                return
+            session = Session(arbitration_id, size, 0, timestamp)
+            chunk = data[2:]
+            session.buffer[:len(chunk)] = chunk
+            session.received = len(chunk)
+            self.open_session(session_key, session)
+        elif frame_type == ISOTP_CONSECUTIVE_FRAME:
+            session = self.sessions.get(session_key)
+            if session is None:
+                return
+            if data[0] & 0x0F != session.next_sequence & 0x0F:
+                logger.debug("ISO-TP sequence error on ID %X", arbitration_id)
+                del self.sessions[session_key]
+                self.error_count += 1
+                return
+            chunk = data[1:1 + session.size - session.received]
+            session.buffer[session.received:session.received + len(chunk)] = chunk
+            session.received += len(chunk)
+            session.next_sequence += 1
+            if session.received >= session.size:
+                self.complete(session_key, session, timestamp)
+            else:
+                self.touch(session_key, session, timestamp)
+        # Flow control frames are sent by the receiver and carry no payload
+
+    def stats(self):
+        return {"sessions": len(self.sessions),
+                "completed": self.completed_count,
+                "timed_out": self.timed_out_count,
+                "evicted": self.evicted_count,
+                "errors": self.error_count}
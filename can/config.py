@@ -2,11 +2,25 @@
 Initialize with a YAML config filepath. Parses and returns
 the config YAML file as a dict object
 
+ConfigWatcher calls back with the new config dict whenever the file is
+saved with a valid YAML content, so that listeners can reload in place.
 """
 
+import os
+import sys
 import yaml
 import logging
 
+# ConfigWatcher is shared with the components of the repository root. It only
+# depends on yaml, so the CAN tools do not need the MQTT dependencies
+ROOT_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT_DIRECTORY not in sys.path:
+    sys.path.append(ROOT_DIRECTORY)
+from config_watcher import ConfigWatcher
+
+logger = logging.getLogger(__name__)
+
+
 class Config:
 
     def __init__(self, filename):
@@ -21,11 +35,8 @@ class Config:
                 try:
                     return yaml.safe_load(stream)
                 except yaml.YAMLError as exc:
-                    logging.warning("Exception occured while parsing config file", exc)
+                    logger.warning("Exception occured while parsing config file.\nDetails: {}".format(exc))
                     return {}
         except FileNotFoundError:
-            logging.warning("Config file not found")
+            logger.warning("Config file not found")
             return {}
-
-        
-        
@@ -1,32 +1,63 @@
 import sys
-import can
+import asyncio
 import logging
 logging.getLogger().setLevel(logging.INFO)
 
-from config import Config
-from CANListener import CANListener
+from config import Config, ConfigWatcher
+from ListenerManager import ListenerManager
+from TraceRecorder import RECORDER_STR
 
 filepath = "./config.yaml"
 
-config_dict = Config(filepath).read_config()
-logging.info("Config dict is read: {}".format(config_dict))
-
-bustype, channel = 'socketcan', 'can0' 
-bus = None
-try:
-    bus = can.interface.Bus(channel=channel, bustype=bustype, bitrate=500000)
-except OSError as osError:
-    logging.error("Error while trying to initialize the CAN bus.\nDetails: {}".format(osError))
-    logging.error("Terminating...")
-    sys.exit(1)
-    
-can_listener = CANListener(bus, config_dict) 
-
-logging.info("Starting async listener")
-# can_listener.listen_asynchronously()
-can_listener.start_background_listener()
-logging.info("Stopped listening. Cleaning up..")
-
-
-
 
+def main():
+    config_dict = Config(filepath).read_config()
+    logging.info("Config dict is read: {}".format(config_dict))
+
+    # One CANListener per configured channel (can0 by default)
+    manager = ListenerManager(config_dict)
+    # Recorded channels are opened without kernel filters
+    if config_dict is not None and RECORDER_STR in config_dict:
+        manager.record_to(config_dict[RECORDER_STR])
+    try:
+        manager.open()
+    except OSError as osError:
+        logging.error("Error while trying to initialize the CAN bus.\nDetails: {}".format(osError))
+        logging.error("Terminating...")
+        manager.shut_down()
+        sys.exit(1)
+
+    logging.info("Starting async listener")
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    manager.attach_to_loop(loop)
+    # Messages, filters and channels are reloaded in place when config.yaml is saved
+    watcher = ConfigWatcher(filepath, manager.reload)
+    watcher.attach_to_loop(loop)
+    failed_channels = []
+
+    def check_ingest():
+        # In INGEST mode process the bus is opened by the ingest process
+        failed_channels.extend(manager.failed_channels())
+        if len(failed_channels) > 0:
+            logging.error("CAN ingest of {} failed. Terminating...".format(failed_channels))
+            loop.stop()
+            return
+        loop.call_later(1.0, check_ingest)
+
+    loop.call_soon(check_ingest)
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        logging.info("Keyboard interrupt. Stopping...")
+    logging.info("Stopped listening. Cleaning up..")
+    watcher.stop()
+    manager.shut_down()
+    logging.info("Filter stats: {}".format(manager.filter_stats()))
+    if len(failed_channels) > 0:
+        sys.exit(1)
+
+
+# Ingest processes are spawned and import this module again
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+import json
+import asyncio
+import argparse
+import logging
+logging.getLogger().setLevel(logging.INFO)
+
+from config import Config
+from CANListener import CANListener
+from ReplayBus import ReplayBus
+
+parser = argparse.ArgumentParser(
+    description="Replays recorded CAN traces through CANListener")
+parser.add_argument("traces", nargs="+",
+                    help="trace files (.pctrace, .log, .asc, .blf, ...) or trace directories")
+parser.add_argument("-c", "--config", default="./config.yaml")
+parser.add_argument("-s", "--speed", type=float, default=1.0,
+                    help="replay speed factor, 0 replays as fast as possible")
+parser.add_argument("--loop", action="store_true", help="restart the traces when they end")
+args = parser.parse_args()
+
+config_dict = Config(args.config).read_config()
+can_listener = CANListener(None, config_dict)
+bus = ReplayBus(paths=args.traces, speed=args.speed, loop=args.loop,
+                can_filters=can_listener.build_can_filters())
+can_listener.set_bus(bus)
+
+loop = asyncio.new_event_loop()
+asyncio.set_event_loop(loop)
+notifier = can_listener.attach_to_loop(loop)
+
+
+async def wait_until_finished():
+    while not bus.finished:
+        await asyncio.sleep(0.1)
+    # Let the notifier deliver the last frames
+    await asyncio.sleep(can_listener.max_batch_delay * 2)
+
+logging.info("Replaying {} at speed {}".format(args.traces, args.speed or "max"))
+try:
+    loop.run_until_complete(wait_until_finished())
+except KeyboardInterrupt:
+    logging.info("Interrupted")
+notifier.stop()
+bus.shutdown()
+
+stats = {"replay": bus.timing_stats(),
+         "filters": can_listener.filter_stats.as_dict()}
+if can_listener.change_filter is not None:
+    stats["change_filter"] = can_listener.change_filter.stats()
+stats["decoded"] = can_listener.can_data.snapshot_dict()
+print(json.dumps(stats, indent=2))
@@ -0,0 +1,86 @@
+'''
+Reloads YAML config files in place. The file is checked for a changed
+modification time (a stat call per interval, which also notices editors
+replacing the file) and its parsed content is passed to `callback(config)`.
+Files that do not parse are skipped, so that the running config stays.
+The file is checked from a background thread (start) or from an asyncio
+loop (attach_to_loop), so that the callback runs in the thread of the CAN
+listeners. Only depends on yaml: the CAN tools import it too (can/config.py).
+'''
+
+import os
+import threading
+import logging
+import yaml
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_INTERVAL = 1.0  # seconds
+
+
+class ConfigWatcher:
+    def __init__(self, filepath, callback, interval: float = DEFAULT_INTERVAL):
+        self.filepath = filepath
+        self.callback = callback
+        self.interval = interval
+        self.signature = self.stat()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.handle = None
+
+    def stat(self):
+        try:
+            stat = os.stat(self.filepath)
+            return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        except OSError:
+            return None
+
+    def check(self) -> bool:
+        # Returns True if a changed config was passed to the callback
+        signature = self.stat()
+        if signature is None or signature == self.signature:
+            return False
+        self.signature = signature
+        try:
+            with open(self.filepath, "r") as stream:
+                config = yaml.safe_load(stream)
+        except (OSError, yaml.YAMLError) as error:
+            logger.warning("Changed config file {} is not applied.\nDetails: {}".format(
+                self.filepath, error))
+            return False
+        if not isinstance(config, dict):
+            logger.warning("Changed config file {} is empty, not applied".format(self.filepath))
+            return False
+        logger.info("Config file {} changed, reloading".format(self.filepath))
+        try:
+            self.callback(config)
+        except Exception as exc:
+            logger.error("Error while reloading {}.\nDetails: {}".format(self.filepath, exc))
+        return True
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            self.check()
+
+    def start(self):
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(
+            target=self.run, name="ConfigWatcher", daemon=True)
+        self.thread.start()
+
+    def attach_to_loop(self, loop):
+        def poll():
+            self.check()
+            self.handle = loop.call_later(self.interval, poll)
+        self.handle = loop.call_later(self.interval, poll)
+
+    def stop(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
@@ -0,0 +1,188 @@
+'''
+Logging of the service. The logging threads (CAN notifier, obd.Async, the
+OBD scheduler, paho) only put their records on a bounded queue; a
+QueueListener thread formats and writes them, so that a slow SD card or
+journal never stalls a receive path. A full queue drops records instead of
+blocking.
+
+    Logging:
+        level: INFO
+        # text | json (one object per line, including the `extra` fields)
+        format: text
+        # Rotated log file. Without it records go to stderr (the journal under systemd)
+        file: /var/log/pican/pican.log
+        max_bytes: 1048576
+        backup_count: 3
+        queue_size: 10000
+        # Levels of module loggers
+        loggers:
+            obd_listener.avl_obd: DEBUG
+        # Passes 1 in N records of each call site of a logger, warnings and errors always
+        sample:
+            obd_listener.avl_obd: 100
+
+Levels and sampling are applied again when the file changes (see main.py).
+'''
+
+import os
+import json
+import queue
+import logging
+import logging.handlers
+import yaml
+
+logger = logging.getLogger(__name__)
+
+LOG_CONFIG_FILEPATH = os.path.dirname(
+    os.path.realpath(__file__)) + "/config_logging.yaml"
+
+# Config keywords
+LOGGING_STR = "Logging"
+LEVEL_STR = "level"
+FORMAT_STR = "format"
+FORMAT_TEXT = "text"
+FORMAT_JSON = "json"
+FILE_STR = "file"
+MAX_BYTES_STR = "max_bytes"
+BACKUP_COUNT_STR = "backup_count"
+QUEUE_SIZE_STR = "queue_size"
+LOGGERS_STR = "loggers"
+SAMPLE_STR = "sample"
+
+DEFAULT_LEVEL = "INFO"
+DEFAULT_MAX_BYTES = 1024 * 1024
+DEFAULT_BACKUP_COUNT = 3
+DEFAULT_QUEUE_SIZE = 10000
+TEXT_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+# Module loggers whose level or sampling was set by apply_levels
+configured_loggers = set()
+
+# Attributes of every LogRecord, the others were passed as `extra`
+RECORD_ATTRIBUTES = frozenset(
+    vars(logging.LogRecord("", logging.INFO, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {"time": record.created,
+                 "level": record.levelname,
+                 "logger": record.name,
+                 "thread": record.threadName,
+                 "message": record.getMessage()}
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class SampleFilter(logging.Filter):
+    '''
+    Passes the first and then every `every`-th record of each call site.
+    Warnings and errors always pass
+    '''
+
+    def __init__(self, every: int):
+        super().__init__()
+        self.every = max(1, int(every))
+        self.counts = {}  # (pathname, lineno) -> records seen
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        site = (record.pathname, record.lineno)
+        count = self.counts.get(site, 0)
+        self.counts[site] = count + 1
+        if count % self.every != 0:
+            return False
+        record.sample_rate = self.every
+        return True
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped_count = 0
+
+    def enqueue(self, record):
+        # Never blocks the logging thread
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped_count += 1
+
+
+def read_logging_config(filepath=LOG_CONFIG_FILEPATH) -> dict:
+    # Defaults are used if the file is missing or does not parse
+    try:
+        with open(filepath, "r") as stream:
+            config = yaml.safe_load(stream)
+    except FileNotFoundError:
+        return {}
+    except (OSError, yaml.YAMLError) as error:
+        logger.warning("Logging config {} is not applied.\nDetails: {}".format(filepath, error))
+        return {}
+    return config if isinstance(config, dict) else {}
+
+
+def create_handler(logging_config: dict) -> logging.Handler:
+    path = logging_config.get(FILE_STR)
+    if path:
+        path = os.path.expanduser(path)
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        handler = logging.handlers.RotatingFileHandler(
+            path, maxBytes=logging_config.get(MAX_BYTES_STR, DEFAULT_MAX_BYTES),
+            backupCount=logging_config.get(BACKUP_COUNT_STR, DEFAULT_BACKUP_COUNT))
+    else:
+        handler = logging.StreamHandler()
+    if logging_config.get(FORMAT_STR, FORMAT_TEXT) == FORMAT_JSON:
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+    return handler
+
+
+def configure_logging(config: dict = None) -> logging.handlers.QueueListener:
+    # Routes the records of all loggers through the queue. Returns the started
+    # QueueListener, stop it before exiting to write the queued records
+    logging_config = (config or {}).get(LOGGING_STR) or {}
+    try:
+        handler = create_handler(logging_config)
+    except OSError as error:
+        handler = create_handler({FORMAT_STR: logging_config.get(FORMAT_STR)})
+        logger.warning("Unable to open the log file, logging to stderr.\nDetails: {}".format(error))
+    log_queue = queue.Queue(logging_config.get(QUEUE_SIZE_STR, DEFAULT_QUEUE_SIZE))
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(DroppingQueueHandler(log_queue))
+    apply_levels(config)
+    listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+def apply_levels(config: dict):
+    # (Re)applies the root and module levels and the sampling. Loggers no
+    # longer in the config inherit their level again
+    global configured_loggers
+    logging_config = (config or {}).get(LOGGING_STR) or {}
+    levels = {"": logging_config.get(LEVEL_STR, DEFAULT_LEVEL)}
+    levels.update(logging_config.get(LOGGERS_STR) or {})
+    sample = logging_config.get(SAMPLE_STR) or {}
+    for name in configured_loggers - set(levels):
+        logging.getLogger(name).setLevel(logging.NOTSET)
+    for name, level in levels.items():
+        try:
+            logging.getLogger(name).setLevel(str(level).upper())
+        except ValueError as error:
+            logger.warning("Log level of {} is not applied.\nDetails: {}".format(name or "root", error))
+    for name in configured_loggers | set(sample):
+        module_logger = logging.getLogger(name)
+        for existing in [f for f in module_logger.filters if isinstance(f, SampleFilter)]:
+            module_logger.removeFilter(existing)
+        if sample.get(name, 1) > 1:
+            module_logger.addFilter(SampleFilter(sample[name]))
+    configured_loggers = (set(levels) | set(sample)) - {""}
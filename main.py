@@ -1,50 +1,334 @@
-from obd_listener import OBDTracker
-from mqtt import MqttClient
-import logging as logger
-from pynput import keyboard
+import os
+import sys
+import asyncio
+import argparse
+import threading
+from mqtt import MqttClient, AsyncMqttClient
+from mqtt.mqtt import Config as MqttConfig, MQTT_CONFIG_FILEPATH, CLIENT_STR, ASYNCIO_STR
+from supervisor import Supervisor, Component, DEFAULT_DRAIN_TIMEOUT
+from config_watcher import ConfigWatcher
+from log_config import configure_logging, read_logging_config, apply_levels, LOG_CONFIG_FILEPATH
+import logging
 
-logger.getLogger(__name__).setLevel(logger.INFO)
+logger = logging.getLogger(__name__)
 
+# obd_listener (python-obd and its pint unit registry) and the CAN listener
+# are imported where they are needed: on the Pi they take seconds to import,
+# which is spent connecting to the broker instead
 
-def on_press(key: keyboard.Key):
-    # try:
-    #     print('Alphanumeric key {0} pressed'.format(key.char))
-    # except AttributeError:
-    #     print('Special key {0} pressed'.format(key))
-    pass
+CAN_DIRECTORY = os.path.dirname(os.path.realpath(__file__)) + "/can"
 
 
-def on_release(key: keyboard.Key):
-    if key == keyboard.Key.esc:
-        # Stop listener
-        return False
+def create_mqtt_client(can_config_path: str = None) -> MqttClient:
+    # Client/asyncio in the MQTT config runs the client on the event loop of
+    # the CAN listener (see mqtt/async_client.py) instead of paho's thread
+    mqtt_config = MqttConfig(MQTT_CONFIG_FILEPATH).read_config()
+    client_config = (mqtt_config or {}).get(CLIENT_STR) or {}
+    if not client_config.get(ASYNCIO_STR, False):
+        return MqttClient(mqtt_config)
+    if can_config_path is None:
+        logger.warning("MQTT asyncio mode shares the loop of the CAN listener (--can). "
+                       "Using paho's network thread")
+        return MqttClient(mqtt_config)
+    return AsyncMqttClient(mqtt_config)
 
 
-def start():
-    with keyboard.Listener(on_press=on_press, on_release=on_release) as listener:
-        listener.join()
+def add_can_directory():
+    # The CAN listener modules are imported by their file names
+    if CAN_DIRECTORY not in sys.path:
+        sys.path.append(CAN_DIRECTORY)
 
 
-if __name__ == "__main__":
-    logger.info("########## OBD Tracker ##########")
+class TelemetrySchema:
+    # The binary schema of the published values (see MqttClient.set_schema),
+    # derived from the OBD and CAN configs before anything is published and
+    # updated when they are reloaded. Deriving the OBD types imports python-obd
+    # up front, so it is only used with a binary serializer
+
+    def __init__(self, mqtt_client: MqttClient):
+        self.mqtt_client = mqtt_client
+        self.obd_fields = {}
+        self.can_fields = {}
+        # OBD reloads run on their watcher thread, CAN reloads on the listener loop
+        self.lock = threading.Lock()
+
+    def read_configs(self, obd: bool, can_config_path: str = None):
+        # Sets the schema of the merged configs at once
+        if obd:
+            from obd_listener.avl_obd import OBD_CONFIG_FILEPATH, OBDConfig, schema_fields
+            self.obd_fields = schema_fields(OBDConfig.read_config_st(OBD_CONFIG_FILEPATH))
+        if can_config_path is not None:
+            add_can_directory()
+            from config import Config
+            from ListenerManager import ListenerManager
+            self.can_fields = ListenerManager(
+                Config(can_config_path).read_config()).schema_fields()
+        with self.lock:
+            self.apply()
+
+    def set_obd_config(self, config: dict):
+        from obd_listener.avl_obd import schema_fields
+        with self.lock:
+            self.obd_fields = schema_fields(config)
+            self.apply()
+
+    def set_can_fields(self, fields: dict):
+        with self.lock:
+            self.can_fields = fields
+            self.apply()
+
+    def apply(self):
+        fields = dict(self.obd_fields)
+        fields.update(self.can_fields)
+        self.mqtt_client.set_schema(fields)
+
+
+class MqttComponent(Component):
+    name = "mqtt"
+
+    def __init__(self, client: MqttClient):
+        self.client = client
+        # An AsyncMqttClient is connected and shut down by the CanComponent
+        # running its loop
+        self.on_loop = isinstance(client, AsyncMqttClient)
+        self.failed = False
+        self.thread = None
+        # Saved config files are applied without restarting, see MqttClient.reload
+        self.watcher = ConfigWatcher(MQTT_CONFIG_FILEPATH, self.client.reload)
+
+    def start(self):
+        # Connects on a thread, so that the OBD adapter is set up in parallel.
+        # OBDTracker waits for the connection before publishing
+        self.failed = False
+        self.watcher.start()
+        if self.on_loop:
+            return
+        self.thread = threading.Thread(
+            target=self.connect, name="MqttConnect", daemon=True)
+        self.thread.start()
+
+    def connect(self):
+        try:
+            self.client.connect()
+        except SystemExit:
+            # connect_to_broker terminates if the broker cannot be resolved,
+            # e.g. before the network is up
+            self.failed = True
+
+    def healthy(self) -> bool:
+        return not self.failed
+
+    def restart(self, timeout: float):
+        # Once connected paho reconnects by itself, so only the first connect is retried
+        self.start()
+
+    def stop(self, timeout: float):
+        self.watcher.stop()
+        if self.on_loop:
+            return
+        if self.thread is not None:
+            self.thread.join(timeout)
+        self.client.shut_down(drain_timeout=timeout)
+
+
+class ObdComponent(Component):
+    name = "obd"
+
+    def __init__(self, mqtt_client: MqttClient, schema: TelemetrySchema = None):
+        self.mqtt_client = mqtt_client
+        self.schema = schema
+        self.tracker = None
+        self.thread = None
+        self.watcher = None
+
+    def start(self):
+        # Importing python-obd and initializing the adapter take seconds
+        self.thread = threading.Thread(
+            target=self.connect, name="OBDConnect", daemon=True)
+        self.thread.start()
 
-    logger.info("MqttClient is connecting to the broker")
-    mqtt_client = MqttClient()
-    mqtt_client.connect()
+    def connect(self):
+        from obd_listener import OBDTracker
+        from obd_listener.avl_obd import OBD_CONFIG_FILEPATH
+        if self.watcher is None:
+            self.watcher = ConfigWatcher(OBD_CONFIG_FILEPATH, self.reload)
+        self.watcher.start()
+        self.tracker = OBDTracker(mqtt_client=self.mqtt_client)
+        if self.schema is not None:
+            # The config may have been saved since the schema was derived
+            self.schema.set_obd_config(self.tracker.config)
+        self.tracker.connect()
 
-    obd_tracker = OBDTracker(mqtt_client=mqtt_client)
-    obd_tracker.connect()
-    obd_tracker.test_query()
+    def add_samples(self, names, timestamps, values):
+        # Decoded CAN samples for the freeze frames of the current tracker, if
+        # its diagnostics are enabled (see diagnostics.py)
+        tracker = self.tracker
+        if tracker is not None and tracker.diagnostics is not None:
+            tracker.diagnostics.add_samples(names, timestamps, values)
 
-    start()
+    def healthy(self) -> bool:
+        if self.thread is not None and self.thread.is_alive():
+            # Still connecting
+            return True
+        return self.tracker is not None and self.tracker.is_running()
 
-    logger.info("Shutting down the OBDTracker...")
-    obd_tracker.shut_down(reason="Shut down requested")
-    logger.info("Shutting down the MqttClient...")
-    mqtt_client.shut_down()
+    def reload(self, config: dict):
+        # A restarted tracker reads the saved config itself
+        if self.tracker is not None and self.tracker.reload(config) and \
+                self.schema is not None:
+            self.schema.set_obd_config(config)
+
+    def stop(self, timeout: float):
+        if self.thread is not None:
+            self.thread.join(timeout)
+        if self.watcher is not None:
+            self.watcher.stop()
+        if self.tracker is not None:
+            self.tracker.shut_down(reason="Shut down requested")
+            self.tracker = None
+
+
+class CanComponent(Component):
+    name = "can"
+
+    def __init__(self, config_path: str, mqtt_client: MqttClient, sample_sink=None,
+                 schema: TelemetrySchema = None):
+        self.config_path = config_path
+        self.mqtt_client = mqtt_client
+        self.schema = schema
+        # Gets every decoded sample, e.g. the ObdComponent for its freeze frames
+        self.sample_sink = sample_sink
+        self.manager = None
+        self.loop = None
+        self.thread = None
+
+    def start(self):
+        add_can_directory()
+        from config import Config
+        from ListenerManager import ListenerManager
+        self.manager = ListenerManager(Config(self.config_path).read_config())
+        try:
+            self.manager.open()
+        except OSError:
+            self.manager.shut_down()
+            self.manager = None
+            raise
+        if self.schema is not None:
+            # The config may have been saved since the schema was derived
+            self.schema.set_can_fields(self.manager.schema_fields())
+        self.manager.publish_to(self.mqtt_client.publisher)
+        if self.mqtt_client.aggregator is not None:
+            self.manager.aggregate_to(self.mqtt_client.aggregator)
+        if self.sample_sink is not None:
+            self.manager.capture_to(self.sample_sink)
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.run, name="CANListener", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        if isinstance(self.mqtt_client, AsyncMqttClient):
+            # Heartbeats, publishes and reconnects share the loop with the CAN notifier
+            self.mqtt_client.connect(loop=self.loop)
+        self.manager.attach_to_loop(self.loop)
+        # Reloads run on the listener loop, see ListenerManager.reload
+        ConfigWatcher(self.config_path, self.reload).attach_to_loop(self.loop)
+        self.loop.run_forever()
+
+    def reload(self, config: dict):
+        if self.manager.reload(config) and self.schema is not None:
+            self.schema.set_can_fields(self.manager.schema_fields())
+
+    def healthy(self) -> bool:
+        # The supervisor restarts the component (and its ingest processes) if
+        # the loop died, an ingest process exited or a bus went bus-off
+        manager = self.manager
+        return self.thread is not None and self.thread.is_alive() and \
+            manager is not None and manager.healthy()
+
+    def stop(self, timeout: float):
+        self.stop_loop(timeout, shut_down_mqtt=True)
+
+    def restart(self, timeout: float):
+        # An AsyncMqttClient is only disconnected, start() connects it on the new loop
+        self.stop_loop(timeout, shut_down_mqtt=False)
+        self.start()
+
+    def stop_loop(self, timeout: float, shut_down_mqtt: bool):
+        if isinstance(self.mqtt_client, AsyncMqttClient):
+            self.stop_mqtt(timeout, shut_down_mqtt)
+        if self.thread is not None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join(timeout)
+            self.thread = None
+        if self.manager is not None:
+            self.manager.shut_down()
+            self.manager = None
+
+    def stop_mqtt(self, timeout: float, shut_down: bool):
+        # Drains the AsyncMqttClient on the loop while it still runs
+        if self.thread is None or not self.thread.is_alive():
+            if shut_down:
+                self.mqtt_client.shut_down()
+            else:
+                self.mqtt_client.disconnect()
+            return
+        if shut_down:
+            coroutine = self.mqtt_client.shut_down_async(timeout)
+        else:
+            coroutine = self.mqtt_client.disconnect_async(timeout)
+        try:
+            asyncio.run_coroutine_threadsafe(coroutine, self.loop).result(timeout)
+        except Exception as exc:
+            logger.warning("MQTT client did not disconnect in time.\nDetails: {}".format(exc))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="OBD/CAN tracker service")
+    parser.add_argument("--can", metavar="CONFIG", default=None,
+                        help="Listen to the CAN bus with the given config (e.g. can/config.yaml)")
+    parser.add_argument("--no-obd", action="store_true", help="Do not track the OBD port")
+    parser.add_argument("--drain-timeout", type=float, default=DEFAULT_DRAIN_TIMEOUT,
+                        help="Seconds to publish the pending values on shutdown")
+    parser.add_argument("--log-config", metavar="CONFIG", default=LOG_CONFIG_FILEPATH,
+                        help="Logging config (levels, sampling, log file)")
+    args = parser.parse_args()
+
+    # Records are written on a listener thread, see log_config.py
+    log_listener = configure_logging(read_logging_config(args.log_config))
+    log_watcher = ConfigWatcher(args.log_config, apply_levels)
+    log_watcher.start()
+
+    logger.info("########## OBD Tracker ##########")
+    mqtt_component = MqttComponent(create_mqtt_client(args.can))
+    # The binary schema is complete before the first value is published
+    schema = None
+    if mqtt_component.client.uses_schema():
+        schema = TelemetrySchema(mqtt_component.client)
+        schema.read_configs(not args.no_obd, args.can)
+    obd_component = None if args.no_obd else ObdComponent(mqtt_component.client, schema)
+    components = []
+    # Its ingest processes (INGEST mode: process) are spawned, so they do not
+    # inherit the logging queue and the threads started meanwhile. The CAN
+    # signals are part of the OBD freeze frames
+    if args.can is not None:
+        components.append(CanComponent(args.can, mqtt_component.client, obd_component, schema))
+    components.append(mqtt_component)
+    handlers = {"mqtt": mqtt_component.client.reload}
+    if obd_component is not None:
+        components.append(obd_component)
+        handlers["obd"] = obd_component.reload
+    # Configs published to <id>/config/<mqtt|obd> are applied if remote_config is set
+    if mqtt_component.client.remote_config_enabled():
+        mqtt_component.client.enable_remote_config(handlers)
 
-    # import asyncio
-    # loop = asyncio.get_event_loop()
-    # loop.run_forever()
-    # obd_tracker.shut_down()
+    supervisor = Supervisor(components, drain_timeout=args.drain_timeout)
+    supervisor.install_signal_handlers()
+    exit_code = supervisor.run()
     logger.info("Program exiting...")
+    log_watcher.stop()
+    log_listener.stop()
+    if exit_code != 0:
+        # Do not wait for the threads that did not stop
+        logging.shutdown()
+        os._exit(exit_code)
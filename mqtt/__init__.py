@@ -1 +1,14 @@
 from .mqtt import MqttClient
+from .publisher import PublishPipeline
+from .serializer import JsonSerializer, BinarySerializer, create_serializer
+from .dispatcher import TopicDispatcher
+from .async_client import AsyncMqttClient
+from .latency import LatencyTracker, LatencyHistogram, monotonic_from_wall
+
+
+def __getattr__(name):
+    # WindowAggregator pulls in numpy, which slows down the startup on the Pi
+    if name == "WindowAggregator":
+        from .aggregator import WindowAggregator
+        return WindowAggregator
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
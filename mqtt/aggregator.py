@@ -0,0 +1,287 @@
+'''
+Streaming window statistics of telemetry signals, so that the uplink can run
+at one message per window while peaks between two messages are not lost.
+
+Per signal and window: count, min, max, mean, stddev and approximate
+quantiles (merging t-digest). Memory is constant: a window is made of
+`window / hop` panes of `hop` seconds, each holding fixed size statistics
+per signal. hop == window gives tumbling windows, a smaller hop sliding ones.
+Samples are assigned to panes by their arrival time.
+
+    Aggregate:
+        window: 1.0
+        hop: 1.0
+        quantiles: [0.5, 0.9, 0.99]
+        compression: 50
+        topic: <id>/aggregates
+'''
+
+import time
+import asyncio
+import threading
+import logging
+from collections import deque
+import numpy as np
+
+from .serializer import JsonSerializer, NAME_STR, FIELD_TYPE_STR, TYPE_F32, TYPE_INT, TYPE_STR
+
+logger = logging.getLogger(__name__)
+
+# Config keywords
+AGGREGATE_STR = "Aggregate"
+WINDOW_STR = "window"
+HOP_STR = "hop"
+QUANTILES_STR = "quantiles"
+COMPRESSION_STR = "compression"
+TOPIC_STR = "topic"
+
+DEFAULT_WINDOW = 1.0  # seconds
+DEFAULT_QUANTILES = [0.5, 0.9, 0.99]
+DEFAULT_COMPRESSION = 50
+DEFAULT_TOPIC_SUFFIX = "/aggregates"
+# Samples buffered (in multiples of the compression) before a digest is merged
+BUFFER_FACTOR = 5
+# Statistics published per key as <key>/<statistic>, followed by the quantiles
+STATISTICS = ["count", "min", "max", "mean", "stddev"]
+
+
+def quantile_name(quantile):
+    return "p{:g}".format(quantile * 100)
+
+
+class TDigest:
+    '''
+    Merging t-digest: sorted centroids whose weight is bounded by
+    4 * n * q * (1 - q) / compression, so the tails stay precise
+    '''
+    __slots__ = ('compression', 'means', 'weights', 'pending', 'pending_count')
+
+    def __init__(self, compression=DEFAULT_COMPRESSION):
+        self.compression = compression
+        self.means = np.empty(0, dtype=np.float64)
+        self.weights = np.empty(0, dtype=np.float64)
+        self.pending = []  # (means, weights) not merged yet
+        self.pending_count = 0
+
+    def add_many(self, values):
+        self.pending.append((values, np.ones(len(values))))
+        self.pending_count += len(values)
+        if self.pending_count >= BUFFER_FACTOR * self.compression:
+            self.compress()
+
+    def merge(self, other):
+        other.compress()
+        if len(other.means) > 0:
+            self.pending.append((other.means, other.weights))
+            self.pending_count += len(other.means)
+
+    def compress(self):
+        if len(self.pending) == 0:
+            return
+        means = np.concatenate([self.means] + [pending[0] for pending in self.pending])
+        weights = np.concatenate([self.weights] + [pending[1] for pending in self.pending])
+        self.pending = []
+        self.pending_count = 0
+        order = np.argsort(means, kind='mergesort')
+        means = means[order].tolist()
+        weights = weights[order].tolist()
+        total = sum(weights)
+        merged_means, merged_weights = [], []
+        mean, weight, done = means[0], weights[0], 0.0
+        for next_mean, next_weight in zip(means[1:], weights[1:]):
+            proposed = weight + next_weight
+            q = (done + proposed / 2) / total
+            if proposed <= 4 * total * q * (1 - q) / self.compression:
+                mean += (next_mean - mean) * next_weight / proposed
+                weight = proposed
+            else:
+                merged_means.append(mean)
+                merged_weights.append(weight)
+                done += weight
+                mean, weight = next_mean, next_weight
+        merged_means.append(mean)
+        merged_weights.append(weight)
+        self.means = np.array(merged_means)
+        self.weights = np.array(merged_weights)
+
+    def quantile(self, quantile):
+        self.compress()
+        if len(self.means) == 0:
+            return float('nan')
+        centers = np.cumsum(self.weights) - self.weights / 2
+        return float(np.interp(quantile * self.weights.sum(), centers, self.means))
+
+
+class WindowStats:
+    '''
+    Mergeable statistics of one signal (moments merged as in Chan et al.)
+    '''
+    __slots__ = ('count', 'mean', 'm2', 'min', 'max', 'digest')
+
+    def __init__(self, compression=DEFAULT_COMPRESSION):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = float('inf')
+        self.max = float('-inf')
+        self.digest = TDigest(compression)
+
+    def merge_moments(self, count, mean, m2):
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean += delta * count / total
+        self.m2 += m2 + delta * delta * self.count * count / total
+        self.count = total
+
+    def add_many(self, values):
+        if len(values) == 0:
+            return
+        mean = float(values.mean())
+        self.merge_moments(len(values), mean, float(((values - mean) ** 2).sum()))
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+        self.digest.add_many(values)
+
+    def merge(self, other):
+        if other.count == 0:
+            return
+        self.merge_moments(other.count, other.mean, other.m2)
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.digest.merge(other.digest)
+
+    def as_dict(self, quantiles):
+        stats = {"count": self.count,
+                 "min": self.min,
+                 "max": self.max,
+                 "mean": self.mean,
+                 "stddev": (self.m2 / self.count) ** 0.5}
+        for quantile in quantiles:
+            stats[quantile_name(quantile)] = min(
+                max(self.digest.quantile(quantile), self.min), self.max)
+        return stats
+
+
+class WindowAggregator:
+    def __init__(self, mqtt_client, aggregate_config: dict = None, serializer=None):
+        if aggregate_config is None:
+            aggregate_config = {}
+        self.mqtt_client = mqtt_client
+        self.serializer = serializer if serializer is not None else JsonSerializer()
+        self.window = aggregate_config.get(WINDOW_STR, DEFAULT_WINDOW)
+        self.hop = aggregate_config.get(HOP_STR, self.window)
+        self.quantiles = aggregate_config.get(QUANTILES_STR, DEFAULT_QUANTILES)
+        self.compression = aggregate_config.get(COMPRESSION_STR, DEFAULT_COMPRESSION)
+        self.topic = aggregate_config.get(TOPIC_STR, None)
+        self.panes = deque(maxlen=max(1, int(round(self.window / self.hop))))
+        self.current = {}  # key -> WindowStats of the current pane
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.task = None
+        self.sent_count = 0
+
+    def get_topic(self):
+        if self.topic is not None:
+            return self.topic
+        return self.mqtt_client.id + DEFAULT_TOPIC_SUFFIX
+
+    def set_schema(self, fields: list):
+        # Replaces the binary schema (if any) by the statistics of the numeric
+        # `fields` of the published schema, in its order: the counts as
+        # integers, the others as floats (see MqttClient.set_schema)
+        if not hasattr(self.serializer, "set_schema"):
+            return
+        names = STATISTICS + [quantile_name(quantile) for quantile in self.quantiles]
+        schema = []
+        for field in fields:
+            if field.get(FIELD_TYPE_STR) == TYPE_STR:
+                continue
+            for name in names:
+                schema.append({NAME_STR: "{}/{}".format(field[NAME_STR], name),
+                               FIELD_TYPE_STR: TYPE_INT if name == "count" else TYPE_F32})
+        self.serializer.set_schema(schema)
+
+    def add(self, key, value):
+        try:
+            self.add_many(key, np.array([value], dtype=np.float64))
+        except (TypeError, ValueError):
+            # Only numeric values are aggregated
+            pass
+
+    def add_many(self, key, values):
+        # `values` is a 1-D float array of samples of `key`
+        with self.lock:
+            stats = self.current.get(key)
+            if stats is None:
+                stats = self.current[key] = WindowStats(self.compression)
+            stats.add_many(values)
+
+    def roll(self):
+        # Closes the current pane and returns the statistics of the last window
+        with self.lock:
+            pane = self.current
+            self.current = {}
+        self.panes.append(pane)
+        if len(self.panes) == 1:
+            window = pane
+        else:
+            window = {}
+            for pane in self.panes:
+                for key, stats in pane.items():
+                    merged = window.get(key)
+                    if merged is None:
+                        merged = window[key] = WindowStats(self.compression)
+                    merged.merge(stats)
+        return {key: stats.as_dict(self.quantiles) for key, stats in window.items()
+                if stats.count > 0}
+
+    def flush(self):
+        window = self.roll()
+        if len(window) == 0:
+            return None
+        values = {"{}/{}".format(key, name): value
+                  for key, stats in window.items() for name, value in stats.items()}
+        payload = self.serializer.encode(time.time(), values)
+        self.sent_count += 1
+        return self.mqtt_client.publish(self.get_topic(), payload)
+
+    def run(self):
+        while not self.stop_event.wait(self.hop):
+            try:
+                self.flush()
+            except Exception as exc:
+                logger.error(
+                    "Error while flushing the window aggregates.\nDetails: {}".format(exc))
+
+    async def run_async(self):
+        while not self.stop_event.is_set():
+            await asyncio.sleep(self.hop)
+            try:
+                self.flush()
+            except Exception as exc:
+                logger.error(
+                    "Error while flushing the window aggregates.\nDetails: {}".format(exc))
+
+    def start(self, loop: asyncio.AbstractEventLoop = None):
+        # Publishes on a background thread, or as a task of `loop` if given
+        if loop is not None:
+            if self.task is None or self.task.done():
+                self.stop_event.clear()
+                self.task = loop.create_task(self.run_async())
+            return
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(
+            target=self.run, name="WindowAggregator", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
@@ -0,0 +1,235 @@
+'''
+asyncio mode of the MqttClient. Paho's socket is driven by the event loop
+(add_reader/add_writer) instead of the `loop_start` thread, and heartbeats,
+publish windows, reconnects and the offline queue drain run as tasks of the
+same loop. The loop can be shared with the CAN notifier
+(see CANListener.attach_to_loop) so that no extra thread is needed.
+
+main.py runs the client on the loop of the CAN listener if enabled in the
+MQTT config (and --can is given):
+
+    Client:
+        asyncio: true
+'''
+
+import asyncio
+import threading
+import socket
+import logging
+import paho.mqtt.client as mqtt
+
+from .mqtt import MqttClient
+
+logger = logging.getLogger(__name__)
+
+MISC_LOOP_PERIOD = 1.0  # seconds
+RECONNECT_MIN_DELAY = 1.0  # seconds
+RECONNECT_MAX_DELAY = 60.0  # seconds
+PUBLISH_POLL_PERIOD = 0.01  # seconds
+
+
+class AsyncioHelper:
+    '''
+    Registers paho's socket with an asyncio event loop. Must be created in the
+    thread running the loop; the callbacks of paho calls made from other
+    threads (e.g. the connect in the executor) are handed over to the loop
+    '''
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, client: mqtt.Client):
+        self.loop = loop
+        self.loop_thread_id = threading.get_ident()
+        self.client = client
+        self.misc = None
+        self.client.on_socket_open = self.on_socket_open
+        self.client.on_socket_close = self.on_socket_close
+        self.client.on_socket_register_write = self.on_socket_register_write
+        self.client.on_socket_unregister_write = self.on_socket_unregister_write
+
+    def call_in_loop(self, callback, *args):
+        if threading.get_ident() == self.loop_thread_id:
+            callback(*args)
+        else:
+            self.loop.call_soon_threadsafe(callback, *args)
+
+    def on_socket_open(self, client, userdata, sock):
+        self.call_in_loop(self.open_socket, client, sock)
+
+    def open_socket(self, client, sock):
+        self.loop.add_reader(sock, client.loop_read)
+        self.misc = self.loop.create_task(self.misc_loop())
+
+    def on_socket_close(self, client, userdata, sock):
+        self.call_in_loop(self.close_socket, sock)
+
+    def close_socket(self, sock):
+        self.loop.remove_reader(sock)
+        if self.misc is not None:
+            self.misc.cancel()
+            self.misc = None
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self.call_in_loop(self.loop.add_writer, sock, client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.call_in_loop(self.loop.remove_writer, sock)
+
+    async def misc_loop(self):
+        # Keepalive pings and retries
+        while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            try:
+                await asyncio.sleep(MISC_LOOP_PERIOD)
+            except asyncio.CancelledError:
+                break
+
+
+class AsyncMqttClient(MqttClient):
+    def __init__(self, mqtt_config: dict = None):
+        super().__init__(mqtt_config)
+        self.client = None  # Created by connect()
+        self.loop = None
+        self.loop_thread_id = None
+        self.helper = None
+        self.heartbeat_task = None
+        self.reconnect_task = None
+        self.drain_task = None
+        self.shutting_down = False
+
+    def connect(self, will="will not defined", loop: asyncio.AbstractEventLoop = None):
+        # Must be called from the thread running (or about to run) `loop`.
+        # Returns at once, the broker is connected to in the background
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+        self.loop_thread_id = threading.get_ident()
+        self.shutting_down = False
+        self.create_client(will)
+        self.helper = AsyncioHelper(self.loop, self.client)
+        self.connect_to_broker()
+        self.publisher.start(self.loop)
+        if self.aggregator is not None:
+            self.aggregator.start(self.loop)
+        if self.latency is not None:
+            self.latency.start_http_server()
+
+    def connect_to_broker(self):
+        # Name resolution and the TCP connect block, so they run in an executor
+        # thread while the loop keeps serving the CAN notifier
+        try:
+            self.client.connect_async(self.host, self.port)
+        except ValueError as value_err:
+            logger.error("Error while trying to connect to the {}\nDetails: {}".format(
+                self.host, value_err))
+            return
+        if self.reconnect_task is None or self.reconnect_task.done():
+            self.reconnect_task = self.loop.create_task(self.reconnect_async(delay=0.0))
+
+    def in_loop_thread(self) -> bool:
+        return self.loop_thread_id is None or threading.get_ident() == self.loop_thread_id
+
+    def publish(self, topic, payload, qos: int = 0, retain: bool = False) -> mqtt.MQTTMessageInfo:
+        if self.client is None and self.offline_queue is None:
+            # Not connected yet
+            return None
+        # Paho may register the socket for writing, which must happen in the loop thread
+        if not self.in_loop_thread():
+            self.loop.call_soon_threadsafe(
+                MqttClient.publish, self, topic, payload, qos, retain)
+            return None
+        return MqttClient.publish(self, topic, payload, qos, retain)
+
+    def heartbeat(self):
+        if self.heartbeat_task is None or self.heartbeat_task.done():
+            self.heartbeat_task = self.loop.create_task(self.heartbeat_async())
+
+    async def heartbeat_async(self):
+        while self.is_connected:
+            logger.info("### Heartbeat ###")
+            self.client.publish(self.id + "/heartbeat", "ON", retain=True)
+            await asyncio.sleep(self.hb_period)
+
+    def on_disconnect(self, client, userdata, rc=0):
+        self.is_connected = False
+        logger.info("Disconnecting with result code: {}".format(rc))
+        if rc != 0 and not self.shutting_down:
+            if self.reconnect_task is None or self.reconnect_task.done():
+                self.reconnect_task = self.loop.create_task(self.reconnect_async())
+
+    async def reconnect_async(self, delay: float = RECONNECT_MIN_DELAY):
+        # Exponential backoff between RECONNECT_MIN_DELAY and RECONNECT_MAX_DELAY
+        while not self.is_connected and not self.shutting_down:
+            if delay > 0:
+                await asyncio.sleep(delay)
+            try:
+                logger.info("Connecting to the broker {}".format(self.host))
+                await self.loop.run_in_executor(None, self.client.reconnect)
+                return
+            except (socket.error, OSError) as error:
+                delay = min(max(delay * 2, RECONNECT_MIN_DELAY), RECONNECT_MAX_DELAY)
+                logger.warning("Connecting failed. Retrying in {} s.\nDetails: {}".format(
+                    delay, error))
+
+    def start_draining(self):
+        if self.offline_queue is None or len(self.offline_queue) == 0:
+            return
+        if self.drain_task is None or self.drain_task.done():
+            self.drain_task = self.loop.create_task(self.drain_offline_queue_async())
+
+    async def drain_offline_queue_async(self):
+        logger.info("Draining {} messages from the offline queue".format(
+            len(self.offline_queue)))
+        while self.is_connected and len(self.offline_queue) > 0:
+            batch = self.publish_offline_batch()
+            if batch is None:
+                break
+            infos, end_index = batch
+            while self.is_connected and not all(info.is_published() for info in infos):
+                await asyncio.sleep(PUBLISH_POLL_PERIOD)
+            if not self.is_connected:
+                break
+            self.offline_queue.commit(end_index)
+            await asyncio.sleep(self.drain_interval)
+
+    def stop_tasks(self) -> mqtt.MQTTMessageInfo:
+        # Publishes the pending values and stops the tasks of the loop. Returns
+        # the message info of the last payload, see PublishPipeline.stop
+        self.shutting_down = True
+        info = self.publisher.stop()
+        if self.aggregator is not None:
+            self.aggregator.stop()
+        for task in (self.heartbeat_task, self.reconnect_task, self.drain_task):
+            if task is not None:
+                task.cancel()
+        return info
+
+    async def disconnect_async(self, drain_timeout: float = None):
+        # Waits up to `drain_timeout` for the pending values to be sent before
+        # disconnecting. Must run on the loop. connect() attaches the client to
+        # a loop again, e.g. after the CAN listener was restarted
+        info = self.stop_tasks()
+        deadline = self.loop.time() + (drain_timeout or 0.0)
+        if info is not None and self.is_connected:
+            while not info.is_published() and self.loop.time() < deadline:
+                await asyncio.sleep(PUBLISH_POLL_PERIOD)
+        self.client.disconnect()
+        # The DISCONNECT packet is written by the loop
+        while self.client.socket() is not None and self.loop.time() < deadline:
+            await asyncio.sleep(PUBLISH_POLL_PERIOD)
+
+    async def shut_down_async(self, drain_timeout: float = None):
+        await self.disconnect_async(drain_timeout)
+        if self.latency is not None:
+            self.latency.stop()
+        if self.offline_queue is not None:
+            self.offline_queue.close()
+
+    def disconnect(self):
+        # Without a running loop, e.g. once it was stopped. Pending values are
+        # handed to paho but not waited for
+        self.stop_tasks()
+        if self.client is not None:
+            self.client.disconnect()
+
+    def shut_down(self, drain_timeout: float = None):
+        self.disconnect()
+        if self.latency is not None:
+            self.latency.stop()
+        if self.offline_queue is not None:
+            self.offline_queue.close()
@@ -0,0 +1,107 @@
+import re
+from functools import lru_cache
+
+# re.Pattern is not available before Python 3.7
+PATTERN_TYPE = type(re.compile(""))
+# A string containing one of these is registered as a regex instead of a topic filter
+REGEX_CHARS = re.compile(r"[.*?^$|\\()\[\]{}]")
+
+SINGLE_LEVEL = "+"
+MULTI_LEVEL = "#"
+
+DEFAULT_CACHE_SIZE = 256
+
+
+class TopicNode:
+    __slots__ = ("children", "callbacks")
+
+    def __init__(self):
+        self.children = {}
+        self.callbacks = []
+
+
+class TopicDispatcher:
+    '''
+    Resolves the callbacks of an incoming topic. MQTT topic filters (with `+`
+    and `#` wildcards) are indexed in a trie so that a lookup costs O(topic
+    depth); regex patterns are checked one by one as a fallback. Resolved
+    topics are cached until the next registration.
+    '''
+
+    def __init__(self, cache_size: int = DEFAULT_CACHE_SIZE):
+        self.root = TopicNode()
+        self.regex_callbacks = {}  # compiled regex -> [callback]
+        self.resolve = lru_cache(maxsize=cache_size)(self.resolve_uncached)
+
+    @staticmethod
+    def is_regex(sub_topic) -> bool:
+        if isinstance(sub_topic, PATTERN_TYPE):
+            return True
+        # A leading $ belongs to system topics (e.g. $SYS/#), not to a regex
+        return REGEX_CHARS.search(sub_topic, 1 if sub_topic.startswith("$") else 0) is not None
+
+    def register(self, sub_topic, callback):
+        # `sub_topic` is either a compiled regex, a regex string or an MQTT topic filter
+        if TopicDispatcher.is_regex(sub_topic):
+            if not isinstance(sub_topic, PATTERN_TYPE):
+                sub_topic = re.compile(sub_topic)
+            self.regex_callbacks.setdefault(sub_topic, []).append(callback)
+        else:
+            node = self.root
+            for level in sub_topic.split("/"):
+                node = node.children.setdefault(level, TopicNode())
+            node.callbacks.append(callback)
+        self.resolve.cache_clear()
+
+    def unregister(self, sub_topic, callback) -> bool:
+        if TopicDispatcher.is_regex(sub_topic):
+            if not isinstance(sub_topic, PATTERN_TYPE):
+                sub_topic = re.compile(sub_topic)
+            callbacks = self.regex_callbacks.get(sub_topic, [])
+        else:
+            node = self.root
+            for level in sub_topic.split("/"):
+                node = node.children.get(level)
+                if node is None:
+                    return False
+            callbacks = node.callbacks
+        if callback not in callbacks:
+            return False
+        callbacks.remove(callback)
+        self.resolve.cache_clear()
+        return True
+
+    def resolve_uncached(self, topic: str) -> tuple:
+        callbacks = []
+        levels = topic.split("/")
+        # Wildcards do not match topics starting with $ (e.g. $SYS) at the first level
+        TopicDispatcher.match(self.root, levels, 0, callbacks, topic.startswith("$"))
+        for topic_re, regex_callbacks in self.regex_callbacks.items():
+            if topic_re.match(topic) is not None:
+                callbacks.extend(regex_callbacks)
+        return tuple(callbacks)
+
+    @staticmethod
+    def match(node, levels, index, callbacks, skip_wildcards=False):
+        if not skip_wildcards:
+            multi = node.children.get(MULTI_LEVEL)
+            if multi is not None:
+                # "a/#" also matches "a"
+                callbacks.extend(multi.callbacks)
+        if index == len(levels):
+            callbacks.extend(node.callbacks)
+            return
+        child = node.children.get(levels[index])
+        if child is not None:
+            TopicDispatcher.match(child, levels, index + 1, callbacks)
+        if not skip_wildcards:
+            single = node.children.get(SINGLE_LEVEL)
+            if single is not None:
+                TopicDispatcher.match(single, levels, index + 1, callbacks)
+
+    def dispatch(self, message) -> int:
+        # Calls the callbacks registered for the message's topic. Returns their number
+        callbacks = self.resolve(message.topic)
+        for callback in callbacks:
+            callback(message)
+        return len(callbacks)
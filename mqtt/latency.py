@@ -0,0 +1,308 @@
+'''
+Latency tracing from the CAN/OBD sample to the MQTT send and acknowledgement.
+
+Every telemetry value carries monotonic timestamps through the pipeline:
+    received   the sample left the bus (CAN kernel timestamp or OBD response time)
+    decoded    the CAN frame was decoded (the enqueue time for OBD values)
+    enqueued   PublishPipeline.update accepted the value
+    published  the coalesced payload was handed to paho
+    acked      paho's on_publish fired (PUBACK for QoS > 0, socket write for QoS 0)
+The received time is a wall clock timestamp mapped to the monotonic clock
+once, when the frame is decoded: only the ingest (and end to end) stage
+depends on that mapping, decode_to_publish and the later stages are
+measured on the monotonic clock alone.
+The stage durations are recorded in HDR-style histograms, per signal and
+over all signals, and reported periodically on <id>/metrics and on a local
+HTTP endpoint. A dashboard showing stale values can then tell whether the
+delay is the bus/loop (ingest), the listeners (enqueue), the publish window
+(queue) or the network (ack).
+'''
+
+import json
+import math
+import time
+import threading
+import logging
+import paho.mqtt.client as mqtt
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+logger = logging.getLogger(__name__)
+
+# Config keywords
+METRICS_STR = "Metrics"
+INTERVAL_STR = "interval"
+TOPIC_STR = "topic"
+HTTP_HOST_STR = "http_host"
+HTTP_PORT_STR = "http_port"
+PER_SIGNAL_STR = "per_signal"
+
+DEFAULT_INTERVAL = 10.0  # seconds
+DEFAULT_TOPIC_SUFFIX = "/metrics"
+DEFAULT_HTTP_HOST = "127.0.0.1"
+
+# Stages
+INGEST = "ingest"                        # received -> decoded
+ENQUEUE = "enqueue"                      # decoded -> enqueued
+QUEUE = "queue"                          # enqueued -> published
+DECODE_TO_PUBLISH = "decode_to_publish"  # decoded -> published
+ACK = "ack"                              # published -> acked
+END_TO_END = "end_to_end"                # received -> published
+STAGES = (INGEST, ENQUEUE, QUEUE, DECODE_TO_PUBLISH, ACK, END_TO_END)
+
+# Histogram range and precision: 16 linear sub-buckets per power of two
+# (<= 6.25% relative error) from 1us up to 2^30 us (~18 min)
+LOWEST_VALUE = 1e-6  # seconds
+SUB_BUCKET_BITS = 4
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+OCTAVES = 30
+QUANTILES = (0.5, 0.9, 0.99)
+# Bound of the payloads waiting for their acknowledgement
+MAX_PENDING_ACKS = 10000
+# Payloads not acknowledged within this time (e.g. lost with the connection)
+# are dropped at report time and counted as ack_expired. paho reuses mids
+# after 65535 messages, so stale entries would give wrong ack times
+ACK_EXPIRY = 60.0  # seconds
+
+
+def monotonic_from_wall(wall_time, now_monotonic=None, now_wall=None):
+    # Maps a time.time() timestamp (e.g. a CAN kernel timestamp) to time.monotonic()
+    if now_monotonic is None:
+        now_monotonic = time.monotonic()
+    if now_wall is None:
+        now_wall = time.time()
+    return now_monotonic - (now_wall - wall_time)
+
+
+class LatencyHistogram:
+    '''
+    Log-linear histogram of durations in seconds, in the spirit of HdrHistogram:
+    fixed memory, O(1) recording and bounded relative error
+    '''
+
+    __slots__ = ("counts", "count", "total", "min", "max")
+
+    def __init__(self):
+        self.counts = [0] * (OCTAVES * SUB_BUCKETS)
+        self.reset()
+
+    def reset(self):
+        for index in range(len(self.counts)):
+            self.counts[index] = 0
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = 0.0
+
+    @staticmethod
+    def bucket_index(value):
+        # Octave 0 counts [0, 16) us in 1us steps, octave n >= 1 counts
+        # [16, 32) << (n - 1) us in steps of 2^(n - 1) us
+        units = int(value / LOWEST_VALUE)
+        if units < SUB_BUCKETS:
+            return max(units, 0)
+        shift = units.bit_length() - SUB_BUCKET_BITS - 1
+        if shift + 1 >= OCTAVES:
+            return OCTAVES * SUB_BUCKETS - 1
+        return (shift + 1) * SUB_BUCKETS + (units >> shift) - SUB_BUCKETS
+
+    @staticmethod
+    def bucket_upper_bound(index):
+        # Upper bound (s) of the values counted in bucket `index`
+        octave, sub_bucket = divmod(index, SUB_BUCKETS)
+        if octave == 0:
+            return (sub_bucket + 1) * LOWEST_VALUE
+        return ((sub_bucket + SUB_BUCKETS + 1) << (octave - 1)) * LOWEST_VALUE
+
+    def record(self, value):
+        if value < 0:
+            value = 0.0
+        self.counts[LatencyHistogram.bucket_index(value)] += 1
+        self.count += 1
+        self.total += value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, quantile):
+        if self.count == 0:
+            return 0.0
+        target = quantile * self.count
+        cumulative = 0
+        for index, count in enumerate(self.counts):
+            cumulative += count
+            if count > 0 and cumulative >= target:
+                return min(LatencyHistogram.bucket_upper_bound(index), self.max)
+        return self.max
+
+    def as_dict(self):
+        if self.count == 0:
+            return {"count": 0}
+        stats = {"count": self.count,
+                 "min": self.min,
+                 "mean": self.total / self.count,
+                 "max": self.max}
+        for quantile in QUANTILES:
+            stats["p{:g}".format(quantile * 100)] = self.quantile(quantile)
+        return stats
+
+
+class LatencyTracker:
+    '''
+    Collects the stage latencies of a PublishPipeline. Reports cover one
+    interval each: the histograms are reset once they were published
+    '''
+
+    def __init__(self, mqtt_client, metrics_config: dict = None):
+        if metrics_config is None:
+            metrics_config = {}
+        self.mqtt_client = mqtt_client
+        self.interval = metrics_config.get(INTERVAL_STR, DEFAULT_INTERVAL)
+        self.topic = metrics_config.get(TOPIC_STR, None)
+        self.per_signal = metrics_config.get(PER_SIGNAL_STR, True)
+        self.http_host = metrics_config.get(HTTP_HOST_STR, DEFAULT_HTTP_HOST)
+        self.http_port = metrics_config.get(HTTP_PORT_STR, None)
+        self.lock = threading.Lock()
+        self.stages = {stage: LatencyHistogram() for stage in STAGES}
+        self.signals = {}  # key -> end to end LatencyHistogram
+        self.pending_acks = {}  # mid -> published monotonic time
+        self.early_acks = {}  # mid -> acked monotonic time, acked before registered
+        self.counters = {}
+        self.gauges = {}  # name -> last value, e.g. the publish queue depth
+        self.interval_start = time.monotonic()
+        self.last_report = None
+        self.http_server = None
+
+    def get_topic(self):
+        if self.topic is not None:
+            return self.topic
+        return self.mqtt_client.id + DEFAULT_TOPIC_SUFFIX
+
+    def enqueued(self, received, decoded, enqueued):
+        with self.lock:
+            self.stages[INGEST].record(decoded - received)
+            self.stages[ENQUEUE].record(enqueued - decoded)
+
+    def published(self, stamps, published, info=None):
+        # `stamps` maps the published keys to their (received, enqueued, decoded)
+        # times. `info` is the MQTTMessageInfo of the payload, if it was sent
+        with self.lock:
+            for key, (received, enqueued, decoded) in stamps.items():
+                self.stages[QUEUE].record(published - enqueued)
+                self.stages[DECODE_TO_PUBLISH].record(published - decoded)
+                self.stages[END_TO_END].record(published - received)
+                if self.per_signal:
+                    histogram = self.signals.get(key)
+                    if histogram is None:
+                        histogram = self.signals[key] = LatencyHistogram()
+                    histogram.record(published - received)
+            if info is None or info.rc != mqtt.MQTT_ERR_SUCCESS:
+                # Not sent (e.g. while disconnected), on_publish will not follow
+                return
+            acked = self.early_acks.pop(info.mid, None)
+            if acked is not None:
+                self.stages[ACK].record(acked - published)
+            elif len(self.pending_acks) < MAX_PENDING_ACKS:
+                self.pending_acks[info.mid] = published
+
+    def acked(self, mid):
+        # paho on_publish callback (network thread or event loop)
+        now = time.monotonic()
+        with self.lock:
+            published = self.pending_acks.pop(mid, None)
+            if published is not None:
+                self.stages[ACK].record(now - published)
+            elif len(self.early_acks) < MAX_PENDING_ACKS:
+                # The payload may be acknowledged before published() registers it
+                self.early_acks[mid] = now
+
+    def count(self, name, increment=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + increment
+
+    def gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    def expire_pending_acks(self, now):
+        expired = [mid for mid, published in self.pending_acks.items()
+                   if now - published >= ACK_EXPIRY]
+        for mid in expired:
+            del self.pending_acks[mid]
+        if len(expired) > 0:
+            self.counters["ack_expired"] = self.counters.get("ack_expired", 0) + len(expired)
+
+    def report(self, reset: bool = False):
+        now = time.monotonic()
+        with self.lock:
+            self.expire_pending_acks(now)
+            report = {"time": time.time(),
+                      "interval": now - self.interval_start,
+                      "stages": {stage: histogram.as_dict()
+                                 for stage, histogram in self.stages.items()},
+                      "pending_acks": len(self.pending_acks),
+                      "counters": dict(self.counters),
+                      "gauges": dict(self.gauges)}
+            if self.per_signal:
+                report["signals"] = {key: histogram.as_dict()
+                                     for key, histogram in self.signals.items()}
+            if reset:
+                for histogram in self.stages.values():
+                    histogram.reset()
+                for histogram in self.signals.values():
+                    histogram.reset()
+                self.counters = {}
+                self.early_acks.clear()
+                self.interval_start = now
+        return report
+
+    def publish_if_due(self, now=None):
+        # Called from the publish pipeline loop
+        if now is None:
+            now = time.monotonic()
+        if now - self.interval_start < self.interval:
+            return None
+        self.last_report = self.report(reset=True)
+        return self.mqtt_client.publish(self.get_topic(), json.dumps(self.last_report))
+
+    def start_http_server(self):
+        # Serves GET /metrics (current interval) and GET /metrics/last (last published)
+        if self.http_port is None or self.http_server is not None:
+            return
+        tracker = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.rstrip("/") == "/metrics":
+                    body = tracker.report()
+                elif self.path.rstrip("/") == "/metrics/last":
+                    body = tracker.last_report or {}
+                else:
+                    self.send_error(404)
+                    return
+                payload = json.dumps(body).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                logger.debug("Metrics endpoint: " + format % args)
+
+        try:
+            self.http_server = HTTPServer((self.http_host, self.http_port), MetricsHandler)
+        except OSError as error:
+            logger.error("Unable to serve the metrics on {}:{}.\nDetails: {}".format(
+                self.http_host, self.http_port, error))
+            return
+        threading.Thread(target=self.http_server.serve_forever,
+                         name="MetricsEndpoint", daemon=True).start()
+        logger.info("Serving latency metrics on http://{}:{}/metrics".format(
+            self.http_host, self.http_port))
+
+    def stop(self):
+        if self.http_server is not None:
+            self.http_server.shutdown()
+            self.http_server.server_close()
+            self.http_server = None
@@ -1,17 +1,23 @@
 import sys
 import os
 import yaml
+import json
 import time
 import paho.mqtt.client as mqtt
 import threading
 import re
-import logging as logger
+import logging
 import asyncio
 
 from socket import gaierror
+from .publisher import PublishPipeline, PUBLISH_STR
+from .serializer import create_serializer, SERIALIZER_STR, SCHEMA_STR, SCHEMA_ID_STR, \
+    FIELD_TYPE_STR, NAME_STR as FIELD_NAME_STR
+from . import offline_queue
+from .dispatcher import TopicDispatcher, PATTERN_TYPE
+from .latency import LatencyTracker, METRICS_STR
 
-
-logger.getLogger().setLevel(logger.DEBUG)
+logger = logging.getLogger(__name__)
 
 # Config keywords
 BROKER_STR = 'Broker'
@@ -26,6 +32,18 @@ PUB_TOPICS_STR = "pub_topics"
 NAME_STR = "name"
 QOS_STR = "qos"
 HEARTBEAT_PERIOD_STR = "heartbeat_period"
+REMOTE_CONFIG_STR = "remote_config"
+# Runs the client on the CAN listener's event loop, see async_client.py
+ASYNCIO_STR = "asyncio"
+# Section of the window aggregator (aggregator.py). The aggregator pulls in
+# numpy, so it is only imported if the section is configured
+AGGREGATE_STR = "Aggregate"
+# Sections that are only applied when the client is recreated
+RESTART_SECTIONS = [BROKER_STR, SERIALIZER_STR, METRICS_STR, AGGREGATE_STR,
+                    offline_queue.OFFLINE_QUEUE_STR]
+CONFIG_TOPIC_SUFFIX = "/config/+"
+# Retained binary schemas, see MqttClient.publish_schemas
+SCHEMA_TOPIC_SUFFIX = "/schema/"
 
 MQTT_CONFIG_FILEPATH = os.path.dirname(
     os.path.realpath(__file__)) + "/config_mqtt.yaml"
@@ -76,10 +94,39 @@ class MqttClient:
                 self.init_attributes_default()
         else:
             self.init_attributes_default()
+        self.config = mqtt_config
+        self.config_topic = None  # Subscribed by enable_remote_config
         # Regex can be used if custom message->action mechanism are desired
         # self.topic_func_map = {re.compile(".*/add_sub_topic"): self.add_sub_topic}
         self.is_connected = False
-        self.topic_func_map = {re.compile(".*/location"): [self.location_cb]}
+        # Set once the broker accepted the first connection, see wait_connected
+        self.connected_event = threading.Event()
+        self.heartbeat_timer = None
+        self.shutting_down = False
+        self.dispatcher = TopicDispatcher()
+        self.dispatcher.register(re.compile(".*/location"), self.location_cb)
+        # Coalesces telemetry updates into one message per publish window
+        publish_config = mqtt_config.get(PUBLISH_STR) if mqtt_config else None
+        serializer_config = mqtt_config.get(SERIALIZER_STR) if mqtt_config else None
+        # Applied on restart only, see set_schema
+        self.serializer_config = serializer_config or {}
+        self.schema = None
+        self.schema_lock = threading.Lock()
+        # Latency of the published values is traced if a Metrics section is configured
+        metrics_config = mqtt_config.get(METRICS_STR) if mqtt_config else None
+        self.latency = LatencyTracker(self, metrics_config) if metrics_config is not None else None
+        self.publisher = PublishPipeline(
+            self, publish_config, create_serializer(serializer_config), self.latency)
+        # Window statistics of the published values, if an Aggregate section is configured
+        aggregate_config = mqtt_config.get(AGGREGATE_STR) if mqtt_config else None
+        self.aggregator = None
+        if aggregate_config is not None:
+            from .aggregator import WindowAggregator
+            self.aggregator = WindowAggregator(
+                self, aggregate_config, create_serializer(serializer_config))
+        # Messages published while disconnected are written to disk, if configured
+        self.init_offline_queue(
+            mqtt_config.get(offline_queue.OFFLINE_QUEUE_STR) if mqtt_config else None)
 
     def init_attributes_default(self):
         self.host = None
@@ -91,8 +138,76 @@ class MqttClient:
         self.pub_topics = []
         self.hb_period = 15
 
+    def init_offline_queue(self, queue_config: dict = None):
+        self.offline_queue = None
+        self.drain_thread = None
+        if queue_config is None or queue_config.get(offline_queue.PATH_STR) is None:
+            return
+        self.drain_batch_size = queue_config.get(
+            offline_queue.BATCH_SIZE_STR, offline_queue.DEFAULT_BATCH_SIZE)
+        self.drain_interval = queue_config.get(
+            offline_queue.DRAIN_INTERVAL_STR, offline_queue.DEFAULT_DRAIN_INTERVAL)
+        try:
+            self.offline_queue = offline_queue.OfflineQueue(
+                queue_config[offline_queue.PATH_STR],
+                queue_config.get(offline_queue.SIZE_MB_STR,
+                                 offline_queue.DEFAULT_SIZE_MB),
+                queue_config.get(offline_queue.SYNC_EVERY_STR, offline_queue.DEFAULT_SYNC_EVERY))
+        except (OSError, ValueError) as error:
+            logger.error(
+                "Unable to open the offline queue. Messages published while disconnected will be lost.\nDetails: {}".format(error))
+
+    def start_draining(self):
+        if self.offline_queue is None or len(self.offline_queue) == 0:
+            return
+        if self.drain_thread is not None and self.drain_thread.is_alive():
+            return
+        self.drain_thread = threading.Thread(
+            target=self.drain_offline_queue, name="OfflineQueueDrain", daemon=True)
+        self.drain_thread.start()
+
+    def drain_offline_queue(self):
+        logger.info("Draining {} messages from the offline queue".format(
+            len(self.offline_queue)))
+        while self.is_connected and len(self.offline_queue) > 0:
+            batch = self.publish_offline_batch()
+            if batch is None:
+                break
+            infos, end_index = batch
+            for info in infos:
+                info.wait_for_publish()
+            self.offline_queue.commit(end_index)
+            time.sleep(self.drain_interval)
+
+    def publish_offline_batch(self):
+        # Sends the next batch of queued messages. Consecutive messages of the same
+        # topic are packed into a single message published to <topic>/batch.
+        # Returns the message infos and the index to commit once they are sent
+        records, end_index = self.offline_queue.peek(self.drain_batch_size)
+        if len(records) == 0:
+            return None
+        groups = []
+        for topic, payload, qos in records:
+            if len(groups) > 0 and groups[-1][0] == topic and groups[-1][1] == qos:
+                groups[-1][2].append(payload)
+            else:
+                groups.append((topic, qos, [payload]))
+        infos = []
+        for topic, qos, payloads in groups:
+            if len(payloads) == 1:
+                infos.append(self.client.publish(topic, payloads[0], qos=qos))
+            else:
+                infos.append(self.client.publish(
+                    topic + "/batch", offline_queue.pack_payloads(payloads), qos=qos))
+        if any(info.rc != mqtt.MQTT_ERR_SUCCESS for info in infos):
+            logger.warning("Connection lost while draining the offline queue")
+            return None
+        return infos, end_index
+
     def on_connect(self, client, userdata, flags, rc):
         self.is_connected = True
+        self.connected_event.set()
+        self.publisher.reset_in_flight()
         logger.info("Client connected to the broker {}".format(self.host))
         # Subscribing in on_connect() means that if we lose the connection and reconnect then
         # subscriptions will be renewed
@@ -102,68 +217,117 @@ class MqttClient:
             self.client.subscribe(sub_topic)
         self.client.publish(self.id + "/message", "Greetings from AVL RPi")
         self.heartbeat()
+        self.publish_schemas()
+        self.start_draining()
+
+    def wait_connected(self, timeout: float = None) -> bool:
+        # For connect() running on another thread, e.g. in parallel with the OBD setup
+        self.connected_event.wait(timeout)
+        return self.is_connected
 
     def on_disconnect(self, client, userdata, rc=0):
         self.is_connected = False
         logger.info("Disconnecting with result code: {}".format(rc))
-        client.loop_stop()
+        # Let the network loop reconnect unless the disconnect was requested
+        if rc == 0:
+            client.loop_stop()
 
     def on_message(self, client, userdata, message):
-        logger.info(
-            "Incoming message: Topic: {} - Payload: {}".format(message.topic, message.payload))
-
-        for topic_re in self.topic_func_map:
-            if topic_re.match(message.topic) is not None:
-                # Iterate through all the registered callbacks of the corresponding
-                # regex-topic
-                for callback in self.topic_func_map[topic_re]:
-                    callback(message)
-            else:
-                logger.info("{} does not match {}".format(
-                    topic_re, message.topic))
+        logger.debug("Incoming message: Topic: %s - Payload: %s", message.topic, message.payload)
+
+        self.dispatcher.dispatch(message)
+
+    def on_publish(self, client, userdata, mid):
+        if self.latency is not None:
+            self.latency.acked(mid)
 
     def heartbeat(self):
+        if self.shutting_down:
+            return
         logger.info("### Heartbeat ###")
         self.client.publish(self.id + "/heartbeat", "ON", retain=True)
-        threading.Timer(self.hb_period, self.heartbeat).start()
-
-    def publish(self, topic, payload, qos: int = 0) -> mqtt.MQTTMessageInfo:
+        # A reconnect restarts the heartbeat, so the previous timer is replaced.
+        # Daemon timers do not keep the process alive on shutdown
+        if self.heartbeat_timer is not None:
+            self.heartbeat_timer.cancel()
+        self.heartbeat_timer = threading.Timer(self.hb_period, self.heartbeat)
+        self.heartbeat_timer.daemon = True
+        self.heartbeat_timer.start()
+
+    def publish(self, topic, payload, qos: int = 0, retain: bool = False) -> mqtt.MQTTMessageInfo:
         if topic is None:
             return
-        return self.client.publish(topic=topic, payload=payload, qos=qos)
+        if not self.is_connected and self.offline_queue is not None:
+            # Retained messages are republished on connect instead (e.g. the schemas)
+            if not retain:
+                self.offline_queue.append(topic, payload, qos)
+            return None
+        return self.client.publish(topic=topic, payload=payload, qos=qos, retain=retain)
+
+    def uses_schema(self) -> bool:
+        # True if the payloads are binary, see set_schema
+        return hasattr(self.publisher.serializer, "set_schema")
+
+    def set_schema(self, field_types: dict):
+        '''
+        Sets the binary schema (if any) of the published values and of their
+        window statistics, given the field type of every published key (see
+        serializer.py). The fields of the Serializer config come first, in
+        their order, the other keys follow sorted by name: the same configs
+        always give the same schema id, whatever the order they are read in.
+        Changed schemas are published, see publish_schemas
+        '''
+        if not self.uses_schema():
+            return
+        schema = [field if isinstance(field, dict) else {FIELD_NAME_STR: field}
+                  for field in self.serializer_config.get(SCHEMA_STR) or []]
+        configured = set(field[FIELD_NAME_STR] for field in schema)
+        schema += [{FIELD_NAME_STR: name, FIELD_TYPE_STR: field_types[name]}
+                   for name in sorted(field_types) if name not in configured]
+        with self.schema_lock:
+            if schema == self.schema:
+                return
+            self.schema = schema
+            self.publisher.set_schema(schema)
+            if self.aggregator is not None:
+                self.aggregator.set_schema(schema)
+        logger.info("Binary schema set: {} fields".format(len(schema)))
+        self.publish_schemas()
+
+    def publish_schemas(self):
+        # Publishes the schemas retained on <id>/schema/<schema id>, so that
+        # the backend can look up the schema of any payload it receives
+        if not self.is_connected or not self.uses_schema():
+            return
+        serializer_list = [self.publisher.serializer]
+        if self.aggregator is not None:
+            serializer_list.append(self.aggregator.serializer)
+        for serializer in serializer_list:
+            description = serializer.describe()
+            self.publish(self.id + SCHEMA_TOPIC_SUFFIX + description[SCHEMA_ID_STR],
+                         json.dumps(description), qos=1, retain=True)
 
     # Registers a callback to the specified topic. When a message having the specified
-    # topic arrives, the callback will be called.
-    def register_cb(self, _sub_topic: re._pattern_type or str, callback) -> bool:
-        # Temporary solution. TODO Decide whether to use regex, str or both
-        if not isinstance(_sub_topic, re._pattern_type):
-            _sub_topic = re.compile(_sub_topic)
-        # if the given sub_topic is a regex check if any of the subscribed topics is a match for
-        # the regex, warn otherwise
-        if isinstance(_sub_topic, re._pattern_type):
+    # topic arrives, the callback will be called. `_sub_topic` can be a regex (compiled or
+    # a string containing regex characters) or an MQTT topic filter with +/# wildcards.
+    def register_cb(self, _sub_topic: PATTERN_TYPE or str, callback) -> bool:
+        if TopicDispatcher.is_regex(_sub_topic):
+            if not isinstance(_sub_topic, PATTERN_TYPE):
+                _sub_topic = re.compile(_sub_topic)
+            # check if any of the subscribed topics is a match for the regex, warn otherwise
             matched_topics = list(
                 filter(lambda topic: _sub_topic.match(topic), self.sub_topics))
-            if len(matched_topics) is 0:
-                logger.warning("Registering a callback that is not in the subscribed topics. sub_topics: {}, sub_topic: {}".format(
-                    self.sub_topics, _sub_topic))
-                return False
-        # this condition will never hold True as we are converting str to regex
-        # TODO either remove or allow str arguments
-        elif isinstance(_sub_topic, str):
-            if _sub_topic not in self.sub_topics:
-                logger.warning("Registering a callback that is not in the subscribed topics. sub_topics: {}, sub_topic: {}".format(
-                    self.sub_topics, _sub_topic))
-                return False
-
-        # Create the callback list if it does not exist. Append otherwise
-        if _sub_topic not in self.topic_func_map:
-            self.topic_func_map[_sub_topic] = [callback]
-        # if the given regex-topic exists in the topic_func_map, its corresponding value
-        # should be always a list of callbacks. TODO Can it be None? Should we check or skip?
-        elif self.topic_func_map[_sub_topic] is None:
-            self.topic_func_map[_sub_topic] = [callback]
         else:
-            self.topic_func_map[_sub_topic].append(callback)
+            matched_topics = list(filter(lambda topic: topic == _sub_topic or
+                                         mqtt.topic_matches_sub(topic, _sub_topic) or
+                                         mqtt.topic_matches_sub(_sub_topic, topic), self.sub_topics))
+        if len(matched_topics) == 0:
+            logger.warning("Registering a callback that is not in the subscribed topics. sub_topics: {}, sub_topic: {}".format(
+                self.sub_topics, _sub_topic))
+            return False
+
+        self.dispatcher.register(_sub_topic, callback)
+        return True
 
     def add_sub_topic(self, _topic):
         logger.info("Subscribing to {}".format(_topic))
@@ -178,6 +342,70 @@ class MqttClient:
                 _topic, valueErr))
             pass
 
+    def reload(self, mqtt_config: dict) -> bool:
+        # Applies a changed config while connected: subscriptions are diffed, the
+        # publish pipeline is reconfigured. Returns False if nothing changed
+        if not mqtt_config or mqtt_config == self.config:
+            return False
+        old_config = self.config or {}
+        client_config = mqtt_config.get(CLIENT_STR) or {}
+        restart_sections = [section for section in RESTART_SECTIONS
+                            if mqtt_config.get(section) != old_config.get(section)]
+        if client_config.get(ID_STR, self.id) != self.id:
+            restart_sections.append(CLIENT_STR + "/" + ID_STR)
+        if len(restart_sections) > 0:
+            logger.warning("MQTT config changes of {} are applied on restart".format(restart_sections))
+        sub_topics = client_config.get(SUB_TOPICS_STR, self.sub_topics)
+        added = [topic for topic in sub_topics if topic not in self.sub_topics]
+        removed = [topic for topic in self.sub_topics
+                   if topic not in sub_topics and topic != self.config_topic]
+        logger.info("Reloading MQTT config. Subscribing to: {}, unsubscribing from: {}".format(
+            added, removed))
+        self.sub_topics = [topic for topic in self.sub_topics if topic not in removed] + added
+        if self.is_connected:
+            for topic in added:
+                self.client.subscribe(topic)
+            for topic in removed:
+                self.client.unsubscribe(topic)
+        self.pub_topics = client_config.get(PUB_TOPICS_STR, self.pub_topics)
+        self.hb_period = client_config.get(HEARTBEAT_PERIOD_STR, self.hb_period)
+        self.publisher.configure(mqtt_config.get(PUBLISH_STR))
+        self.config = mqtt_config
+        return True
+
+    def remote_config_enabled(self) -> bool:
+        return bool(((self.config or {}).get(CLIENT_STR) or {}).get(REMOTE_CONFIG_STR, False))
+
+    def enable_remote_config(self, handlers: dict):
+        # Applies configs published (as YAML) to <id>/config/<name> by calling
+        # handlers[name](config), e.g. {"mqtt": mqtt_client.reload}
+        self.config_topic = self.id + CONFIG_TOPIC_SUFFIX
+        self.config_handlers = handlers
+        if self.config_topic not in self.sub_topics:
+            self.sub_topics.append(self.config_topic)
+            if self.is_connected:
+                self.client.subscribe(self.config_topic)
+        self.dispatcher.register(self.config_topic, self.remote_config_cb)
+
+    def remote_config_cb(self, message):
+        name = message.topic.rsplit("/", 1)[-1]
+        handler = self.config_handlers.get(name)
+        if handler is None:
+            logger.warning("No config handler for {}".format(message.topic))
+            return
+        try:
+            config = yaml.safe_load(message.payload)
+        except yaml.YAMLError as error:
+            logger.warning("Remote config of {} is not applied.\nDetails: {}".format(name, error))
+            return
+        if not isinstance(config, dict):
+            logger.warning("Remote config of {} is not a mapping, not applied".format(name))
+            return
+        try:
+            handler(config)
+        except Exception as exc:
+            logger.error("Error while applying the remote config of {}.\nDetails: {}".format(name, exc))
+
     # DEMO. To check if subscribed message - callback registering is working.
     def location_cb(self, message):
         logger.info(
@@ -193,14 +421,28 @@ class MqttClient:
     '''
 
     def connect(self, will="will not defined"):
+        self.create_client(will)
+        self.connect_to_broker()
+        # self.client.loop_forever()
+        self.client.loop_start()
+        self.publisher.start()
+        if self.aggregator is not None:
+            self.aggregator.start()
+        if self.latency is not None:
+            self.latency.start_http_server()
+
+    def create_client(self, will="will not defined"):
         self.client = mqtt.Client(self.id)
         self.client.on_connect = self.on_connect
         self.client.on_disconnect = self.on_disconnect
         self.client.on_message = self.on_message  # MqttClient.on_message
+        self.client.on_publish = self.on_publish
         self.client.username_pw_set(self.uname, self.password)
         if will is not None:
             logger.info("Setting will of the client: {}".format(will))
             self.client.will_set("will", payload=will, qos=2, retain=False)
+
+    def connect_to_broker(self):
         conn_status = -1
         try:
             conn_status = self.client.connect(self.host, self.port)
@@ -213,12 +455,34 @@ class MqttClient:
                 self.host, conn_status, value_err))
             terminate(value_err)
 
-        # self.client.loop_forever()
-        self.client.loop_start()
-
-    def shut_down(self):
+    def publish_value(self, key, value, received=None):
+        # Queues a telemetry value for the next coalesced publish. `received` is
+        # the monotonic time the value was sampled (see latency.monotonic_from_wall)
+        if self.aggregator is not None:
+            self.aggregator.add(key, value)
+        return self.publisher.update(key, value, received)
+
+    def shut_down(self, drain_timeout: float = None):
+        # Publishes the pending values and, if `drain_timeout` is given, waits up
+        # to that long for the broker to acknowledge them before disconnecting
+        self.shutting_down = True
+        if self.heartbeat_timer is not None:
+            self.heartbeat_timer.cancel()
+            self.heartbeat_timer = None
+        info = self.publisher.stop()
+        if self.aggregator is not None:
+            self.aggregator.stop()
+        if self.latency is not None:
+            self.latency.stop()
+        if drain_timeout is not None and info is not None and self.is_connected:
+            try:
+                info.wait_for_publish(drain_timeout)
+            except (RuntimeError, ValueError) as error:
+                logger.warning("Pending values were not published.\nDetails: {}".format(error))
         self.client.loop_stop()
         self.client.disconnect()
+        if self.offline_queue is not None:
+            self.offline_queue.close()
 
 
 class MqttTest:
@@ -244,6 +508,7 @@ def test_mqtt_registration(mqtt_client: MqttClient):
 
 if __name__ == "__main__":
     import argparse
+    logging.basicConfig(level=logging.DEBUG)
     parser = argparse.ArgumentParser()
     parser.add_argument("-id", "--id", default=None)
     args = vars(parser.parse_args())
@@ -0,0 +1,253 @@
+'''
+Durable store-and-forward queue for messages published while the broker is
+unreachable. Messages are appended to a fixed size, memory-mapped ring buffer
+file (e.g. on the SD card) and the oldest ones are evicted once it is full.
+
+File layout:
+    [0, HEADER_SIZE)         two header slots written alternately. On open,
+                             the valid slot with the highest sequence wins
+    [HEADER_SIZE, size)      ring of records:
+                             u32 length, u32 crc32, u16 topic length, u8 qos,
+                             topic, payload
+A u32 WRAP_MARKER (or too little room for a record header) at the end of the
+ring means the next record starts at the beginning of the ring.
+'''
+
+import os
+import mmap
+import struct
+import zlib
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Config keywords
+OFFLINE_QUEUE_STR = "OfflineQueue"
+PATH_STR = "path"
+SIZE_MB_STR = "size_mb"
+BATCH_SIZE_STR = "batch_size"
+DRAIN_INTERVAL_STR = "drain_interval"
+SYNC_EVERY_STR = "sync_every"
+
+DEFAULT_SIZE_MB = 16
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_DRAIN_INTERVAL = 0.5  # seconds
+DEFAULT_SYNC_EVERY = 1
+
+MAGIC = b"PCQ1"
+HEADER_SIZE = 4096
+# magic, capacity, sequence, head, tail, count, head index, crc32
+HEADER_STRUCT = struct.Struct("<4sQQQQQQI")
+HEADER_SLOT_SIZE = 64
+RECORD_STRUCT = struct.Struct("<IIHB")
+WRAP_MARKER = 0xFFFFFFFF
+
+
+class OfflineQueue:
+    def __init__(self, path, size_mb=DEFAULT_SIZE_MB, sync_every=DEFAULT_SYNC_EVERY):
+        self.path = path
+        self.capacity = int(size_mb * 1024 * 1024) - HEADER_SIZE
+        if self.capacity < RECORD_STRUCT.size:
+            raise ValueError("Offline queue size is too small: {} MB".format(size_mb))
+        self.sync_every = max(1, sync_every)
+        self.lock = threading.Lock()
+        self.sequence = 0
+        self.head = 0
+        self.tail = 0
+        self.count = 0
+        self.head_index = 0  # Number of records removed since the file was created
+        self.unsynced = 0
+        self.evicted_count = 0
+        self.open()
+
+    def open(self):
+        exists = os.path.exists(self.path)
+        self.file = open(self.path, "r+b" if exists else "w+b")
+        size = HEADER_SIZE + self.capacity
+        if os.fstat(self.file.fileno()).st_size != size:
+            if exists:
+                logger.warning("Offline queue {} has a different size. Discarding it".format(
+                    self.path))
+            self.file.truncate(size)
+            exists = False
+        self.buffer = mmap.mmap(self.file.fileno(), size)
+        if exists and self.read_header():
+            self.recover()
+        else:
+            self.write_header()
+        logger.info("Offline queue {} opened with {} pending messages".format(
+            self.path, self.count))
+
+    def close(self):
+        with self.lock:
+            self.buffer.flush()
+            self.buffer.close()
+            self.file.close()
+
+    # Header
+    def read_header(self):
+        best = None
+        for slot in range(2):
+            offset = slot * HEADER_SLOT_SIZE
+            fields = HEADER_STRUCT.unpack_from(self.buffer, offset)
+            crc = zlib.crc32(self.buffer[offset:offset + HEADER_STRUCT.size - 4])
+            if fields[0] != MAGIC or fields[1] != self.capacity or fields[7] != crc:
+                continue
+            if best is None or fields[2] > best[2]:
+                best = fields
+        if best is None:
+            logger.warning("No valid header in offline queue {}. Starting empty".format(
+                self.path))
+            return False
+        _, _, self.sequence, self.head, self.tail, self.count, self.head_index, _ = best
+        return True
+
+    def write_header(self):
+        self.sequence += 1
+        offset = (self.sequence % 2) * HEADER_SLOT_SIZE
+        HEADER_STRUCT.pack_into(self.buffer, offset, MAGIC, self.capacity, self.sequence,
+                                self.head, self.tail, self.count, self.head_index, 0)
+        crc = zlib.crc32(self.buffer[offset:offset + HEADER_STRUCT.size - 4])
+        struct.pack_into("<I", self.buffer, offset + HEADER_STRUCT.size - 4, crc)
+        self.unsynced += 1
+        if self.unsynced >= self.sync_every:
+            self.buffer.flush()
+            self.unsynced = 0
+
+    def recover(self):
+        # Walks the records from head to tail and truncates the queue at the
+        # first corrupted record (e.g. torn write during a power loss)
+        position = self.head
+        for index in range(self.count):
+            record = self.read_record(position)
+            if record is None:
+                logger.warning("Offline queue {} is corrupted after {} records. Truncating".format(
+                    self.path, index))
+                self.tail = position
+                self.count = index
+                self.write_header()
+                return
+            position = record[0]
+
+    # Records
+    def record_start(self, position):
+        if self.capacity - position < RECORD_STRUCT.size:
+            return 0
+        length = struct.unpack_from("<I", self.buffer, HEADER_SIZE + position)[0]
+        return 0 if length == WRAP_MARKER else position
+
+    def read_record(self, position):
+        # Returns (next position, topic, payload, qos) or None if invalid
+        position = self.record_start(position)
+        offset = HEADER_SIZE + position
+        length, crc, topic_length, qos = RECORD_STRUCT.unpack_from(self.buffer, offset)
+        end = position + RECORD_STRUCT.size + length
+        if end > self.capacity or topic_length > length:
+            return None
+        data = self.buffer[offset + RECORD_STRUCT.size:HEADER_SIZE + end]
+        if zlib.crc32(data) != crc:
+            return None
+        topic = data[:topic_length].decode("utf-8")
+        return end, topic, data[topic_length:], qos
+
+    def fits(self, length):
+        # Returns the position where a record of `length` bytes can be written
+        if self.count == 0:
+            self.head = self.tail = 0
+            return 0
+        if self.tail > self.head:
+            if self.capacity - self.tail >= length:
+                return self.tail
+            return 0 if self.head >= length else None
+        if self.tail < self.head and self.head - self.tail >= length:
+            return self.tail
+        return None
+
+    def evict_one(self):
+        record = self.read_record(self.head)
+        if record is None:
+            # Corrupted ring, none of the remaining records can be trusted
+            self.head_index += self.count
+            self.count = 0
+        else:
+            self.count -= 1
+            self.head_index += 1
+            self.head = record[0]
+        if self.count == 0:
+            self.head = self.tail = 0
+
+    def append(self, topic, payload, qos=0):
+        topic = topic.encode("utf-8")
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        elif payload is None:
+            payload = b""
+        elif not isinstance(payload, (bytes, bytearray)):
+            payload = str(payload).encode("utf-8")
+        length = RECORD_STRUCT.size + len(topic) + len(payload)
+        if length > self.capacity // 2:
+            logger.warning("Message of {} bytes does not fit into the offline queue".format(length))
+            return False
+        with self.lock:
+            position = self.fits(length)
+            while position is None:
+                self.evict_one()
+                self.evicted_count += 1
+                position = self.fits(length)
+            if position == 0 and self.tail != 0 and self.capacity - self.tail >= 4:
+                struct.pack_into("<I", self.buffer, HEADER_SIZE + self.tail, WRAP_MARKER)
+            data = topic + payload
+            offset = HEADER_SIZE + position
+            RECORD_STRUCT.pack_into(self.buffer, offset, len(data), zlib.crc32(data),
+                                    len(topic), qos)
+            self.buffer[offset + RECORD_STRUCT.size:offset + length] = data
+            self.tail = position + length
+            self.count += 1
+            self.write_header()
+        return True
+
+    def peek(self, max_records):
+        # Returns ([(topic, payload, qos)], end index). Pass the end index to
+        # commit() once the records are delivered
+        with self.lock:
+            records = []
+            position = self.head
+            for _ in range(min(max_records, self.count)):
+                record = self.read_record(position)
+                if record is None:
+                    break
+                position = record[0]
+                records.append(record[1:])
+            return records, self.head_index + len(records)
+
+    def commit(self, end_index):
+        # Removes the records up to `end_index` unless they were evicted already
+        with self.lock:
+            while self.head_index < end_index and self.count > 0:
+                self.evict_one()
+            self.write_header()
+
+    def __len__(self):
+        return self.count
+
+
+def pack_payloads(payloads) -> bytes:
+    # Frames several payloads into one message: u32 count, then u32 length + bytes each
+    buffer = bytearray(struct.pack("<I", len(payloads)))
+    for payload in payloads:
+        buffer += struct.pack("<I", len(payload))
+        buffer += payload
+    return bytes(buffer)
+
+
+def unpack_payloads(message: bytes):
+    count = struct.unpack_from("<I", message)[0]
+    position = 4
+    payloads = []
+    for _ in range(count):
+        length = struct.unpack_from("<I", message, position)[0]
+        position += 4
+        payloads.append(message[position:position + length])
+        position += length
+    return payloads
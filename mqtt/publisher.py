@@ -0,0 +1,312 @@
+import time
+import asyncio
+import threading
+import logging
+import paho.mqtt.client as mqtt
+
+from .serializer import JsonSerializer
+from . import work_queue
+
+logger = logging.getLogger(__name__)
+
+# Config keywords
+PUBLISH_STR = "Publish"
+WINDOW_STR = "window"
+TOPIC_STR = "topic"
+DEADBAND_STR = "deadband"
+MAX_RATE_STR = "max_rate"
+DEFAULT_STR = "default"
+QOS_STR = "qos"
+QUEUE_SIZE_STR = "queue_size"
+OVERFLOW_STR = "overflow"
+MAX_IN_FLIGHT_STR = "max_in_flight"
+
+DEFAULT_WINDOW = 1.0  # seconds
+DEFAULT_TOPIC_SUFFIX = "/telemetry"
+DEFAULT_MAX_IN_FLIGHT = 10
+
+
+class PublishPipeline:
+    '''
+    Coalesces value updates (OBD responses, CAN signals) and publishes them as
+    a single payload per window instead of one MQTT message per update.
+    Updates are dropped if they are within the key's deadband of the last
+    published value and a key is published at most `max_rate` times per second.
+    If a LatencyTracker is given, the receive/enqueue/publish times of the
+    values are traced (see latency.py).
+
+    Updates wait in a bounded queue (see work_queue.py), so the receive
+    callbacks never block on the network and memory stays fixed. While
+    `max_in_flight` payloads were handed to paho but not yet sent (QoS 0) or
+    acknowledged (QoS > 0), nothing more is published and the updates keep
+    coalescing, or overflowing, in the queue.
+
+        Publish:
+            window: 1.0
+            queue_size: 1024
+            # coalesce | drop_oldest | drop_newest
+            overflow: coalesce
+            # 0 does not limit the payloads queued in paho
+            max_in_flight: 10
+    '''
+
+    def __init__(self, mqtt_client, publish_config: dict = None, serializer=None,
+                 latency_tracker=None):
+        self.mqtt_client = mqtt_client
+        self.serializer = serializer if serializer is not None else JsonSerializer()
+        self.lock = threading.Lock()
+        self.queue = None
+        self.configure(publish_config)
+
+        self.latency = latency_tracker
+        self.last_sent = {}  # key -> (value, monotonic time)
+        self.last_queued = {}  # key -> (value, monotonic time), deadband reference of the ring queues
+        self.in_flight = []  # MQTTMessageInfo of the payloads not sent yet
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.task = None
+        self.sent_count = 0
+        self.dropped_count = 0
+        self.rate_limited_count = 0
+        self.held_count = 0
+        self.reported_drops = 0
+
+    def configure(self, publish_config: dict = None):
+        # (Re)applies the window, topic, QoS, deadbands, rate limits and queue.
+        # A changed window takes effect after the current one
+        if publish_config is None:
+            publish_config = {}
+        deadband = publish_config.get(DEADBAND_STR, None) or {}
+        max_rate = publish_config.get(MAX_RATE_STR, None) or {}
+        # Compared as normalized, so that invalid values do not replace the queue on every reload
+        queue_size, overflow = work_queue.normalize(
+            publish_config.get(QUEUE_SIZE_STR, work_queue.DEFAULT_QUEUE_SIZE),
+            publish_config.get(OVERFLOW_STR, work_queue.COALESCE))
+        with self.lock:
+            if self.queue is None or queue_size != self.queue.stats.capacity or \
+                    overflow != self.queue.policy:
+                self.replace_queue(work_queue.create_queue(queue_size, overflow))
+            self.max_in_flight = publish_config.get(MAX_IN_FLIGHT_STR, DEFAULT_MAX_IN_FLIGHT)
+            self.window = publish_config.get(WINDOW_STR, DEFAULT_WINDOW)
+            self.topic = publish_config.get(TOPIC_STR, None)
+            self.qos = publish_config.get(QOS_STR, 0)
+            self.default_deadband = deadband.get(DEFAULT_STR, 0)
+            self.deadbands = {key: value for key, value in deadband.items()
+                              if key != DEFAULT_STR}
+            self.default_min_interval = PublishPipeline.min_interval(
+                max_rate.get(DEFAULT_STR, None))
+            self.min_intervals = {key: PublishPipeline.min_interval(value)
+                                  for key, value in max_rate.items() if key != DEFAULT_STR}
+
+    def replace_queue(self, queue):
+        # Moves the queued updates over, the overflow policy of `queue` applies
+        if self.queue is not None:
+            while len(self.queue) > 0:
+                for item in self.queue.take():
+                    queue.put(*item)
+            self.reported_drops = 0
+        self.queue = queue
+
+    @staticmethod
+    def min_interval(max_rate):
+        if max_rate is None or max_rate <= 0:
+            return 0.0
+        return 1.0 / max_rate
+
+    def get_topic(self):
+        if self.topic is not None:
+            return self.topic
+        return self.mqtt_client.id + DEFAULT_TOPIC_SUFFIX
+
+    def set_schema(self, schema: list):
+        # Replaces the binary schema (if any), see MqttClient.set_schema. Keys
+        # that are not in the schema are still published, but less compactly
+        if hasattr(self.serializer, "set_schema"):
+            self.serializer.set_schema(schema)
+
+    def within_deadband(self, key, value):
+        # Coalesced values are compared to the published ones, queued updates
+        # to the previous update since all of them are published
+        last = (self.last_sent if self.queue.keyed else self.last_queued).get(key)
+        if last is None:
+            return False
+        last_value = last[0]
+        deadband = self.deadbands.get(key, self.default_deadband)
+        try:
+            return abs(value - last_value) <= deadband if deadband > 0 else value == last_value
+        except TypeError:
+            # Non numeric values are only compared for equality
+            return value == last_value
+
+    def update(self, key, value, received=None, decoded=None):
+        # `received` is the monotonic time the value was sampled and `decoded`
+        # the one it was decoded at, if known (see latency.py)
+        # Never blocks: a full queue drops an update (see work_queue.py)
+        now = time.monotonic() if self.latency is not None else 0.0
+        if received is None:
+            received = now
+        if decoded is None:
+            decoded = now
+        with self.lock:
+            if self.within_deadband(key, value):
+                self.dropped_count += 1
+                self.queue.discard(key)
+                return False
+            if not self.queue.put(key, value, received, now, decoded):
+                return False
+            if not self.queue.keyed:
+                self.last_queued[key] = (value, now)
+        if self.latency is not None:
+            self.latency.enqueued(received, decoded, now)
+        return True
+
+    def update_many(self, items, received=None, decoded=None):
+        # `items` is an iterable of (key, value) pairs
+        for key, value in items:
+            self.update(key, value, received, decoded)
+
+    def collect(self, now, stamps=None):
+        # Takes the values of one payload whose keys are not rate limited at
+        # `now`. Their latency stamps are written to `stamps`, if given
+        values = {}
+        with self.lock:
+            for key, value, received, enqueued, decoded in self.queue.take():
+                last = self.last_sent.get(key)
+                min_interval = self.min_intervals.get(
+                    key, self.default_min_interval)
+                if last is not None and now - last[1] < min_interval:
+                    if self.queue.keyed:
+                        # Published once the key is no longer rate limited
+                        self.queue.put(key, value, received, enqueued, decoded)
+                    else:
+                        self.rate_limited_count += 1
+                    continue
+                self.last_sent[key] = (value, now)
+                values[key] = value
+                if stamps is not None:
+                    stamps[key] = (received, enqueued, decoded)
+        return values
+
+    @staticmethod
+    def is_sent(info) -> bool:
+        if info.rc != mqtt.MQTT_ERR_SUCCESS:
+            # Not queued by paho, e.g. while disconnected
+            return True
+        return info.is_published()
+
+    def backlogged(self) -> bool:
+        # True while max_in_flight payloads wait in paho for the network
+        if self.max_in_flight is None or self.max_in_flight <= 0:
+            return False
+        self.in_flight = [info for info in self.in_flight if not PublishPipeline.is_sent(info)]
+        return len(self.in_flight) >= self.max_in_flight
+
+    def reset_in_flight(self):
+        # Called on (re)connect: paho discards the QoS 0 payloads of a lost
+        # connection without marking them published
+        self.in_flight = []
+
+    def flush(self):
+        # Publishes the queued values unless paho is backlogged: all of them at
+        # once if coalescing, else one payload per run of distinct keys.
+        # Returns the message info of the last payload
+        info = None
+        # Updates arriving meanwhile wait for the next window
+        for _ in range(len(self.queue)):
+            if len(self.queue) == 0:
+                break
+            if self.backlogged():
+                self.held_count += 1
+                if self.latency is not None:
+                    self.latency.count("held")
+                break
+            stamps = {} if self.latency is not None else None
+            values = self.collect(time.monotonic(), stamps)
+            if len(values) > 0:
+                info = self.publish_values(values, stamps)
+            if self.queue.keyed:
+                break
+        if self.latency is not None:
+            self.report_queue()
+            self.latency.publish_if_due()
+        return info
+
+    def publish_values(self, values, stamps=None):
+        payload = self.serializer.encode(time.time(), values)
+        self.sent_count += 1
+        info = self.mqtt_client.publish(self.get_topic(), payload, self.qos)
+        if info is not None and self.max_in_flight:
+            self.in_flight.append(info)
+        if self.latency is not None:
+            self.latency.published(stamps, time.monotonic(), info)
+            self.latency.count("payloads")
+            self.latency.count("values", len(values))
+        return info
+
+    def report_queue(self):
+        with self.lock:
+            stats = self.queue.as_dict()
+            dropped = self.queue.stats.dropped_count - self.reported_drops
+            self.reported_drops = self.queue.stats.dropped_count
+        if dropped > 0:
+            self.latency.count("queue_dropped", dropped)
+        self.latency.gauge("queue_depth", stats["depth"])
+        self.latency.gauge("queue_max_depth", stats["max_depth"])
+        self.latency.gauge("in_flight", len(self.in_flight))
+
+    def stats(self):
+        with self.lock:
+            stats = {"queue": self.queue.as_dict()}
+        stats.update({"policy": self.queue.policy,
+                      "sent": self.sent_count,
+                      "deadband": self.dropped_count,
+                      "rate_limited": self.rate_limited_count,
+                      "held": self.held_count,
+                      "in_flight": len(self.in_flight)})
+        return stats
+
+    def run(self):
+        while not self.stop_event.wait(self.window):
+            try:
+                self.flush()
+            except Exception as exc:
+                logger.error(
+                    "Error while flushing the publish pipeline.\nDetails: {}".format(exc))
+
+    async def run_async(self):
+        while not self.stop_event.is_set():
+            await asyncio.sleep(self.window)
+            try:
+                self.flush()
+            except Exception as exc:
+                logger.error(
+                    "Error while flushing the publish pipeline.\nDetails: {}".format(exc))
+
+    def start(self, loop: asyncio.AbstractEventLoop = None):
+        # Flushes on a background thread, or as a task of `loop` if given
+        if loop is not None:
+            if self.task is None or self.task.done():
+                self.stop_event.clear()
+                self.task = loop.create_task(self.run_async())
+            return
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(
+            target=self.run, name="PublishPipeline", daemon=True)
+        self.thread.start()
+
+    def stop(self, flush: bool = True):
+        # Returns the message info of the final flush or of the last payload
+        # still in flight, if any
+        self.stop_event.set()
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        info = self.flush() if flush else None
+        if info is None and len(self.in_flight) > 0:
+            info = self.in_flight[-1]
+        return info
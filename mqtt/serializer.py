@@ -0,0 +1,331 @@
+'''
+Telemetry payload serializers. Only depends on the standard library (and
+optionally `zstandard`) so that the backend can import it to decode payloads.
+
+Binary format (all integers little endian):
+    header:  1 byte  (version << 4 | compression)
+             4 bytes crc32 of the schema, to detect mismatching schemas
+    body:    (compressed as a whole if compression != 0)
+             varint  record count
+             per record:
+                 varint  timestamp in ms. Absolute for the first record,
+                         zigzag delta to the previous record otherwise
+                 bitmap  fields of the schema present in the record
+                 values  of the present fields in schema order
+                 varint  number of extra (not in the schema) values
+                 extras  varint name length, name, 1 byte type, value
+
+The schema is derived from the OBD and CAN configs (see
+MqttClient.set_schema) and published retained, as the JSON of describe(), on
+<id>/schema/<schema id as 8 hex digits>. A decoder looks up the schema id of
+a payload there and decodes it with BinarySerializer.from_description.
+'''
+
+import json
+import struct
+import zlib
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Config keywords
+SERIALIZER_STR = "Serializer"
+FORMAT_STR = "format"
+COMPRESSION_STR = "compression"
+SCHEMA_STR = "schema"
+NAME_STR = "name"
+FIELD_TYPE_STR = "type"
+SCALE_STR = "scale"
+SCHEMA_ID_STR = "schema_id"
+FIELDS_STR = "fields"
+
+FORMAT_JSON = "json"
+FORMAT_BINARY = "binary"
+
+VERSION = 1
+COMPRESSION_NONE = 0
+COMPRESSION_ZLIB = 1
+COMPRESSION_ZSTD = 2
+COMPRESSION_IDS = {None: COMPRESSION_NONE, "none": COMPRESSION_NONE,
+                   "zlib": COMPRESSION_ZLIB, "zstd": COMPRESSION_ZSTD}
+
+# Field types. `int` fields are stored as zigzag varints of value / scale
+TYPE_F16 = "f16"
+TYPE_F32 = "f32"
+TYPE_F64 = "f64"
+TYPE_INT = "int"
+TYPE_STR = "str"
+FLOAT_STRUCTS = {TYPE_F16: struct.Struct("<e"),
+                 TYPE_F32: struct.Struct("<f"),
+                 TYPE_F64: struct.Struct("<d")}
+
+EXTRA_FLOAT = 0
+EXTRA_STR = 1
+F64_STRUCT = FLOAT_STRUCTS[TYPE_F64]
+
+
+def write_varint(buffer: bytearray, value: int):
+    while value > 0x7F:
+        buffer.append((value & 0x7F) | 0x80)
+        value >>= 7
+    buffer.append(value)
+
+
+def read_varint(data, pos: int):
+    result = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+def zigzag(value: int) -> int:
+    return value * 2 if value >= 0 else -value * 2 - 1
+
+
+def unzigzag(value: int) -> int:
+    return (value >> 1) ^ -(value & 1)
+
+
+class JsonSerializer:
+    content_type = FORMAT_JSON
+
+    def encode(self, timestamp: float, values: dict) -> bytes:
+        return json.dumps({"ts": round(timestamp, 3), "values": values},
+                          separators=(',', ':'), default=str).encode("utf-8")
+
+    def encode_records(self, records) -> bytes:
+        return json.dumps([{"ts": round(ts, 3), "values": values} for ts, values in records],
+                          separators=(',', ':'), default=str).encode("utf-8")
+
+    def decode(self, payload: bytes):
+        decoded = json.loads(payload)
+        if isinstance(decoded, dict):
+            decoded = [decoded]
+        return [(record["ts"], record["values"]) for record in decoded]
+
+
+class BinarySerializer:
+    content_type = FORMAT_BINARY
+
+    def __init__(self, schema: list = None, compression: str = None):
+        # Held while encoding, so that set_schema never changes a payload midway
+        self.lock = threading.Lock()
+        self.set_schema(schema)
+        if compression not in COMPRESSION_IDS:
+            logger.warning(
+                "Unknown compression {}. Payloads will not be compressed".format(compression))
+            compression = None
+        self.compression = COMPRESSION_IDS[compression]
+        if self.compression == COMPRESSION_ZSTD and zstandard is None:
+            logger.warning("zstandard is not installed. Falling back to zlib")
+            self.compression = COMPRESSION_ZLIB
+
+    def set_schema(self, schema: list = None):
+        # `schema` is a list of field names or {name, type, scale} dicts. Later
+        # duplicates of a name are ignored
+        fields, types, scales, index = [], [], [], {}
+        for field in schema or []:
+            if isinstance(field, str):
+                field = {NAME_STR: field}
+            name = field[NAME_STR]
+            field_type = field.get(FIELD_TYPE_STR, TYPE_F32)
+            if name in index:
+                continue
+            if field_type not in FLOAT_STRUCTS and field_type not in (TYPE_INT, TYPE_STR):
+                raise ValueError("Unknown field type {} of {}".format(field_type, name))
+            index[name] = len(fields)
+            fields.append(name)
+            types.append(field_type)
+            scales.append(field.get(SCALE_STR, 1))
+        with self.lock:
+            self.fields, self.types, self.scales, self.index = fields, types, scales, index
+            self.cached_schema_id = None
+
+    def describe(self) -> dict:
+        # The schema as published on <id>/schema/<schema id>
+        with self.lock:
+            return {SCHEMA_ID_STR: "{:08x}".format(self.schema_id()),
+                    FIELDS_STR: [{NAME_STR: name, FIELD_TYPE_STR: field_type, SCALE_STR: scale}
+                                 for name, field_type, scale
+                                 in zip(self.fields, self.types, self.scales)]}
+
+    @staticmethod
+    def from_description(description: dict, compression: str = None):
+        # Serializer of a published schema, e.g. to decode the payloads of a tracker
+        serializer = BinarySerializer(description[FIELDS_STR], compression)
+        if "{:08x}".format(serializer.schema_id()) != description[SCHEMA_ID_STR]:
+            raise ValueError("Schema {} does not match its fields".format(
+                description[SCHEMA_ID_STR]))
+        return serializer
+
+    def schema_id(self) -> int:
+        if self.cached_schema_id is not None:
+            return self.cached_schema_id
+        description = ",".join("{}:{}:{}".format(name, field_type, scale) for name, field_type, scale
+                               in zip(self.fields, self.types, self.scales))
+        self.cached_schema_id = zlib.crc32(description.encode("utf-8"))
+        return self.cached_schema_id
+
+    def encode(self, timestamp: float, values: dict) -> bytes:
+        return self.encode_records([(timestamp, values)])
+
+    def encode_records(self, records) -> bytes:
+        with self.lock:
+            return self.encode_records_locked(records)
+
+    def encode_records_locked(self, records) -> bytes:
+        body = bytearray()
+        write_varint(body, len(records))
+        previous_ms = None
+        bitmap_size = (len(self.fields) + 7) // 8
+        for timestamp, values in records:
+            timestamp_ms = int(round(timestamp * 1000))
+            if previous_ms is None:
+                write_varint(body, timestamp_ms)
+            else:
+                write_varint(body, zigzag(timestamp_ms - previous_ms))
+            previous_ms = timestamp_ms
+
+            bitmap = bytearray(bitmap_size)
+            encoded = bytearray()
+            extras = []
+            present = []
+            for name, value in values.items():
+                if value is None:
+                    continue
+                index = self.index.get(name)
+                if index is None:
+                    extras.append((name, value))
+                else:
+                    present.append(index)
+            for index in sorted(present):
+                name = self.fields[index]
+                size = len(encoded)
+                try:
+                    self.encode_value(encoded, index, values[name])
+                except (struct.error, TypeError, ValueError, OverflowError):
+                    # Not of the field's type (e.g. a str in a float field),
+                    # sent as an extra rather than losing the record
+                    del encoded[size:]
+                    extras.append((name, values[name]))
+                    continue
+                bitmap[index >> 3] |= 1 << (index & 7)
+            body += bitmap
+            body += encoded
+
+            write_varint(body, len(extras))
+            for name, value in extras:
+                BinarySerializer.encode_extra(body, name, value)
+
+        if self.compression == COMPRESSION_ZLIB:
+            body = zlib.compress(bytes(body))
+        elif self.compression == COMPRESSION_ZSTD:
+            body = zstandard.ZstdCompressor().compress(bytes(body))
+        return struct.pack("<BI", (VERSION << 4) | self.compression, self.schema_id()) + bytes(body)
+
+    def encode_value(self, buffer: bytearray, index: int, value):
+        field_type = self.types[index]
+        if field_type == TYPE_INT:
+            write_varint(buffer, zigzag(int(round(value / self.scales[index]))))
+        elif field_type == TYPE_STR:
+            encoded = str(value).encode("utf-8")
+            write_varint(buffer, len(encoded))
+            buffer += encoded
+        else:
+            buffer += FLOAT_STRUCTS[field_type].pack(value)
+
+    @staticmethod
+    def encode_extra(buffer: bytearray, name, value):
+        encoded_name = str(name).encode("utf-8")
+        write_varint(buffer, len(encoded_name))
+        buffer += encoded_name
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            buffer.append(EXTRA_FLOAT)
+            buffer += F64_STRUCT.pack(value)
+        else:
+            encoded = str(value).encode("utf-8")
+            buffer.append(EXTRA_STR)
+            write_varint(buffer, len(encoded))
+            buffer += encoded
+
+    def decode(self, payload: bytes):
+        # Returns a list of (timestamp, values) records
+        header, schema_id = struct.unpack_from("<BI", payload)
+        if header >> 4 != VERSION:
+            raise ValueError("Unsupported payload version {}".format(header >> 4))
+        if schema_id != self.schema_id():
+            raise ValueError("Payload schema {:08x} does not match {:08x}".format(
+                schema_id, self.schema_id()))
+        compression = header & 0x0F
+        body = payload[5:]
+        if compression == COMPRESSION_ZLIB:
+            body = zlib.decompress(body)
+        elif compression == COMPRESSION_ZSTD:
+            body = zstandard.ZstdDecompressor().decompress(body)
+
+        records = []
+        count, pos = read_varint(body, 0)
+        timestamp_ms = None
+        bitmap_size = (len(self.fields) + 7) // 8
+        for _ in range(count):
+            value, pos = read_varint(body, pos)
+            timestamp_ms = value if timestamp_ms is None else timestamp_ms + unzigzag(value)
+            bitmap = body[pos:pos + bitmap_size]
+            pos += bitmap_size
+            values = {}
+            for index, name in enumerate(self.fields):
+                if not bitmap[index >> 3] & (1 << (index & 7)):
+                    continue
+                values[name], pos = self.decode_value(body, pos, index)
+            n_extras, pos = read_varint(body, pos)
+            for _ in range(n_extras):
+                length, pos = read_varint(body, pos)
+                name = bytes(body[pos:pos + length]).decode("utf-8")
+                pos += length
+                extra_type = body[pos]
+                pos += 1
+                if extra_type == EXTRA_FLOAT:
+                    values[name] = F64_STRUCT.unpack_from(body, pos)[0]
+                    pos += F64_STRUCT.size
+                else:
+                    length, pos = read_varint(body, pos)
+                    values[name] = bytes(body[pos:pos + length]).decode("utf-8")
+                    pos += length
+            records.append((timestamp_ms / 1000.0, values))
+        return records
+
+    def decode_value(self, body, pos: int, index: int):
+        field_type = self.types[index]
+        if field_type == TYPE_INT:
+            value, pos = read_varint(body, pos)
+            return unzigzag(value) * self.scales[index], pos
+        if field_type == TYPE_STR:
+            length, pos = read_varint(body, pos)
+            return bytes(body[pos:pos + length]).decode("utf-8"), pos + length
+        float_struct = FLOAT_STRUCTS[field_type]
+        return float_struct.unpack_from(body, pos)[0], pos + float_struct.size
+
+
+def create_serializer(serializer_config: dict = None):
+    # Returns the serializer described by the `Serializer` config section
+    if serializer_config is None:
+        serializer_config = {}
+    serializer_format = serializer_config.get(FORMAT_STR, FORMAT_JSON)
+    if serializer_format == FORMAT_BINARY:
+        return BinarySerializer(serializer_config.get(SCHEMA_STR),
+                                serializer_config.get(COMPRESSION_STR))
+    if serializer_format != FORMAT_JSON:
+        logger.warning(
+            "Unknown serializer format {}. Using {}".format(serializer_format, FORMAT_JSON))
+    return JsonSerializer()
@@ -0,0 +1,199 @@
+'''
+Bounded queues between the receive callbacks (CAN notifier, obd.Async,
+PollScheduler) and the publish worker of PublishPipeline. Their slots are
+allocated up front, so memory does not grow while the uplink is slow, and
+put() never blocks: once a queue is full, the overflow policy decides which
+update is dropped.
+
+    coalesce      one slot per key holding its latest value. Updates of a
+                  queued key replace its value, updates of new keys are
+                  dropped while all slots are taken
+    drop_oldest   every update in arrival order, a full queue overwrites the
+                  oldest update
+    drop_newest   every update in arrival order, a full queue rejects the
+                  new update
+
+The queues are not thread safe, PublishPipeline locks around them.
+'''
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Overflow policies
+COALESCE = "coalesce"
+DROP_OLDEST = "drop_oldest"
+DROP_NEWEST = "drop_newest"
+POLICIES = (COALESCE, DROP_OLDEST, DROP_NEWEST)
+
+DEFAULT_QUEUE_SIZE = 1024
+
+
+class QueueStats:
+    __slots__ = ("capacity", "max_depth", "enqueued_count", "dropped_count", "coalesced_count")
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.max_depth = 0
+        self.enqueued_count = 0
+        self.dropped_count = 0
+        self.coalesced_count = 0
+
+    def as_dict(self, depth):
+        return {"depth": depth,
+                "max_depth": self.max_depth,
+                "capacity": self.capacity,
+                "enqueued": self.enqueued_count,
+                "dropped": self.dropped_count,
+                "coalesced": self.coalesced_count}
+
+
+class CoalescingQueue:
+    '''
+    Latest value per key in `capacity` preallocated slots
+    '''
+    policy = COALESCE
+    keyed = True
+
+    def __init__(self, capacity=DEFAULT_QUEUE_SIZE):
+        self.keys = [None] * capacity
+        self.values = [None] * capacity
+        self.received = [0.0] * capacity
+        self.enqueued = [0.0] * capacity
+        self.decoded = [0.0] * capacity
+        self.free = list(range(capacity - 1, -1, -1))
+        self.slots = {}  # key -> slot, in arrival order
+        self.stats = QueueStats(capacity)
+
+    def __len__(self):
+        return len(self.slots)
+
+    def put(self, key, value, received=0.0, enqueued=0.0, decoded=0.0) -> bool:
+        slot = self.slots.get(key)
+        if slot is not None:
+            # The oldest sample of a coalesced key determines its staleness
+            self.values[slot] = value
+            self.stats.coalesced_count += 1
+            return True
+        if len(self.free) == 0:
+            self.stats.dropped_count += 1
+            return False
+        slot = self.free.pop()
+        self.keys[slot] = key
+        self.values[slot] = value
+        self.received[slot] = received
+        self.enqueued[slot] = enqueued
+        self.decoded[slot] = decoded
+        self.slots[key] = slot
+        self.stats.enqueued_count += 1
+        if len(self.slots) > self.stats.max_depth:
+            self.stats.max_depth = len(self.slots)
+        return True
+
+    def discard(self, key):
+        slot = self.slots.pop(key, None)
+        if slot is not None:
+            self.release(slot)
+
+    def release(self, slot):
+        self.keys[slot] = self.values[slot] = None
+        self.free.append(slot)
+
+    def take(self):
+        # Removes and returns the queued (key, value, received, enqueued, decoded) items
+        items = []
+        for key, slot in self.slots.items():
+            items.append((key, self.values[slot], self.received[slot], self.enqueued[slot],
+                          self.decoded[slot]))
+            self.release(slot)
+        self.slots.clear()
+        return items
+
+    def as_dict(self):
+        return self.stats.as_dict(len(self))
+
+
+class RingQueue:
+    '''
+    Updates in arrival order in a ring of `capacity` preallocated slots
+    '''
+    keyed = False
+
+    def __init__(self, capacity=DEFAULT_QUEUE_SIZE, policy=DROP_OLDEST):
+        self.policy = policy
+        self.capacity = capacity
+        self.keys = [None] * capacity
+        self.values = [None] * capacity
+        self.received = [0.0] * capacity
+        self.enqueued = [0.0] * capacity
+        self.decoded = [0.0] * capacity
+        self.head = 0
+        self.count = 0
+        self.stats = QueueStats(capacity)
+
+    def __len__(self):
+        return self.count
+
+    def put(self, key, value, received=0.0, enqueued=0.0, decoded=0.0) -> bool:
+        if self.count == self.capacity:
+            self.stats.dropped_count += 1
+            if self.policy == DROP_NEWEST:
+                return False
+            # Overwrites the oldest update
+            self.head = (self.head + 1) % self.capacity
+            self.count -= 1
+        slot = (self.head + self.count) % self.capacity
+        self.keys[slot] = key
+        self.values[slot] = value
+        self.received[slot] = received
+        self.enqueued[slot] = enqueued
+        self.decoded[slot] = decoded
+        self.count += 1
+        self.stats.enqueued_count += 1
+        if self.count > self.stats.max_depth:
+            self.stats.max_depth = self.count
+        return True
+
+    def discard(self, key):
+        # Queued updates are published in order, none is taken back
+        pass
+
+    def take(self):
+        # Removes and returns the oldest updates up to the first repeated key,
+        # i.e. the updates that fit into one payload
+        items = []
+        keys = set()
+        while self.count > 0:
+            slot = self.head
+            key = self.keys[slot]
+            if key in keys:
+                break
+            keys.add(key)
+            items.append((key, self.values[slot], self.received[slot], self.enqueued[slot],
+                          self.decoded[slot]))
+            self.keys[slot] = self.values[slot] = None
+            self.head = (self.head + 1) % self.capacity
+            self.count -= 1
+        return items
+
+    def as_dict(self):
+        return self.stats.as_dict(len(self))
+
+
+def normalize(size=DEFAULT_QUEUE_SIZE, policy=COALESCE):
+    # Returns the (size, policy) used for the configured ones, the defaults
+    # replace invalid values
+    if not isinstance(size, int) or isinstance(size, bool) or size < 1:
+        logger.warning("Invalid queue size {}. Using {}".format(size, DEFAULT_QUEUE_SIZE))
+        size = DEFAULT_QUEUE_SIZE
+    if policy not in POLICIES:
+        logger.warning("Unknown overflow policy {}. Using {}".format(policy, COALESCE))
+        policy = COALESCE
+    return size, policy
+
+
+def create_queue(size=DEFAULT_QUEUE_SIZE, policy=COALESCE):
+    size, policy = normalize(size, policy)
+    if policy in (DROP_OLDEST, DROP_NEWEST):
+        return RingQueue(size, policy)
+    return CoalescingQueue(size)
@@ -1,11 +1,17 @@
 import sys
 import os
+import threading
 import obd
-import logging as logger
+import logging
 import yaml
-from mqtt import MqttClient
+from mqtt import MqttClient, monotonic_from_wall
+from mqtt.serializer import TYPE_F32, TYPE_STR
+from .scheduler import PollScheduler, parse_message_entry
+from .profile import open_connection, profile_path, make_profile, save_profile, \
+    read_supported_commands, COMMANDS_KEY
+from .diagnostics import DiagnosticsMonitor, DIAGNOSTICS_STR
 
-logger.getLogger(__name__).setLevel(logger.DEBUG)
+logger = logging.getLogger(__name__)
 
 OBD_CONFIG_FILEPATH = os.path.dirname(
     os.path.realpath(__file__)) + "/config_obd.yaml"
@@ -17,6 +23,39 @@ ID_STR = "ID"
 JOB_STR = "job"
 JOB_LOG_STR = "log"
 JOB_PUBLISH_STR = "publish"
+POLLING_STR = "polling"
+POLLING_ADAPTIVE = "adaptive"
+POLLING_ROUND_ROBIN = "round_robin"
+BATCH_SIZE_STR = "batch_size"
+MQTT_CONNECT_TIMEOUT_STR = "mqtt_connect_timeout"
+
+DEFAULT_MQTT_CONNECT_TIMEOUT = 10.0  # seconds
+# Delay of the revalidation of a cached adapter profile, so that the first values go out first
+PROFILE_REVALIDATION_DELAY = 5.0  # seconds
+# python-obd decoders returning numbers (pint Quantities). The values of the
+# other decoders (e.g. FUEL_TYPE, FUEL_STATUS) are strings or tuples
+NUMERIC_DECODERS = {"count", "percent", "percent_centered", "temp", "current_centered",
+                    "sensor_voltage", "sensor_voltage_big", "fuel_pressure", "pressure",
+                    "evap_pressure", "abs_evap_pressure", "evap_pressure_alt",
+                    "timing_advance", "inject_timing", "max_maf", "fuel_rate",
+                    "absolute_load", "elm_voltage", "decode_uas"}
+
+
+def schema_fields(config: dict) -> dict:
+    # Binary schema type of every configured message (see
+    # MqttClient.set_schema): floats, strings for the non-numeric ones
+    fields = {}
+    for entry in config[OBD_STR][MESSAGES_STR]:
+        name = parse_message_entry(entry)[0]
+        fields[name] = TYPE_F32
+        if not obd.commands.has_name(name):
+            continue
+        decoder = obd.commands[name].decode
+        # uas() decoders are functools.partial objects
+        decoder = getattr(decoder, "func", decoder)
+        if getattr(decoder, "__name__", None) not in NUMERIC_DECODERS:
+            fields[name] = TYPE_STR
+    return fields
 
 
 def terminate(msg="No message provided"):
@@ -60,6 +99,7 @@ class OBDTracker:
     def __init__(self, config_dict: dict or str = None, mqtt_client: MqttClient = None):
         self.id = 'obd-test'
         self.mqtt_client = mqtt_client
+        self.connection = None
         self.set_up_config(config_dict)
 
     # `config` can be either a file path or a config dict
@@ -72,12 +112,35 @@ class OBDTracker:
         self.id = config[OBD_STR][ID_STR]
         self.job = config[OBD_STR][JOB_STR]
         logger.info("OBDTracker job: {}".format(self.job))
-        self.obd_messages = config[OBD_STR][MESSAGES_STR]
+        self.polling = config[OBD_STR].get(POLLING_STR, POLLING_ROUND_ROBIN)
+        # Messages are PID names or {name, rate, priority} entries
+        self.obd_message_entries = config[OBD_STR][MESSAGES_STR]
+        self.obd_messages = [parse_message_entry(entry)[0]
+                             for entry in self.obd_message_entries]
+        self.batch_size = config[OBD_STR].get(BATCH_SIZE_STR, 1)
+        self.mqtt_connect_timeout = config[OBD_STR].get(
+            MQTT_CONNECT_TIMEOUT_STR, DEFAULT_MQTT_CONNECT_TIMEOUT)
+        # Adapter profile cache, see profile.py
+        self.profile_path = profile_path(config[OBD_STR])
+        self.profile_cached = False
+        self.scheduler = None
+        self.callback = None
+        # DTC polling and freeze-frame capture, if configured (see diagnostics.py)
+        diagnostics_config = config[OBD_STR].get(DIAGNOSTICS_STR)
+        self.diagnostics = None
+        if diagnostics_config is not None:
+            self.diagnostics = DiagnosticsMonitor(self.mqtt_client, diagnostics_config)
 
         self.obd_response_value_dict = {}
         for obd_message in self.obd_messages:
             self.obd_response_value_dict[obd_message] = None
 
+    def poll_entries(self) -> list:
+        # The configured messages and the DTC commands, for PollScheduler
+        if self.diagnostics is None:
+            return self.obd_message_entries
+        return list(self.obd_message_entries) + self.diagnostics.poll_entries()
+
     def print_supported_commands(self):
         if self.connection is not None and self.connection.is_connected():
             logger.info("Supported commands: {}".format(
@@ -86,7 +149,9 @@ class OBDTracker:
             logger.info("Can't get supported commands while disconnected")
 
     def connect(self, print_info: bool = True):
-        self.connection = obd.Async()
+        # PollScheduler issues the queries itself over a synchronous connection
+        self.connection, self.profile_cached = open_connection(
+            self.profile_path, asynchronous=self.polling != POLLING_ADAPTIVE)
         if print_info:
             self.print_supported_commands()
 
@@ -94,16 +159,59 @@ class OBDTracker:
             logger.warning("Unable to subscribe to the OBD messages")
             self.shut_down()
             return
-        self.watch_obd_messages()
-        # Start the asynchronous event loop
-        self.connection.start()
+        if not self.watch_obd_messages():
+            return
+        if self.scheduler is not None:
+            self.scheduler.start()
+        else:
+            # Start the asynchronous event loop
+            self.connection.start()
+        if self.profile_cached:
+            timer = threading.Timer(PROFILE_REVALIDATION_DELAY, self.revalidate_profile)
+            timer.daemon = True
+            timer.start()
+
+    def revalidate_profile(self):
+        # Re-reads the supported commands of a connection opened from the cached
+        # profile, between two polls, and rewrites the profile if they changed
+        if self.scheduler is not None:
+            self.scheduler.call_between_queries(self.update_supported_commands)
+            return
+        # python-obd's loop must not query at the same time
+        self.connection.stop()
+        try:
+            self.update_supported_commands()
+        except Exception as exc:
+            logger.error("Error while revalidating the adapter profile.\nDetails: {}".format(exc))
+        finally:
+            self.connection.start()
+
+    def update_supported_commands(self):
+        supported = read_supported_commands(self.connection)
+        cached = set(self.connection.profile[COMMANDS_KEY])
+        if set(command.name for command in supported) == cached:
+            logger.info("Cached adapter profile is up to date")
+            return
+        logger.info("Supported commands changed, rewriting the adapter profile")
+        self.connection.supported_commands.clear()
+        self.connection.supported_commands.update(supported)
+        save_profile(self.profile_path, make_profile(self.connection))
+        if self.diagnostics is not None:
+            self.diagnostics.attach(self.connection)
+        # Configured messages that are supported now
+        if self.scheduler is not None:
+            self.scheduler.update_messages(self.poll_entries(), self.batch_size)
+        elif self.callback is not None:
+            for obd_message in self.obd_messages:
+                self.connection.watch(obd.commands[obd_message], callback=self.callback)
 
     def watch_obd_messages(self) -> bool:
-        if self.job is 'log' and logger.getLogger().level <= logger.INFO:
+        if self.job is 'log' and not logger.isEnabledFor(logging.INFO):
             logger.warning("OBDListener is assigned to log incoming messages. But the logger level is {}".format(
-                logger.getLevelName(logger.getLogger().level)))
+                logging.getLevelName(logger.getEffectiveLevel())))
             return False
-        elif self.job is 'publish' and (self.mqtt_client is None or not self.mqtt_client.is_connected):
+        elif self.job is 'publish' and (self.mqtt_client is None or
+                                        not self.mqtt_client.wait_connected(self.mqtt_connect_timeout)):
             logger.warning("OBDListener is assigned to publish incoming messages through MQTT." +
                            " But the MqttClient is None.")
             return False
@@ -111,26 +219,100 @@ class OBDTracker:
         logger.info("OBD tracker subscribing to the following OBD messages: {}".format(
             self.obd_messages))
         callback_func = self.obd_response_callback_log if self.job is 'log' else self.obd_response_callback_publish
+        self.callback = callback_func
+        if self.diagnostics is not None:
+            self.diagnostics.attach(self.connection)
+        if self.polling == POLLING_ADAPTIVE:
+            self.scheduler = PollScheduler(
+                self.connection, self.poll_entries(), callback_func, self.batch_size)
+            if self.diagnostics is not None:
+                # Mode 02 freeze frames are read between two polls
+                self.diagnostics.query_between = self.scheduler.call_between_queries
+            return True
         for obd_message in self.obd_messages:
             self.connection.watch(
                 obd.commands[obd_message], callback=callback_func)
+        if self.diagnostics is not None:
+            # obd.Async queries every watched command at the same rate
+            for command in self.diagnostics.commands():
+                self.connection.watch(command, callback=callback_func)
         return True
 
+    def reload(self, config: dict) -> bool:
+        # Applies a changed config dict to the running connection: added messages
+        # are watched (or polled), removed ones dropped. Returns False if nothing changed
+        if config == self.config:
+            return False
+        obd_config = config[OBD_STR]
+        unknown = [parse_message_entry(entry)[0] for entry in obd_config[MESSAGES_STR]
+                   if not obd.commands.has_name(parse_message_entry(entry)[0])]
+        if len(unknown) > 0:
+            logger.warning("Unknown OBD commands in the config: {}. Not reloading".format(unknown))
+            return False
+        if obd_config.get(POLLING_STR, POLLING_ROUND_ROBIN) != self.polling or \
+                obd_config[JOB_STR] != self.job:
+            logger.warning("Changes of the OBD polling mode and job are applied on restart")
+        diagnostics_config = obd_config.get(DIAGNOSTICS_STR)
+        if (diagnostics_config is None) != (self.diagnostics is None):
+            logger.warning("Enabling or disabling the diagnostics is applied on restart")
+        elif self.diagnostics is not None:
+            self.diagnostics.configure(diagnostics_config)
+        entries = obd_config[MESSAGES_STR]
+        messages = [parse_message_entry(entry)[0] for entry in entries]
+        added = [message for message in messages if message not in self.obd_messages]
+        removed = [message for message in self.obd_messages if message not in messages]
+        logger.info("Reloading OBD config. Added: {}, removed: {}".format(added, removed))
+        self.config = config
+        self.id = obd_config[ID_STR]
+        self.obd_message_entries = entries
+        self.obd_messages = messages
+        self.batch_size = obd_config.get(BATCH_SIZE_STR, 1)
+        for message in added:
+            self.obd_response_value_dict[message] = None
+        if self.scheduler is not None:
+            self.scheduler.update_messages(self.poll_entries(), self.batch_size)
+        elif self.callback is not None and len(added) + len(removed) > 0:
+            # python-obd only changes its watches while its loop is stopped
+            self.connection.stop()
+            for message in removed:
+                self.connection.unwatch(obd.commands[message])
+            for message in added:
+                self.connection.watch(obd.commands[message], callback=self.callback)
+            self.connection.start()
+        return True
+
+    # The callbacks run on the obd.Async or PollScheduler thread for every
+    # response: their records are only formatted if the level is enabled (and
+    # sampled, see log_config.py)
     def obd_response_callback_log(self, response: obd.OBDResponse):
-        logger.info("{} [OBD_MSG_CB]: message = {}, value = {}".format(
-            response.time, response, response.value))
-        obd_message = response.command.name
-        logger.info("response.command.name is = {}".format(obd_message))
-        self.obd_response_value_dict[obd_message] = response.value
+        logger.info("%s [OBD_MSG_CB]: message = %s, value = %s",
+                    response.time, response, response.value)
+        if self.diagnostics is not None and self.diagnostics.on_response(response):
+            return
+        self.obd_response_value_dict[response.command.name] = response.value
 
     def obd_response_callback_publish(self, response: obd.OBDResponse):
-        logger.info("{} [OBD_MSG_CB]: message = {}, value = {}".format(
-            response.time, response, response.value))
+        logger.debug("%s [OBD_MSG_CB]: message = %s, value = %s",
+                     response.time, response, response.value)
+        # DTC responses are published by the diagnostics, not as values
+        if self.diagnostics is not None and self.diagnostics.on_response(response):
+            return
         obd_message_name = response.command.name
-        logger.info("respon.command.name is = {}".format(obd_message_name))
         self.obd_response_value_dict[obd_message_name] = response.value
-        self.mqtt_client.publish(
-            topic=obd_message_name, payload=response.value)
+        if response.value is None:
+            return
+        # pint Quantities are published as their magnitude
+        value = getattr(response.value, "magnitude", response.value)
+        self.mqtt_client.publish_value(
+            obd_message_name, value, monotonic_from_wall(response.time))
+
+    def is_running(self) -> bool:
+        # False once the connection to the car is lost or polling stopped
+        if self.connection is None or not self.connection.is_connected():
+            return False
+        if self.scheduler is not None:
+            return self.scheduler.thread is not None and self.scheduler.thread.is_alive()
+        return self.connection.running
 
     def test_query(self):
         logger.info("[TEST] Querying the car. Status: {}".format(
@@ -145,10 +327,14 @@ class OBDTracker:
     def shut_down(self, reason: str = None):
         logger.info(
             "Shutting down the OBD connection. Reason = {}".format(reason))
-        self.connection.close()
+        if self.scheduler is not None:
+            self.scheduler.stop()
+        if self.connection is not None:
+            self.connection.close()
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG)
     config = OBDConfig(OBD_CONFIG_FILEPATH)
     config_dict = config.read_config()
 
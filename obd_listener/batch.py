@@ -0,0 +1,72 @@
+import logging
+import obd
+from obd.OBDCommand import OBDCommand
+from obd.protocols import ECU
+
+logger = logging.getLogger(__name__)
+
+# The ELM327 accepts up to six Mode 01 PIDs in one request on CAN protocols
+MAX_BATCH_SIZE = 6
+CAN_PROTOCOL_IDS = ["6", "7", "8", "9"]
+MODE_01 = 1
+MODE_01_RESPONSE = 0x41
+
+
+def supports_batching(connection: obd.OBD) -> bool:
+    return connection.protocol_id() in CAN_PROTOCOL_IDS
+
+
+def is_batchable(command: OBDCommand) -> bool:
+    # Fixed size Mode 01 commands, so that the responses can be split
+    return command.mode == MODE_01 and command.pid is not None and command.bytes > 2
+
+
+class BatchedQuery:
+    '''
+    Queries several Mode 01 PIDs with a single request (e.g. "010C0D05") and
+    splits the combined response ("41 0C xx xx 0D xx 05 xx") back into one
+    OBDResponse per PID, decoded by the PID's own OBDCommand.
+    '''
+
+    def __init__(self, connection: obd.OBD, commands: list):
+        if len(commands) > MAX_BATCH_SIZE:
+            raise ValueError("At most {} PIDs can be batched".format(MAX_BATCH_SIZE))
+        self.connection = connection
+        self.commands = {command.pid: command for command in commands}
+        request = b"01" + b"".join("{:02X}".format(command.pid).encode()
+                                   for command in commands)
+        name = "BATCH_" + "_".join(command.name for command in commands)
+        # Not fast: the number of frames of a multi-PID (and multi-ECU) response
+        # varies, a frame count learned from one response would cut others short
+        self.command = OBDCommand(name, "Batched Mode 01 request", request, 0,
+                                  self.split_decoder, ECU.ALL, fast=False)
+
+    def split_decoder(self, messages):
+        # Decoder of the batched command. Its value is the list of per-PID responses
+        responses = []
+        for message in messages:
+            data = message.data
+            if len(data) == 0 or data[0] != MODE_01_RESPONSE:
+                continue
+            position = 1
+            while position < len(data):
+                command = self.commands.get(data[position])
+                if command is None:
+                    # Unknown length of the remaining data (e.g. padding)
+                    break
+                end = position + command.bytes - 1
+                pid_message = obd.protocols.protocol.Message(message.frames)
+                pid_message.ecu = message.ecu
+                pid_message.data = bytearray([MODE_01_RESPONSE]) + data[position:end]
+                position = end
+                responses.append(command([pid_message]))
+        return responses
+
+    def query(self) -> list:
+        # Returns the OBDResponses of the PIDs that were answered
+        response = self.connection.query(self.command, force=True)
+        if response.is_null() or response.value is None:
+            logger.debug("No response to the batched request {}".format(
+                self.command.command))
+            return []
+        return response.value
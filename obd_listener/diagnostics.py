@@ -0,0 +1,355 @@
+'''
+Diagnostic trouble codes and freeze-frame capture. The stored (Mode 03),
+pending (Mode 07) and permanent (Mode 0A) DTCs are polled at a low rate and
+priority next to the signals. Every numeric response, and every decoded CAN
+signal if the CAN listener runs (named <message>/<signal>, see
+main.CanComponent), is kept in a fixed size ring buffer. Size `capacity` for
+the combined sample rate over pre_trigger. When a DTC appears or a trigger
+condition (on an OBD or CAN signal) starts to hold, the
+samples from `pre_trigger` seconds before to `post_trigger` seconds after it
+are published, zlib-compressed, on <id>/freeze_frame. So rare events come
+with their context without streaming every signal at full rate.
+
+    OBD:
+      diagnostics:
+        dtc_rate: 0.05
+        dtc_priority: 4
+        pre_trigger: 30.0
+        post_trigger: 10.0
+        capacity: 16384
+        # Seconds before the same trigger can fire again
+        hold_off: 300.0
+        topic: <id>/freeze_frame
+        triggers:
+          - { name: "COOLANT_TEMP", above: 110 }
+          - { name: "CONTROL_MODULE_VOLTAGE", below: 11.5 }
+          - { name: "eng_speed/eng_speed", above: 6000 }
+
+Payload (JSON, compressed as a whole):
+    {"time": trigger time, "reasons": [...], "dtcs": {"stored": [...], ...},
+     "ecu_freeze_frame": {name: value}, (Mode 02, read for new DTCs in adaptive polling)
+     "signals": {name: {"t": [ms relative to the trigger], "v": [values]}}}
+'''
+
+import json
+import zlib
+import threading
+import logging
+import numpy as np
+import obd
+
+from .scheduler import CUSTOM_COMMANDS, NAME_STR, RATE_STR, PRIORITY_STR
+
+logger = logging.getLogger(__name__)
+
+# Config keywords
+DIAGNOSTICS_STR = "diagnostics"
+DTC_RATE_STR = "dtc_rate"
+DTC_PRIORITY_STR = "dtc_priority"
+PRE_TRIGGER_STR = "pre_trigger"
+POST_TRIGGER_STR = "post_trigger"
+CAPACITY_STR = "capacity"
+HOLD_OFF_STR = "hold_off"
+TOPIC_STR = "topic"
+TRIGGERS_STR = "triggers"
+ABOVE_STR = "above"
+BELOW_STR = "below"
+
+DEFAULT_DTC_RATE = 0.05  # Hz
+DEFAULT_DTC_PRIORITY = 4
+DEFAULT_PRE_TRIGGER = 30.0  # seconds
+DEFAULT_POST_TRIGGER = 10.0  # seconds
+DEFAULT_CAPACITY = 16384  # samples
+DEFAULT_HOLD_OFF = 300.0  # seconds
+DEFAULT_TOPIC_SUFFIX = "/freeze_frame"
+DTC_TOPIC_SUFFIX = "/dtc"
+
+# python-obd does not define Mode 0A. Its response is laid out as Mode 03's
+GET_PERMANENT_DTC = obd.OBDCommand("GET_PERMANENT_DTC", "Get permanent DTCs", b"0A", 0,
+                                   obd.decoders.dtc, obd.ECU.ALL, False)
+CUSTOM_COMMANDS[GET_PERMANENT_DTC.name] = GET_PERMANENT_DTC
+
+# DTC command -> kind
+DTC_COMMANDS = {obd.commands.GET_DTC.name: "stored",
+                obd.commands.GET_CURRENT_DTC.name: "pending",
+                GET_PERMANENT_DTC.name: "permanent"}
+
+
+class SampleRing:
+    '''
+    The latest `capacity` samples of all signals in preallocated columns
+    (wall time, signal index, value)
+    '''
+
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        self.capacity = capacity
+        self.times = np.zeros(capacity, dtype=np.float64)
+        self.keys = np.zeros(capacity, dtype=np.int32)
+        self.values = np.zeros(capacity, dtype=np.float64)
+        self.names = []
+        self.index = {}  # name -> signal index
+        self.count = 0  # Samples appended since the start
+        self.lock = threading.Lock()
+
+    def key_of(self, name):
+        key = self.index.get(name)
+        if key is None:
+            key = self.index[name] = len(self.names)
+            self.names.append(name)
+        return key
+
+    def append(self, name, timestamp, value):
+        with self.lock:
+            key = self.key_of(name)
+            slot = self.count % self.capacity
+            self.times[slot] = timestamp
+            self.keys[slot] = key
+            self.values[slot] = value
+            self.count += 1
+
+    def append_many(self, name, timestamps, values):
+        # `timestamps` and `values` are 1-D arrays of samples of `name`
+        with self.lock:
+            key = self.key_of(name)
+            count = len(values)
+            skipped = max(0, count - self.capacity)
+            slots = (self.count + skipped + np.arange(count - skipped)) % self.capacity
+            self.times[slots] = timestamps[skipped:]
+            self.keys[slots] = key
+            self.values[slots] = values[skipped:]
+            self.count += count
+
+    def window(self, start, end):
+        # Returns {name: (times, values)} of the samples within [start, end]
+        with self.lock:
+            size = min(self.count, self.capacity)
+            rows = (self.count - size + np.arange(size)) % self.capacity
+            times, keys, values = self.times[rows], self.keys[rows], self.values[rows]
+            names = list(self.names)
+        mask = (times >= start) & (times <= end)
+        times, keys, values = times[mask], keys[mask], values[mask]
+        order = np.argsort(keys, kind="stable")
+        times, keys, values = times[order], keys[order], values[order]
+        unique, first = np.unique(keys, return_index=True)
+        return {names[key]: (key_times, key_values) for key, key_times, key_values in
+                zip(unique, np.split(times, first[1:]), np.split(values, first[1:]))}
+
+
+class Trigger:
+    '''
+    Fires when `value > above` or `value < below` starts to hold, at most once
+    per `hold_off` seconds
+    '''
+
+    def __init__(self, name, above=None, below=None, hold_off=DEFAULT_HOLD_OFF):
+        self.name = name
+        self.above = above
+        self.below = below
+        self.hold_off = hold_off
+        self.active = False
+        self.last_fired = None
+
+    def describe(self):
+        if self.above is not None:
+            return "{} > {}".format(self.name, self.above)
+        return "{} < {}".format(self.name, self.below)
+
+    def check(self, value, timestamp) -> bool:
+        holds = (self.above is not None and value > self.above) or \
+            (self.below is not None and value < self.below)
+        rising = holds and not self.active
+        self.active = holds
+        if not rising:
+            return False
+        if self.last_fired is not None and timestamp - self.last_fired < self.hold_off:
+            return False
+        self.last_fired = timestamp
+        return True
+
+
+class Capture:
+    __slots__ = ("time", "reasons", "dtcs", "ecu_freeze_frame")
+
+    def __init__(self, timestamp, reason, dtcs):
+        self.time = timestamp
+        self.reasons = [reason]
+        self.dtcs = dtcs
+        self.ecu_freeze_frame = {}
+
+
+def read_ecu_freeze_frame(connection, names):
+    # Mode 02 values of the given Mode 01 signals and the DTC that froze them
+    values = {}
+    pids = [obd.commands.FREEZE_DTC.pid] + [
+        obd.commands[name].pid for name in names
+        if obd.commands.has_name(name) and obd.commands[name].mode == 1]
+    for pid in pids:
+        if not obd.commands.has_pid(2, pid):
+            continue
+        command = obd.commands[2][pid]
+        if not connection.supports(command):
+            continue
+        response = connection.query(command)
+        if response.is_null():
+            continue
+        values[command.name] = json_value(response.value)
+    return values
+
+
+def json_value(value):
+    value = getattr(value, "magnitude", value)
+    if isinstance(value, (int, float, str)) or value is None:
+        return value
+    return str(value)
+
+
+class DiagnosticsMonitor:
+    def __init__(self, mqtt_client=None, diagnostics_config: dict = None):
+        self.mqtt_client = mqtt_client
+        self.ring = None
+        self.capture = None  # Capture waiting for its post-trigger samples
+        self.lock = threading.Lock()
+        self.dtcs = {}  # kind -> sorted codes, of the kinds polled so far
+        # Runs a function on the polling thread (PollScheduler.call_between_queries),
+        # set by OBDTracker in adaptive polling
+        self.query_between = None
+        self.connection = None
+        self.capture_count = 0
+        self.configure(diagnostics_config)
+
+    def configure(self, diagnostics_config: dict = None):
+        if diagnostics_config is None:
+            diagnostics_config = {}
+        self.dtc_rate = diagnostics_config.get(DTC_RATE_STR, DEFAULT_DTC_RATE)
+        self.dtc_priority = diagnostics_config.get(DTC_PRIORITY_STR, DEFAULT_DTC_PRIORITY)
+        self.pre_trigger = diagnostics_config.get(PRE_TRIGGER_STR, DEFAULT_PRE_TRIGGER)
+        self.post_trigger = diagnostics_config.get(POST_TRIGGER_STR, DEFAULT_POST_TRIGGER)
+        self.topic = diagnostics_config.get(TOPIC_STR, None)
+        hold_off = diagnostics_config.get(HOLD_OFF_STR, DEFAULT_HOLD_OFF)
+        triggers = {}
+        for entry in diagnostics_config.get(TRIGGERS_STR) or []:
+            if entry.get(ABOVE_STR) is None and entry.get(BELOW_STR) is None:
+                logger.warning("Trigger of {} sets neither {} nor {}, ignoring it".format(
+                    entry.get(NAME_STR), ABOVE_STR, BELOW_STR))
+                continue
+            triggers.setdefault(entry[NAME_STR], []).append(Trigger(
+                entry[NAME_STR], entry.get(ABOVE_STR), entry.get(BELOW_STR), hold_off))
+        self.triggers = triggers
+        capacity = diagnostics_config.get(CAPACITY_STR, DEFAULT_CAPACITY)
+        if self.ring is None or self.ring.capacity != capacity:
+            self.ring = SampleRing(capacity)
+
+    def get_topic(self):
+        if self.topic is not None:
+            return self.topic
+        return self.mqtt_client.id + DEFAULT_TOPIC_SUFFIX
+
+    def poll_entries(self) -> list:
+        # Scheduler entries of the DTC commands
+        return [{NAME_STR: name, RATE_STR: self.dtc_rate, PRIORITY_STR: self.dtc_priority}
+                for name in DTC_COMMANDS]
+
+    def commands(self) -> list:
+        return [CUSTOM_COMMANDS.get(name) or obd.commands[name] for name in DTC_COMMANDS]
+
+    def attach(self, connection):
+        # Mode 0A is not in python-obd's PID listings: it is tried as supported
+        self.connection = connection
+        connection.supported_commands.add(GET_PERMANENT_DTC)
+
+    def on_response(self, response) -> bool:
+        # Called from the OBD callback for every response. Returns True for the
+        # DTC responses, which are not published as values
+        name = response.command.name
+        kind = DTC_COMMANDS.get(name)
+        if kind is not None:
+            # A null response (timeout, NO DATA) is not an empty DTC list: the
+            # codes would be reported cleared and captured as new once read again
+            if not response.is_null():
+                self.update_dtcs(kind, response.value or [], response.time)
+            return True
+        value = getattr(response.value, "magnitude", response.value)
+        if not isinstance(value, (int, float)):
+            return False
+        self.ring.append(name, response.time, value)
+        for trigger in self.triggers.get(name, ()):
+            if trigger.check(value, response.time):
+                self.trigger(trigger.describe(), response.time)
+        return False
+
+    def add_samples(self, names, timestamps, values):
+        # Decoded CAN samples (from the CAN listener loop): `values` has a
+        # column per name and a row per timestamp
+        for column, name in enumerate(names):
+            self.ring.append_many(name, timestamps, values[:, column])
+            for trigger in self.triggers.get(name, ()):
+                for value, timestamp in zip(values[:, column].tolist(), timestamps.tolist()):
+                    if trigger.check(value, timestamp):
+                        self.trigger(trigger.describe(), timestamp)
+
+    def update_dtcs(self, kind, dtcs, timestamp):
+        codes = sorted(code for code, _ in dtcs)
+        previous = self.dtcs.get(kind)
+        if previous == codes:
+            return
+        known = set(code for kind_codes in self.dtcs.values() for code in kind_codes)
+        self.dtcs[kind] = codes
+        logger.info("{} DTCs: {}".format(kind.capitalize(), codes))
+        self.publish_dtcs()
+        if previous is None:
+            # Codes present when polling started are reported, not captured
+            return
+        new = [code for code in codes if code not in known]
+        if len(new) > 0:
+            self.trigger("new DTC " + ", ".join(new), timestamp, read_ecu=True)
+
+    def publish_dtcs(self):
+        if self.mqtt_client is None:
+            return
+        self.mqtt_client.publish(self.mqtt_client.id + DTC_TOPIC_SUFFIX,
+                                 json.dumps(self.dtcs), qos=1)
+
+    def trigger(self, reason, timestamp, read_ecu=False):
+        with self.lock:
+            capture = self.capture
+            if capture is not None:
+                # Within the post-trigger window of a capture: reported with it
+                capture.reasons.append(reason)
+            else:
+                capture = self.capture = Capture(timestamp, reason, dict(self.dtcs))
+                timer = threading.Timer(self.post_trigger, self.complete, [capture])
+                timer.daemon = True
+                timer.start()
+        logger.warning("Freeze frame triggered: {}".format(reason))
+        if read_ecu and self.query_between is not None and self.connection is not None:
+            self.query_between(lambda: capture.ecu_freeze_frame.update(
+                read_ecu_freeze_frame(self.connection, self.ring.names)))
+
+    def complete(self, capture):
+        with self.lock:
+            if self.capture is capture:
+                self.capture = None
+        try:
+            payload = self.encode(capture)
+        except Exception as exc:
+            logger.error("Error while encoding the freeze frame.\nDetails: {}".format(exc))
+            return
+        self.capture_count += 1
+        if self.mqtt_client is None:
+            logger.info("Captured freeze frame ({} bytes): {}".format(
+                len(payload), capture.reasons))
+            return
+        self.mqtt_client.publish(self.get_topic(), payload, qos=1)
+
+    def encode(self, capture) -> bytes:
+        window = self.ring.window(capture.time - self.pre_trigger,
+                                  capture.time + self.post_trigger)
+        signals = {name: {"t": np.rint((times - capture.time) * 1000).astype(np.int64).tolist(),
+                          "v": values.tolist()}
+                   for name, (times, values) in window.items()}
+        document = {"time": capture.time,
+                    "reasons": capture.reasons,
+                    "dtcs": capture.dtcs,
+                    "ecu_freeze_frame": capture.ecu_freeze_frame,
+                    "signals": signals}
+        return zlib.compress(json.dumps(document, separators=(",", ":")).encode("utf-8"))
@@ -0,0 +1,146 @@
+'''
+Cached adapter profile: the serial port, baud rate and protocol python-obd
+detected, and the commands the vehicle supports. Detecting them on connect
+scans the serial ports, tries the baud rates and protocols one by one and
+queries the PID listings, which takes seconds on every boot. With a profile
+the connection is opened with the cached values and the supported commands
+are re-read in the background once polling runs (see
+OBDTracker.revalidate_profile). If the cached values do not connect, the
+adapter is detected again and the profile rewritten.
+
+    OBD:
+        # false disables the cache
+        profile: ~/.cache/pican/obd_profile.json
+'''
+
+import os
+import json
+import logging
+import obd
+
+logger = logging.getLogger(__name__)
+
+# Config keyword
+PROFILE_STR = "profile"
+
+DEFAULT_PROFILE_PATH = "~/.cache/pican/obd_profile.json"
+
+# Profile keys
+PORT_KEY = "port"
+BAUDRATE_KEY = "baudrate"
+PROTOCOL_KEY = "protocol"
+COMMANDS_KEY = "commands"
+
+
+def profile_path(obd_config: dict):
+    # Returns None if the cache is disabled
+    path = obd_config.get(PROFILE_STR, DEFAULT_PROFILE_PATH)
+    if not path:
+        return None
+    return os.path.expanduser(path)
+
+
+def load_profile(path):
+    try:
+        with open(path, "r") as stream:
+            profile = json.load(stream)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as error:
+        logger.warning("Unable to read the adapter profile {}.\nDetails: {}".format(path, error))
+        return None
+    if not all(key in profile for key in (PORT_KEY, BAUDRATE_KEY, PROTOCOL_KEY, COMMANDS_KEY)):
+        return None
+    return profile
+
+
+def make_profile(connection: obd.OBD):
+    # The serial port is private to python-obd's ELM327, its baud rate is read from it
+    port = getattr(connection.interface, "_ELM327__port", None)
+    return {PORT_KEY: connection.port_name(),
+            BAUDRATE_KEY: getattr(port, "baudrate", None),
+            PROTOCOL_KEY: connection.protocol_id(),
+            COMMANDS_KEY: sorted(command.name for command in connection.supported_commands)}
+
+
+def save_profile(path, profile):
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Written to a temporary file first so that a power loss cannot truncate it
+        with open(path + ".tmp", "w") as stream:
+            json.dump(profile, stream)
+        os.replace(path + ".tmp", path)
+    except OSError as error:
+        logger.warning("Unable to write the adapter profile {}.\nDetails: {}".format(path, error))
+
+
+def commands_of(names):
+    return set(obd.commands[name] for name in names if obd.commands.has_name(name))
+
+
+def read_supported_commands(connection: obd.OBD):
+    # The PID listing queries python-obd runs on connect. PID listings become
+    # supported one after the other (0100 lists 0120 and so on)
+    supported = set(obd.commands.base_commands())
+    for getter in obd.commands.pid_getters():
+        if getter not in supported:
+            continue
+        # OBD.query also bypasses the cached values of obd.Async
+        response = obd.OBD.query(connection, getter, force=True)
+        if response.is_null():
+            continue
+        for index, bit in enumerate(response.value):
+            if not bit:
+                continue
+            pid = getter.pid + index + 1
+            if obd.commands.has_pid(getter.mode, pid):
+                supported.add(obd.commands[getter.mode][pid])
+            if getter.mode == 1 and obd.commands.has_pid(2, pid):
+                supported.add(obd.commands[2][pid])
+    return supported
+
+
+class ProfileMixin:
+    '''
+    Opens the connection with the port, baud rate and protocol of a profile
+    and takes the supported commands from it instead of querying them
+    '''
+
+    def __init__(self, profile: dict, **kwargs):
+        self.profile = profile
+        super().__init__(portstr=profile[PORT_KEY], baudrate=profile[BAUDRATE_KEY],
+                         protocol=profile[PROTOCOL_KEY], **kwargs)
+
+    # Overrides the private OBD.__load_commands called by OBD.__init__
+    def _OBD__load_commands(self):
+        if self.status() != obd.OBDStatus.CAR_CONNECTED:
+            logger.warning("Cannot load commands: No connection to car")
+            return
+        self.supported_commands.update(commands_of(self.profile[COMMANDS_KEY]))
+
+
+class ProfiledOBD(ProfileMixin, obd.OBD):
+    pass
+
+
+class ProfiledAsync(ProfileMixin, obd.Async):
+    pass
+
+
+def open_connection(path, asynchronous: bool):
+    # Returns (connection, cached) where `cached` tells if the profile was used
+    connection_class = obd.Async if asynchronous else obd.OBD
+    profile = load_profile(path) if path is not None else None
+    if profile is not None:
+        logger.info("Connecting with the cached adapter profile: {} at {} baud, protocol {}".format(
+            profile[PORT_KEY], profile[BAUDRATE_KEY], profile[PROTOCOL_KEY]))
+        profiled_class = ProfiledAsync if asynchronous else ProfiledOBD
+        connection = profiled_class(profile)
+        if connection.status() == obd.OBDStatus.CAR_CONNECTED:
+            return connection, True
+        logger.warning("Cached adapter profile did not connect. Detecting the adapter")
+        connection.close()
+    connection = connection_class()
+    if path is not None and connection.status() == obd.OBDStatus.CAR_CONNECTED:
+        save_profile(path, make_profile(connection))
+    return connection, False
@@ -0,0 +1,300 @@
+import time
+import heapq
+import threading
+import logging
+import obd
+
+from .batch import BatchedQuery, supports_batching, is_batchable, MAX_BATCH_SIZE
+
+logger = logging.getLogger(__name__)
+
+# Config keywords
+NAME_STR = "name"
+RATE_STR = "rate"
+PRIORITY_STR = "priority"
+
+# Target rates (Hz) of the PIDs that do not declare one. Fast changing
+# signals are polled more often than slowly changing ones.
+DEFAULT_RATES = {
+    "RPM": 5.0,
+    "SPEED": 5.0,
+    "THROTTLE_POS": 5.0,
+    "ENGINE_LOAD": 2.0,
+    "RUN_TIME": 1.0,
+    "COOLANT_TEMP": 0.2,
+    "FUEL_STATUS": 0.2,
+    "FUEL_LEVEL": 0.1,
+    "FUEL_TYPE": 0.01,
+}
+DEFAULT_RATE = 1.0
+DEFAULT_PRIORITY = 2  # 1 is the highest priority
+MIN_RATE = 0.01
+# Commands python-obd does not define (e.g. Mode 0A, see diagnostics.py), by name
+CUSTOM_COMMANDS = {}
+# Fraction of the measured adapter capacity (1 / round trip time) to use
+UTILIZATION = 0.9
+RTT_ALPHA = 0.2  # Weight of the latest round trip time in its moving average
+ADAPT_EVERY = 10  # queries
+BATCH_ALPHA = 0.2  # Weight of the latest batch size in its moving average
+
+
+def command_of(name):
+    command = CUSTOM_COMMANDS.get(name)
+    return command if command is not None else obd.commands[name]
+
+
+def parse_message_entry(entry):
+    # A message is either a PID name or a {name, rate, priority} dict.
+    # Returns (name, rate, priority)
+    if isinstance(entry, dict):
+        name = entry[NAME_STR]
+        return (name, entry.get(RATE_STR, DEFAULT_RATES.get(name, DEFAULT_RATE)),
+                entry.get(PRIORITY_STR, DEFAULT_PRIORITY))
+    return entry, DEFAULT_RATES.get(entry, DEFAULT_RATE), DEFAULT_PRIORITY
+
+
+class PIDSchedule:
+    __slots__ = ("name", "command", "rate", "priority", "interval", "next_due",
+                 "last_query", "query_count")
+
+    def __init__(self, name, command, rate, priority):
+        self.name = name
+        self.command = command
+        self.rate = max(rate, MIN_RATE)
+        self.priority = priority
+        self.interval = 1.0 / self.rate
+        self.next_due = 0.0
+        self.last_query = None
+        self.query_count = 0
+
+
+class PollScheduler:
+    '''
+    Polls OBD PIDs over a synchronous connection, earliest deadline first.
+    Each PID has a target rate and a priority. When the adapter cannot keep up
+    with the sum of the target rates (estimated from the measured round trip
+    time), the budget is given to the higher priorities first and the rates of
+    the remaining PIDs are scaled down. The polled PIDs can be replaced while
+    polling (update_messages), between two queries.
+    '''
+
+    def __init__(self, connection: obd.OBD, messages: list, callback, batch_size: int = 1):
+        self.connection = connection
+        self.callback = callback
+        self.rtt = None  # Moving average of the query round trip time
+        # Mode 01 PIDs due at about the same time are queried together
+        self.batch_size = max(1, min(batch_size, MAX_BATCH_SIZE))
+        self.mean_batch = 1.0  # Average number of PIDs per query
+        self.batched_queries = {}
+        self.schedules = []
+        for entry in messages:
+            name, rate, priority = parse_message_entry(entry)
+            self.schedules.append(PIDSchedule(
+                name, command_of(name), rate, priority))
+        self.stop_event = threading.Event()
+        # Interrupts the wait for the next deadline, on stop() and updates
+        self.wake_event = threading.Event()
+        self.lock = threading.Lock()
+        self.pending = None  # (messages, batch_size) of an update not applied yet
+        self.calls = []  # Functions to run between two queries
+        self.thread = None
+        self.queries_since_adapt = 0
+
+    def drop_unsupported(self):
+        supported = []
+        for schedule in self.schedules:
+            if self.connection.supports(schedule.command):
+                supported.append(schedule)
+            else:
+                logger.warning(
+                    "{} is not supported by the vehicle. Not polling it".format(schedule.name))
+        self.schedules = supported
+
+    def update_messages(self, messages: list, batch_size: int = None):
+        # Replaces the polled PIDs. PIDs kept keep their measured state
+        with self.lock:
+            self.pending = (list(messages), batch_size)
+        if self.thread is None:
+            self.apply_update()
+        elif not self.thread.is_alive():
+            # The thread ran out of PIDs
+            self.thread = None
+            self.apply_update()
+            self.start()
+        else:
+            self.wake_event.set()
+
+    def call_between_queries(self, func):
+        # Runs `func` on the polling thread while no query is in flight
+        with self.lock:
+            self.calls.append(func)
+        if self.thread is None or not self.thread.is_alive():
+            self.run_calls()
+        else:
+            self.wake_event.set()
+
+    def run_calls(self):
+        with self.lock:
+            calls, self.calls = self.calls, []
+        for func in calls:
+            try:
+                func()
+            except Exception as exc:
+                logger.error("Error in a call between OBD queries.\nDetails: {}".format(exc))
+
+    def apply_update(self):
+        # Returns True if an update was applied. The schedule indices change
+        with self.lock:
+            pending, self.pending = self.pending, None
+        if pending is None:
+            return False
+        messages, batch_size = pending
+        existing = {schedule.name: schedule for schedule in self.schedules}
+        schedules = []
+        for entry in messages:
+            name, rate, priority = parse_message_entry(entry)
+            schedule = existing.get(name)
+            if schedule is not None:
+                schedule.rate = max(rate, MIN_RATE)
+                schedule.priority = priority
+            else:
+                schedule = PIDSchedule(name, command_of(name), rate, priority)
+                if self.thread is not None and not self.connection.supports(schedule.command):
+                    logger.warning(
+                        "{} is not supported by the vehicle. Not polling it".format(name))
+                    continue
+                # Added PIDs are due now
+                schedule.next_due = time.monotonic()
+            schedules.append(schedule)
+        self.schedules = schedules
+        if batch_size is not None:
+            self.batch_size = max(1, min(batch_size, MAX_BATCH_SIZE))
+            if self.batch_size > 1 and self.thread is not None and \
+                    not supports_batching(self.connection):
+                self.batch_size = 1
+        self.batched_queries = {}
+        self.adapt()
+        logger.info("OBD polling updated: {}".format([schedule.name for schedule in self.schedules]))
+        return True
+
+    def adapt(self):
+        # Assigns each PID an interval fitting into the adapter's query budget.
+        # Until the round trip time is measured, the target rates are used
+        if self.rtt is None:
+            for schedule in self.schedules:
+                schedule.interval = 1.0 / schedule.rate
+            return
+        budget = UTILIZATION / max(self.rtt, 1e-3) * self.mean_batch
+        for priority in sorted(set(schedule.priority for schedule in self.schedules)):
+            tier = [schedule for schedule in self.schedules if schedule.priority == priority]
+            demand = sum(schedule.rate for schedule in tier)
+            scale = min(1.0, budget / demand) if budget > 0 else 0.0
+            for schedule in tier:
+                schedule.interval = 1.0 / max(schedule.rate * scale, MIN_RATE)
+            budget -= demand * scale
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Adapted OBD polling to RTT %.3fs: %s", self.rtt,
+                         {schedule.name: round(1.0 / schedule.interval, 3) for schedule in self.schedules})
+
+    def build_queue(self):
+        # PIDs whose interval shrank since their last query are due earlier
+        queue = []
+        for index, schedule in enumerate(self.schedules):
+            if schedule.last_query is not None:
+                schedule.next_due = min(schedule.next_due,
+                                        schedule.last_query + schedule.interval)
+            queue.append((schedule.next_due, index))
+        heapq.heapify(queue)
+        return queue
+
+    def take_batch(self, queue, index, now):
+        # Removes from the queue the batchable PIDs that are due within half
+        # of their interval and returns them with the given one
+        batch = [index]
+        if self.batch_size == 1 or not is_batchable(self.schedules[index].command):
+            return batch
+        candidates = sorted(entry for entry in queue
+                            if is_batchable(self.schedules[entry[1]].command) and
+                            entry[0] <= now + self.schedules[entry[1]].interval / 2)
+        taken = set(entry[1] for entry in candidates[:self.batch_size - 1])
+        if len(taken) > 0:
+            batch.extend(taken)
+            queue[:] = [entry for entry in queue if entry[1] not in taken]
+            heapq.heapify(queue)
+        return batch
+
+    def query(self, batch):
+        # Returns the responses to the PIDs of the batch
+        if len(batch) == 1:
+            response = self.connection.query(self.schedules[batch[0]].command)
+            return [response] if response is not None and not response.is_null() else []
+        key = tuple(sorted(batch))
+        batched_query = self.batched_queries.get(key)
+        if batched_query is None:
+            batched_query = BatchedQuery(
+                self.connection, [self.schedules[index].command for index in key])
+            self.batched_queries[key] = batched_query
+        return [response for response in batched_query.query() if not response.is_null()]
+
+    def run(self):
+        queue = self.build_queue()
+        while len(queue) > 0 and not self.stop_event.is_set():
+            if self.wake_event.is_set():
+                # Checked between queries, also when the adapter is saturated
+                self.wake_event.clear()
+                if self.stop_event.is_set():
+                    break
+                self.run_calls()
+                if self.apply_update():
+                    queue = self.build_queue()
+                    continue
+            due, index = heapq.heappop(queue)
+            delay = due - time.monotonic()
+            if delay > 0 and self.wake_event.wait(delay):
+                heapq.heappush(queue, (due, index))
+                continue
+            start = time.monotonic()
+            batch = self.take_batch(queue, index, start)
+            responses = self.query(batch)
+            end = time.monotonic()
+            if self.rtt is None:
+                self.rtt = end - start
+            self.rtt += RTT_ALPHA * (end - start - self.rtt)
+            self.mean_batch += BATCH_ALPHA * (len(batch) - self.mean_batch)
+            for batch_index in batch:
+                schedule = self.schedules[batch_index]
+                schedule.query_count += 1
+                schedule.last_query = start
+                # Do not try to catch up on missed deadlines
+                schedule.next_due = max(min(schedule.next_due, start) + schedule.interval, end)
+                heapq.heappush(queue, (schedule.next_due, batch_index))
+            for response in responses:
+                try:
+                    self.callback(response)
+                except Exception as exc:
+                    logger.error("Error in OBD callback of {}.\nDetails: {}".format(
+                        response.command.name, exc))
+            self.queries_since_adapt += 1
+            if self.queries_since_adapt >= ADAPT_EVERY:
+                self.adapt()
+                self.queries_since_adapt = 0
+                queue = self.build_queue()
+
+    def start(self):
+        if self.batch_size > 1 and not supports_batching(self.connection):
+            logger.info("OBD protocol does not support multi-PID requests. Not batching")
+            self.batch_size = 1
+        self.drop_unsupported()
+        self.adapt()
+        self.stop_event.clear()
+        self.wake_event.clear()
+        self.thread = threading.Thread(
+            target=self.run, name="OBDPollScheduler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.wake_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
@@ -0,0 +1,193 @@
+'''
+Runs the parts of the tracker (MQTT client, OBD tracker, CAN listener) as
+supervised components of a headless service:
+
+    - SIGTERM/SIGINT stop the components in reverse start order within a
+      drain deadline, a second signal exits at once
+    - components that are not healthy are restarted with exponential backoff
+    - under systemd (Type=notify) READY/STOPPING are reported and the
+      watchdog is pinged, see pican.service
+'''
+
+import os
+import time
+import signal
+import socket
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DRAIN_TIMEOUT = 5.0  # seconds
+DEFAULT_CHECK_INTERVAL = 1.0  # seconds
+MIN_BACKOFF = 1.0  # seconds
+MAX_BACKOFF = 60.0  # seconds
+# A component running this long after a restart starts over at MIN_BACKOFF
+STABLE_PERIOD = 60.0  # seconds
+
+EXIT_DRAIN_TIMEOUT = 2
+EXIT_FORCED = 130
+
+
+def sd_notify(state: str) -> bool:
+    # Sends a state (e.g. "READY=1") to systemd. Returns False outside of systemd
+    address = os.environ.get("NOTIFY_SOCKET")
+    if not address:
+        return False
+    if address.startswith("@"):
+        # Abstract socket namespace
+        address = "\0" + address[1:]
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.connect(address)
+            sock.sendall(state.encode())
+        return True
+    except OSError as error:
+        logger.warning("Unable to notify systemd.\nDetails: {}".format(error))
+        return False
+
+
+def watchdog_interval():
+    # Half of the systemd WatchdogSec of this process, None if not enabled
+    usec = os.environ.get("WATCHDOG_USEC")
+    pid = os.environ.get("WATCHDOG_PID")
+    if not usec or (pid and int(pid) != os.getpid()):
+        return None
+    return int(usec) / 1e6 / 2
+
+
+class Component:
+    '''
+    A supervised part of the service. start() must not block, stop() must
+    return within `timeout` seconds
+    '''
+    name = "component"
+
+    def start(self):
+        raise NotImplementedError
+
+    def stop(self, timeout: float):
+        raise NotImplementedError
+
+    def healthy(self) -> bool:
+        return True
+
+    def restart(self, timeout: float):
+        self.stop(timeout)
+        self.start()
+
+
+class ComponentState:
+    __slots__ = ("component", "started", "failures", "next_restart")
+
+    def __init__(self, component):
+        self.component = component
+        self.started = None  # monotonic time of the last (re)start, None if it failed
+        self.failures = 0
+        self.next_restart = 0.0
+
+
+class Supervisor:
+    def __init__(self, components: list, drain_timeout: float = DEFAULT_DRAIN_TIMEOUT,
+                 check_interval: float = DEFAULT_CHECK_INTERVAL):
+        self.states = [ComponentState(component) for component in components]
+        self.drain_timeout = drain_timeout
+        self.check_interval = check_interval
+        self.watchdog_interval = watchdog_interval()
+        if self.watchdog_interval is not None:
+            self.check_interval = min(self.check_interval, self.watchdog_interval)
+        self.stop_event = threading.Event()
+
+    def handle_signal(self, signum, frame):
+        if self.stop_event.is_set():
+            logger.warning("Second stop signal, exiting without draining")
+            os._exit(EXIT_FORCED)
+        logger.info("Received {}, stopping".format(signal.Signals(signum).name))
+        self.stop_event.set()
+
+    def install_signal_handlers(self):
+        # Must be called from the main thread
+        signal.signal(signal.SIGTERM, self.handle_signal)
+        signal.signal(signal.SIGINT, self.handle_signal)
+
+    def start_component(self, state, restart=False):
+        component = state.component
+        try:
+            if restart:
+                component.restart(self.drain_timeout)
+            else:
+                component.start()
+            state.started = time.monotonic()
+            return True
+        except Exception as exc:
+            logger.error("Error while starting {}.\nDetails: {}".format(component.name, exc))
+            self.schedule_restart(state)
+            return False
+
+    def schedule_restart(self, state):
+        state.started = None
+        state.failures += 1
+        delay = min(MIN_BACKOFF * 2 ** (state.failures - 1), MAX_BACKOFF)
+        state.next_restart = time.monotonic() + delay
+        logger.warning("Restarting {} in {:g} s (failure {})".format(
+            state.component.name, delay, state.failures))
+
+    def check(self):
+        now = time.monotonic()
+        for state in self.states:
+            if state.started is None:
+                if now >= state.next_restart:
+                    logger.info("Restarting {}".format(state.component.name))
+                    self.start_component(state, restart=True)
+                continue
+            try:
+                healthy = state.component.healthy()
+            except Exception as exc:
+                logger.error("Error while checking {}.\nDetails: {}".format(
+                    state.component.name, exc))
+                healthy = False
+            if not healthy:
+                logger.warning("{} is not healthy".format(state.component.name))
+                self.schedule_restart(state)
+            elif state.failures > 0 and now - state.started >= STABLE_PERIOD:
+                state.failures = 0
+
+    def run(self) -> int:
+        # Blocks until stopped by a signal (or stop()). Returns the exit code
+        for state in self.states:
+            logger.info("Starting {}".format(state.component.name))
+            self.start_component(state)
+        sd_notify("READY=1")
+        while not self.stop_event.wait(self.check_interval):
+            self.check()
+            if self.watchdog_interval is not None:
+                sd_notify("WATCHDOG=1")
+        return self.shut_down()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def shut_down(self) -> int:
+        # Stops the components in reverse order, all of them within drain_timeout
+        sd_notify("STOPPING=1")
+        deadline = time.monotonic() + self.drain_timeout
+        exit_code = 0
+        for state in reversed(self.states):
+            component = state.component
+            remaining = max(deadline - time.monotonic(), 0.0)
+            logger.info("Stopping {}".format(component.name))
+            thread = threading.Thread(target=self.stop_component, args=(component, remaining),
+                                      name="Stop-" + component.name, daemon=True)
+            thread.start()
+            thread.join(remaining)
+            if thread.is_alive():
+                logger.warning("{} did not stop within the drain deadline".format(component.name))
+                exit_code = EXIT_DRAIN_TIMEOUT
+        return exit_code
+
+    @staticmethod
+    def stop_component(component, timeout):
+        try:
+            component.stop(timeout)
+        except Exception as exc:
+            logger.error("Error while stopping {}.\nDetails: {}".format(component.name, exc))